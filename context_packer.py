@@ -0,0 +1,170 @@
+"""
+Context Packer - Token-budgeted prompt context from retrieved chunks
+
+Retrieved chunks are up to 1000 characters each and split_documents overlaps neighbouring chunks
+by 200, so joining them as-is gives prompts whose size swings with how many chunks survive the
+chapter filter, and repeats the overlapping text. `pack_context`:
+- counts tokens with tiktoken, using the chat model's encoding (characters / 4 if unavailable)
+- merges a chunk that overlaps an already packed one into it, so the shared text appears once
+- adds chunks in the order given (the reranker's) until the token budget is reached, trimming
+  the chunk that would overflow it at a sentence boundary
+- records original vs packed token counts of every request in `context_packing_stats`
+"""
+import re
+import threading
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+
+from langchain_core.documents import Document
+
+MIN_OVERLAP_CHARS = 40  # Shorter shared edges are coincidence, not splitter overlap
+MAX_OVERLAP_CHARS = 250  # split_documents overlaps chunks by up to 200 characters
+MIN_TRIMMED_TOKENS = 40  # A smaller remainder of the budget is left unused rather than filled with a fragment
+
+_SENTENCE_BREAK = re.compile(r"(?<=[.!?])\s+")
+
+
+@lru_cache(maxsize=4)
+def _encoding(model_name: str):
+    """tiktoken encoding for `model_name`, or None when tiktoken cannot be loaded."""
+    try:
+        import tiktoken  # Local BPE tokenizer; encodings are downloaded once and cached
+        try:
+            return tiktoken.encoding_for_model(model_name)
+        except KeyError:  # Model newer than this tiktoken release
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:  # Not installed, or no cached encoding and no network
+        print(f"⚠️ tiktoken unavailable ({e}); estimating tokens from characters.")
+        return None
+
+
+def count_tokens(text: str, model_name: str) -> int:
+    encoding = _encoding(model_name)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def _overlap(head: str, tail: str) -> int:
+    """Length of the longest end of `head` that `tail` starts with, if long enough to be splitter overlap."""
+    for k in range(min(len(head), len(tail), MAX_OVERLAP_CHARS), MIN_OVERLAP_CHARS - 1, -1):
+        if head.endswith(tail[:k]):
+            return k
+    return 0
+
+
+def _placement(pieces: List[str], text: str) -> Tuple[Optional[int], str, str]:
+    """
+    Where `text` goes: (index of the piece it joins or None for a new piece, the new text, and
+    how it joins: "after" or "before" that piece, or "replace" it when `text` contains it).
+    The new text is empty if `text` is already packed.
+    """
+    for i, piece in enumerate(pieces):
+        if text in piece:
+            return i, "", "after"
+        if piece in text:
+            return i, text, "replace"
+        k = _overlap(piece, text)
+        if k:
+            return i, text[k:], "after"
+        k = _overlap(text, piece)
+        if k:
+            return i, text[:-k], "before"
+    return None, text, "after"
+
+
+def _trim(text: str, budget: int, model_name: str, keep_end: bool) -> str:
+    """Longest run of whole sentences within `budget` tokens, from the start (or the end)."""
+    sentences = _SENTENCE_BREAK.split(text)
+    if keep_end:
+        sentences.reverse()
+    kept, used = [], 0
+    for sentence in sentences:
+        used += count_tokens(sentence + " ", model_name)
+        if used > budget:
+            break
+        kept.append(sentence)
+    if keep_end:
+        kept.reverse()
+    return " ".join(kept)
+
+
+class ContextPackingStats:
+    """Original vs packed prompt context size of recent requests."""
+
+    def __init__(self, max_samples: int = 1000):
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self._samples: List[Dict[str, int]] = []
+
+    def record(self, original_tokens: int, packed_tokens: int, chunks: int, chunks_used: int) -> None:
+        with self._lock:
+            self._samples.append({"original_tokens": original_tokens, "packed_tokens": packed_tokens,
+                                  "chunks": chunks, "chunks_used": chunks_used})
+            del self._samples[:-self.max_samples]  # Recent samples only
+
+    def as_dict(self, recent: int = 20) -> Dict[str, Any]:
+        with self._lock:
+            samples = list(self._samples)
+        if not samples:
+            return {"count": 0}
+        original = sum(sample["original_tokens"] for sample in samples)
+        packed = sorted(sample["packed_tokens"] for sample in samples)
+        return {
+            "count": len(samples),
+            "original_tokens_mean": original / len(samples),
+            "packed_tokens_mean": sum(packed) / len(samples),
+            "packed_tokens_p50": packed[len(packed) // 2],
+            "packed_tokens_max": packed[-1],
+            "saved_fraction": 1 - sum(packed) / original if original else 0.0,
+            "recent": samples[-recent:],
+        }
+
+
+context_packing_stats = ContextPackingStats()
+
+
+def pack_context(docs: List[Document], budget: int, model_name: str) -> Tuple[str, List[Document]]:
+    """
+    Packs the chunks' text into at most `budget` tokens (0 = no limit, overlaps are still merged).
+
+    `docs` must be in rerank order. Returns the context and the chunks that contributed to it.
+    """
+    pieces: List[str] = []
+    used_docs: List[Document] = []
+    used = 0
+    for doc in docs:
+        index, text, how = _placement(pieces, doc.page_content.strip())
+        if not text:
+            continue
+        if how == "replace":
+            tokens = count_tokens(text, model_name) - count_tokens(pieces[index], model_name)
+        else:
+            tokens = count_tokens(text, model_name) + (1 if index is None and pieces else 0)  # "\n\n" separator
+        if budget and used + tokens > budget:
+            # A trimmed replacement might drop part of the piece it replaces, so it is not trimmed
+            if how == "replace" or budget - used < MIN_TRIMMED_TOKENS:
+                break
+            text = _trim(text, budget - used, model_name, keep_end=how == "before")
+            if not text:
+                break
+            tokens = budget - used  # Stop after this chunk; the exact total is counted below
+        if index is None:
+            pieces.append(text)
+        elif how == "replace":
+            pieces[index] = text
+        elif how == "before":
+            pieces[index] = text + pieces[index]
+        else:
+            pieces[index] = pieces[index] + text
+        used_docs.append(doc)
+        used += tokens
+        if budget and used >= budget:
+            break
+
+    context = "\n\n".join(pieces)
+    original_tokens = count_tokens("\n\n".join(doc.page_content for doc in docs), model_name)
+    packed_tokens = count_tokens(context, model_name)
+    context_packing_stats.record(original_tokens, packed_tokens, len(docs), len(used_docs))
+    print(f"Context: {packed_tokens}/{original_tokens} tokens from {len(used_docs)}/{len(docs)} chunks.")
+    return context, used_docs
@@ -0,0 +1,217 @@
+"""
+Fake Chat Model - Deterministic offline stand-in for ChatOpenAI
+
+Answers every prompt the app sends with a well-formed reply of the expected shape, so the quiz
+API can be load-tested without an API key or budget:
+- single questions in the "QUESTION: ... ANSWER: ..." format
+- JSON arrays of question candidates
+- structured grading JSON (and the sequential relevance / verdict / hint prompts)
+
+Verdicts follow the word overlap between the student's and the expected answer, so a load
+driver that submits the expected answer gets "correct" and one that submits noise does not.
+Replies are seeded from the prompt and a call counter, so a sequential run is reproducible.
+
+Latency, errors and reply length are configurable:
+- time to first token is log-normal with median FAKE_LLM_LATENCY_MS and shape FAKE_LLM_LATENCY_SIGMA
+- every output token adds FAKE_LLM_TOKEN_MS (streamed replies sleep between tokens)
+- FAKE_LLM_ERROR_RATE of calls fail like the OpenAI API does under load (429, 500, 503)
+- FAKE_LLM_ANSWER_TOKENS sets the length of generated answers and feedback
+
+Tokens are counted as whitespace-separated words, which is close enough for load testing.
+`main.model_registry` builds this model instead of ChatOpenAI when CHAT_BACKEND=fake.
+"""
+import hashlib
+import itertools
+import json
+import os
+import random
+import re
+import time
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+FAKE_LLM_LATENCY_MS = float(os.getenv("FAKE_LLM_LATENCY_MS", "600"))  # Median time to first token
+FAKE_LLM_LATENCY_SIGMA = float(os.getenv("FAKE_LLM_LATENCY_SIGMA", "0.4"))  # Log-normal shape; 0 = fixed latency
+FAKE_LLM_TOKEN_MS = float(os.getenv("FAKE_LLM_TOKEN_MS", "12"))  # Generation time per output token
+FAKE_LLM_ERROR_RATE = float(os.getenv("FAKE_LLM_ERROR_RATE", "0"))  # Fraction of calls that raise FakeChatModelError
+FAKE_LLM_ANSWER_TOKENS = int(os.getenv("FAKE_LLM_ANSWER_TOKENS", "45"))  # Length of generated answers and feedback
+FAKE_LLM_SEED = int(os.getenv("FAKE_LLM_SEED", "0"))
+
+_calls = itertools.count()  # Distinguishes repeated identical prompts, which must not get identical questions
+
+_STOPWORDS = frozenset("""
+a an and are as at be but by for from had has have he her his in into is it its of on or that the their
+them there these they this to was were what when which who will with would how why did does
+""".split())
+
+_QUESTION_TEMPLATES = [
+    "What role did {topic} play in {chapter}",
+    "How did {topic} influence the course of {chapter}",
+    "Why was {topic} significant for {chapter}",
+    "What were the main consequences of {topic}",
+    "How did contemporaries view {topic}",
+    "What caused the developments surrounding {topic}",
+    "Compare {topic} with {other} in {chapter}",
+]
+
+_ERRORS = [
+    (429, "Rate limit reached for requests"),
+    (500, "The server had an error while processing your request"),
+    (503, "The engine is currently overloaded, please try again later"),
+]
+
+
+class FakeChatModelError(RuntimeError):
+    """Simulated API failure; `status_code` mirrors the HTTP status the OpenAI client reports."""
+
+    def __init__(self, status_code: int, message: str):
+        super().__init__(f"Error code: {status_code} - {message}")
+        self.status_code = status_code
+
+
+def _words(text: str) -> List[str]:
+    return [word for word in re.findall(r"[a-z0-9]+", text.lower()) if word not in _STOPWORDS and len(word) > 2]
+
+
+def _field(prompt: str, name: str) -> str:
+    """Value of a "NAME: value" line in a prompt."""
+    match = re.search(rf"^\s*{re.escape(name)}:\s*(.*)$", prompt, re.MULTILINE)
+    return match.group(1).strip() if match else ""
+
+
+def _overlap(answer: str, expected: str) -> float:
+    """Share of the expected answer's content words that the answer contains."""
+    expected_words = set(_words(expected))
+    return len(expected_words & set(_words(answer))) / len(expected_words) if expected_words else 0.0
+
+
+def _verdict(overlap: float) -> str:
+    if overlap >= 0.6:
+        return "correct"
+    if overlap >= 0.3:
+        return "partially correct"
+    return "incorrect"
+
+
+class FakeChatModel(BaseChatModel):
+    """Chat model that fabricates plausible replies to the app's prompts with simulated latency."""
+
+    model_name: str = "fake-chat"
+    max_tokens: int = 1500
+    latency_ms: float = FAKE_LLM_LATENCY_MS
+    latency_sigma: float = FAKE_LLM_LATENCY_SIGMA
+    token_ms: float = FAKE_LLM_TOKEN_MS
+    error_rate: float = FAKE_LLM_ERROR_RATE
+    answer_tokens: int = FAKE_LLM_ANSWER_TOKENS
+    seed: int = FAKE_LLM_SEED
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    # --- Replies ---
+    def _rng(self, prompt: str) -> random.Random:
+        digest = hashlib.sha1(f"{self.seed}|{next(_calls)}|{prompt}".encode("utf-8")).hexdigest()
+        return random.Random(int(digest[:16], 16))
+
+    def _sentences(self, rng: random.Random, words: List[str], tokens: int) -> str:
+        """Filler prose of about `tokens` words built from the prompt's own vocabulary."""
+        words = words or ["history", "events", "change", "society", "politics"]
+        out = []
+        while len(out) < tokens:
+            sentence = [rng.choice(words) for _ in range(rng.randint(8, 14))]
+            sentence[0] = sentence[0].capitalize()
+            out.extend(sentence)
+            out[-1] += "."
+        return " ".join(out[:tokens]).rstrip(".") + "."
+
+    def _question(self, rng: random.Random, prompt: str) -> Tuple[str, str]:
+        context = prompt.split("CONTEXT:", 1)[-1]
+        words = _words(context) or _words(prompt)
+        topics = sorted(set(words)) or ["the period"]
+        chapter = _field(prompt, "CHAPTER") or "this chapter"
+        template = rng.choice(_QUESTION_TEMPLATES)
+        question = template.format(topic=rng.choice(topics), other=rng.choice(topics), chapter=chapter) + "?"
+        return question, self._sentences(rng, words, self.answer_tokens)
+
+    def _reply(self, prompt: str, rng: random.Random) -> str:
+        if "QUESTION: [Your question here?]" in prompt:
+            question, answer = self._question(rng, prompt)
+            return f"QUESTION: {question}\nANSWER: {answer}"
+        if "JSON array" in prompt:
+            match = re.search(r"generate (\d+) different", prompt)
+            n = int(match.group(1)) if match else 3
+            items = [self._question(rng, prompt) for _ in range(n)]
+            return json.dumps([{"question": question, "answer": answer} for question, answer in items])
+        if "Grade a student's answer" in prompt:
+            student = _field(prompt, "STUDENT'S ANSWER")
+            overlap = _overlap(student, _field(prompt, "EXPECTED ANSWER"))
+            relevant = overlap > 0 or bool(set(_words(student)) & set(_words(_field(prompt, "QUESTION"))))
+            verdict = _verdict(overlap) if relevant else "incorrect"
+            feedback_words = _words(student) + _words(_field(prompt, "EXPECTED ANSWER"))
+            return json.dumps({
+                "relevant": relevant,
+                "verdict": verdict,
+                "score": {"correct": 1.0, "partially correct": 0.5, "incorrect": 0.0}[verdict],
+                "feedback": self._sentences(rng, feedback_words, max(8, self.answer_tokens // 3)),
+                "hint": "" if verdict == "correct" else self._sentences(rng, feedback_words, 15),
+            })
+        if "Is this answer relevant" in prompt:
+            shared = set(_words(_field(prompt, "Answer"))) & set(_words(_field(prompt, "Question")))
+            return "yes" if shared or rng.random() < 0.8 else "no"
+        if "Evaluate this answer as" in prompt:
+            return _verdict(_overlap(_field(prompt, "Student's Answer"), _field(prompt, "Expected Answer")))
+        if prompt.rstrip().endswith("HINT:"):
+            return "HINT: " + self._sentences(rng, _words(_field(prompt, "EXPECTED ANSWER")), 20)
+        # Anything else, e.g. the RetrievalQA prompt
+        return self._sentences(rng, _words(prompt.split("CONTEXT:", 1)[-1]), self.answer_tokens) + " [p. 1]"
+
+    # --- Simulated API behaviour ---
+    def _first_token_delay(self, rng: random.Random) -> float:
+        if self.latency_sigma <= 0:
+            return self.latency_ms / 1000
+        return rng.lognormvariate(0.0, self.latency_sigma) * self.latency_ms / 1000
+
+    def _start(self, messages: List[BaseMessage]) -> Tuple[str, List[str]]:
+        """Picks the reply, waits out the time to first token and maybe fails like the API would."""
+        prompt = "\n".join(str(message.content) for message in messages)
+        rng = self._rng(prompt)
+        delay = self._first_token_delay(rng)
+        if rng.random() < self.error_rate:
+            time.sleep(delay / 4)  # Errors come back faster than completions
+            raise FakeChatModelError(*rng.choice(_ERRORS))
+        tokens = self._reply(prompt, rng).split(" ")[:self.max_tokens]
+        time.sleep(delay)
+        return prompt, tokens
+
+    def _usage(self, prompt: str, tokens: List[str]) -> Dict[str, Any]:
+        prompt_tokens = len(prompt.split())
+        return {
+            "token_usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": len(tokens),
+                "total_tokens": prompt_tokens + len(tokens),
+            },
+            "model_name": self.model_name,
+        }
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager=None, **kwargs: Any) -> ChatResult:
+        prompt, tokens = self._start(messages)
+        time.sleep(len(tokens) * self.token_ms / 1000)
+        message = AIMessage(content=" ".join(tokens))
+        return ChatResult(generations=[ChatGeneration(message=message)], llm_output=self._usage(prompt, tokens))
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager=None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        _, tokens = self._start(messages)
+        for i, token in enumerate(tokens):
+            if i:
+                time.sleep(self.token_ms / 1000)
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=token if i == 0 else " " + token))
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
@@ -0,0 +1,267 @@
+"""
+Grader Calibration - Agreement of the tiered local grader with labelled verdicts
+
+Scores every answer of a labelled set with the local grader's two signals (answer/expected
+embedding similarity and the cross-encoder score of the pair) and reports:
+- at the configured LOCAL_GRADING_* thresholds: the share of answers decided locally, i.e. LLM
+  grading calls saved, and how often each local tier agrees with the labels
+- a threshold sweep: for each accuracy target, the thresholds that decide the most answers locally
+- the mean of both signals per label, to see how well they separate
+- with --llm, the LLM grader's agreement on the same set and that of the whole tiered pipeline
+  (local verdicts where decided, the LLM's elsewhere); this makes one LLM call per answer
+
+Local verdicts never award partial credit, so an answer labelled "partially correct" counts as
+a disagreement whenever it is decided locally. "incorrect" and "off-topic" agree with each other:
+both score zero for the student.
+
+Models are loaded from the local HuggingFace cache only. Labelled answers are read from a JSON
+list (default data/grading_labels.json):
+    [{"question": "...", "expected_answer": "...", "student_answer": "...",
+      "label": "correct" | "partially correct" | "incorrect" | "off-topic"}, ...]
+
+Usage:
+    python grader_calibration.py [--labels data/grading_labels.json] [--llm]
+                                 [--output calibration.json] [--baseline previous.json]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+# Must be set before transformers / huggingface_hub are imported by main
+os.environ.setdefault("HF_HUB_OFFLINE", "1")
+os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
+
+import numpy as np
+
+from main import (
+    BASE_DIR,
+    LOCAL_GRADING_CORRECT,
+    LOCAL_GRADING_INCORRECT,
+    LOCAL_GRADING_RELEVANCE,
+    LocalGrader,
+    analyze_student_answer,
+    local_verdict,
+    model_registry,
+)
+
+LABELS_PATH = BASE_DIR / "data" / "grading_labels.json"
+LABELS = ("correct", "partially correct", "incorrect", "off-topic")
+ACCURACY_TARGETS = (0.90, 0.95, 0.98)
+RELEVANCE_GRID = [round(0.30 + 0.05 * i, 2) for i in range(11)]  # 0.30 .. 0.80
+CORRECT_GRID = [round(0.50 + 0.05 * i, 2) for i in range(10)] + [0.97, 0.99]  # 0.50 .. 0.95, 0.97, 0.99
+INCORRECT_GRID = [0.01, 0.02] + [round(0.05 * i, 2) for i in range(1, 11)]  # 0.01, 0.02, 0.05 .. 0.50
+
+
+def agrees(verdict: str, label: str) -> bool:
+    if verdict in ("incorrect", "off-topic"):
+        return label in ("incorrect", "off-topic")
+    return verdict == label
+
+
+def load_labels(path: Path) -> List[dict]:
+    if not path.exists():
+        print(f"❌ No labelled answers at {path}; see the format in this script's docstring.")
+        sys.exit(1)
+    with open(path, 'r', encoding='utf-8') as f:
+        items = json.load(f)
+    unknown = {item["label"] for item in items} - set(LABELS)
+    if unknown:
+        print(f"❌ Unknown labels {sorted(unknown)}; expected one of {LABELS}.")
+        sys.exit(1)
+    return items
+
+
+def score_answers(items: List[dict], grader: LocalGrader) -> Dict[str, np.ndarray]:
+    """Both local signals for every answer, plus the time the two models took per answer."""
+    similarities, cross_scores, seconds = [], [], []
+    for n, item in enumerate(items, 1):
+        start = time.perf_counter()
+        similarities.append(grader.similarity(item["expected_answer"], item["student_answer"]))
+        cross_scores.append(grader.cross_score(item["expected_answer"], item["student_answer"]))
+        seconds.append(time.perf_counter() - start)
+        if n % 50 == 0:
+            print(f"Scored {n}/{len(items)} answers")
+    return {"similarity": np.array(similarities), "cross_score": np.array(cross_scores), "seconds": np.array(seconds)}
+
+
+def evaluate(scores: Dict[str, np.ndarray], labels: List[str], relevance: float, correct: float,
+             incorrect: float) -> Dict:
+    """Share of answers decided locally and their agreement with the labels, per tier."""
+    verdicts = [local_verdict(similarity, cross_score, relevance, correct, incorrect)
+                for similarity, cross_score in zip(scores["similarity"], scores["cross_score"])]
+    tiers = {}
+    for verdict, label in zip(verdicts, labels):
+        if verdict is not None:
+            tier = tiers.setdefault(verdict, {"n": 0, "agree": 0})
+            tier["n"] += 1
+            tier["agree"] += agrees(verdict, label)
+    decided = sum(tier["n"] for tier in tiers.values())
+    return {
+        "thresholds": {"relevance": relevance, "correct": correct, "incorrect": incorrect},
+        "decided_fraction": decided / len(labels),
+        "accuracy": sum(tier["agree"] for tier in tiers.values()) / decided if decided else None,
+        "tiers": tiers,
+        "verdicts": verdicts,
+    }
+
+
+def sweep(scores: Dict[str, np.ndarray], labels: List[str], targets=ACCURACY_TARGETS) -> List[Dict]:
+    """For each accuracy target, the grid thresholds deciding the most answers at that accuracy or better."""
+    labels = np.array(labels)
+    is_correct = labels == "correct"
+    is_wrong = np.isin(labels, ["incorrect", "off-topic"])
+    similarity, cross_score = scores["similarity"], scores["cross_score"]
+    best: Dict[float, tuple] = {}
+    for relevance in RELEVANCE_GRID:
+        off_topic = similarity < relevance
+        off_topic_agree = int((off_topic & is_wrong).sum())
+        for correct in CORRECT_GRID:
+            local_correct = ~off_topic & (cross_score >= correct)
+            correct_agree = int((local_correct & is_correct).sum())
+            for incorrect in INCORRECT_GRID:
+                if incorrect >= correct:
+                    continue
+                local_incorrect = ~off_topic & (cross_score <= incorrect)
+                decided = int(off_topic.sum() + local_correct.sum() + local_incorrect.sum())
+                if not decided:
+                    continue
+                accuracy = (off_topic_agree + correct_agree + int((local_incorrect & is_wrong).sum())) / decided
+                for target in targets:
+                    candidate = (decided, accuracy, relevance, correct, incorrect)
+                    if accuracy >= target and (target not in best or candidate[:2] > best[target][:2]):
+                        best[target] = candidate
+    return [
+        {"target": target, "thresholds": {"relevance": r, "correct": c, "incorrect": i},
+         "decided_fraction": decided / len(labels), "accuracy": accuracy}
+        for target, (decided, accuracy, r, c, i) in sorted(best.items())
+    ]
+
+
+def signal_means(scores: Dict[str, np.ndarray], labels: List[str]) -> Dict[str, Dict[str, float]]:
+    """Mean similarity and cross-encoder score per label present in the set."""
+    means = {}
+    for label in LABELS:
+        mask = np.array(labels) == label
+        if mask.any():
+            means[label] = {"similarity_mean": float(scores["similarity"][mask].mean()),
+                            "cross_score_mean": float(scores["cross_score"][mask].mean())}
+    return means
+
+
+def llm_verdicts(items: List[dict]) -> Dict:
+    """The LLM grader's verdict on every answer (no grading cache, no local tier)."""
+    llm = model_registry.get_chat_model()
+    verdicts, seconds = [], []
+    for n, item in enumerate(items, 1):
+        start = time.perf_counter()
+        analysis = analyze_student_answer(item["question"], item["student_answer"], item["expected_answer"], llm,
+                                          zpd_score=5.0, lazy_hints=True, use_cache=False, local=False)
+        seconds.append(time.perf_counter() - start)
+        if 'relevant' not in analysis:
+            verdicts.append(None)  # Grading failed
+        elif not analysis['relevant']:
+            verdicts.append("off-topic")
+        elif analysis['is_correct']:
+            verdicts.append("correct")
+        else:
+            verdicts.append("partially correct" if analysis.get('partially_correct') else "incorrect")
+        if n % 10 == 0:
+            print(f"LLM graded {n}/{len(items)} answers")
+    return {"verdicts": verdicts, "seconds": np.array(seconds)}
+
+
+def run_calibration(labels_path: Path = LABELS_PATH, with_llm: bool = False) -> dict:
+    items = load_labels(labels_path)
+    labels = [item["label"] for item in items]
+    print(f"Scoring {len(items)} labelled answers with the local models...")
+    # Uncached cross-encoder, so a calibration run leaves the rerank cache as it was
+    scores = score_answers(items, LocalGrader(cross_encoder=model_registry.get_scoring_cross_encoder()))
+    current = evaluate(scores, labels, LOCAL_GRADING_RELEVANCE, LOCAL_GRADING_CORRECT, LOCAL_GRADING_INCORRECT)
+    local_verdicts = current.pop("verdicts")
+
+    report = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "config": {"labels": str(labels_path), "embedder": model_registry.get_embeddings().model_name,
+                   "reranker": model_registry.get_reranker().model_name},
+        "answers": len(items),
+        "label_counts": {label: labels.count(label) for label in LABELS},
+        "signals": signal_means(scores, labels),
+        "local_ms_p50": float(np.median(scores["seconds"]) * 1000),
+        "current": current,
+        "sweep": sweep(scores, labels),
+    }
+    if with_llm:
+        print("Grading every answer with the LLM for comparison...")
+        llm = llm_verdicts(items)
+        graded = [(verdict, label) for verdict, label in zip(llm["verdicts"], labels) if verdict is not None]
+        tiered = [(local or verdict, label) for local, verdict, label in zip(local_verdicts, llm["verdicts"], labels)
+                  if (local or verdict) is not None]
+        report["llm"] = {
+            "graded": len(graded),
+            "agreement": sum(agrees(verdict, label) for verdict, label in graded) / len(graded) if graded else None,
+            "tiered_agreement": sum(agrees(verdict, label) for verdict, label in tiered) / len(tiered) if tiered else None,
+            "llm_ms_p50": float(np.median(llm["seconds"]) * 1000),
+        }
+    return report
+
+
+def print_report(report: dict, baseline: dict = None) -> None:
+    def delta(key: str) -> str:
+        try:
+            return f" ({report['current'][key] - baseline['current'][key]:+.3f})"
+        except (KeyError, TypeError):
+            return ""
+
+    counts = ", ".join(f"{label}: {count}" for label, count in report["label_counts"].items())
+    print(f"\n{report['answers']} labelled answers ({counts})")
+    print(f"\n{'label':<18} {'similarity':>10} {'cross-encoder':>14}")
+    for label, signals in report["signals"].items():
+        print(f"{label:<18} {signals['similarity_mean']:>10.3f} {signals['cross_score_mean']:>14.3f}")
+
+    current = report["current"]
+    thresholds = current["thresholds"]
+    accuracy = f"{current['accuracy']:.3f}{delta('accuracy')}" if current["accuracy"] is not None else "n/a"
+    print(f"\nAt relevance {thresholds['relevance']}, correct {thresholds['correct']}, "
+          f"incorrect {thresholds['incorrect']}:")
+    print(f"  decided locally: {current['decided_fraction']:.1%}{delta('decided_fraction')} of answers "
+          f"(LLM grading calls saved), accuracy {accuracy}")
+    for tier, stats in current["tiers"].items():
+        print(f"  {tier:<10} {stats['n']:>5} answers, {stats['agree'] / stats['n']:.1%} agree with the labels")
+    print(f"  local grading: {report['local_ms_p50']:.1f} ms per answer (p50)")
+
+    print(f"\n{'target':>7} {'relevance':>10} {'correct':>8} {'incorrect':>10} {'decided':>8} {'accuracy':>9}")
+    for row in report["sweep"]:
+        t = row["thresholds"]
+        print(f"{row['target']:>7.2f} {t['relevance']:>10.2f} {t['correct']:>8.2f} {t['incorrect']:>10.2f} "
+              f"{row['decided_fraction']:>8.1%} {row['accuracy']:>9.3f}")
+
+    llm: Optional[dict] = report.get("llm")
+    if llm and llm["agreement"] is not None:
+        print(f"\nLLM only: {llm['agreement']:.3f} agreement over {llm['graded']} answers "
+              f"({llm['llm_ms_p50']:.0f} ms per answer, p50)")
+        print(f"Tiered:   {llm['tiered_agreement']:.3f} agreement at the thresholds above")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calibrate the tiered local grader against labelled answers.")
+    parser.add_argument("--labels", default=str(LABELS_PATH), help="Labelled answers (JSON)")
+    parser.add_argument("--llm", action="store_true", help="Also grade every answer with the LLM for comparison")
+    parser.add_argument("--output", help="Optional path to write the report as JSON")
+    parser.add_argument("--baseline", help="Earlier report JSON to print deltas against")
+    args = parser.parse_args()
+
+    report = run_calibration(labels_path=Path(args.labels), with_llm=args.llm)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
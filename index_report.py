@@ -0,0 +1,127 @@
+"""
+Index Report - Compares FAISS index types on the real chunk set
+
+Builds every index type supported by `main.build_faiss_index` (flat, sq8, ivf_flat, ivf_pq)
+from the vectors in the saved index and measures, for each one:
+- recall@k against exact flat search
+- p50/p99 single-query search latency
+- serialized index size and build time
+
+Queries are a fixed random sample of the chunk vectors themselves, so the report runs offline
+without loading the embedding model. Pass --encode-queries to use the question-generation
+aspect queries encoded by the BGE embedder instead.
+
+Usage:
+    python index_report.py [--k 10] [--queries 200] [--output report.json]
+"""
+import argparse
+import json
+import time
+from typing import Dict, List
+
+import faiss
+import numpy as np
+
+from main import (
+    VECTORSTORE_PATH,
+    CHAPTER_MAP_PATH,
+    CONTENT_ASPECTS,  # The focus aspects question generation draws from
+    INDEX_TYPES,
+    build_faiss_index,
+    choose_index_params,
+    load_chapter_map,
+    model_registry,
+    reconstruct_vectors,
+)
+
+
+def load_corpus_vectors():
+    """Loads every vector from the saved index, plus its metric type."""
+    index = faiss.read_index(str(VECTORSTORE_PATH / "index.faiss"))
+    if not isinstance(index, faiss.IndexFlat):
+        print("⚠️ Saved index is not flat; ground truth will use its reconstructed (approximate) vectors.")
+    return reconstruct_vectors(index), index.metric_type
+
+
+def sample_queries(vectors, n_queries: int, seed: int = 42):
+    """A fixed random sample of chunk vectors to use as queries."""
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(vectors), size=min(n_queries, len(vectors)), replace=False)
+    return vectors[np.sort(rows)]
+
+
+def encode_aspect_queries():
+    """Encodes 'chapter title + focus aspect' for every chapter, as question generation does."""
+    embeddings = model_registry.get_embeddings()
+    texts = [f"{chapter['title']} {aspect}" for chapter in load_chapter_map(CHAPTER_MAP_PATH)
+             for aspect in CONTENT_ASPECTS]
+    return np.array([embeddings.embed_query(text) for text in texts], dtype="float32")
+
+
+def measure_index(index, queries, k: int, truth: List[set]) -> Dict[str, float]:
+    """Runs queries one at a time, as the retriever does, and scores them against the flat results."""
+    latencies, recalls = [], []
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        _, ids = index.search(query.reshape(1, -1), k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        recalls.append(len(expected & set(ids[0].tolist())) / max(1, len(expected)))
+    return {
+        f"recall@{k}": float(np.mean(recalls)),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+    }
+
+
+def run_report(k: int = 10, n_queries: int = 200, encode_queries: bool = False) -> dict:
+    vectors, metric_type = load_corpus_vectors()
+    queries = encode_aspect_queries() if encode_queries else sample_queries(vectors, n_queries)
+    print(f"Corpus: {len(vectors)} vectors of dim {vectors.shape[1]}; {len(queries)} queries; k={k}")
+
+    flat = build_faiss_index(vectors, "flat", metric_type)
+    _, truth_ids = flat.search(queries, k)
+    truth = [set(row.tolist()) - {-1} for row in truth_ids]
+
+    results = {}
+    for index_type in INDEX_TYPES:
+        start = time.perf_counter()
+        index = build_faiss_index(vectors, index_type, metric_type)
+        build_seconds = time.perf_counter() - start
+        stats = measure_index(index, queries, k, truth)
+        stats["build_s"] = build_seconds
+        stats["size_bytes"] = int(faiss.serialize_index(index).nbytes)
+        results[index_type] = stats
+    return {
+        "n_vectors": int(len(vectors)),
+        "dim": int(vectors.shape[1]),
+        "n_queries": int(len(queries)),
+        "k": k,
+        "params": choose_index_params(len(vectors), vectors.shape[1]),
+        "results": results,
+    }
+
+
+def print_report(report: dict) -> None:
+    k = report["k"]
+    print(f"\n{'index':<10} {'recall@' + str(k):>10} {'p50 ms':>9} {'p99 ms':>9} {'size MB':>9} {'build s':>9}")
+    for index_type, stats in report["results"].items():
+        print(f"{index_type:<10} {stats[f'recall@{k}']:>10.3f} {stats['p50_ms']:>9.3f} {stats['p99_ms']:>9.3f} "
+              f"{stats['size_bytes'] / 1e6:>9.2f} {stats['build_s']:>9.2f}")
+    print(f"\nParameters: {report['params']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recall vs latency report for FAISS index types.")
+    parser.add_argument("--k", type=int, default=10, help="Neighbours per query (default: 10)")
+    parser.add_argument("--queries", type=int, default=200, help="Sampled chunk vectors used as queries")
+    parser.add_argument("--encode-queries", action="store_true",
+                        help="Use encoded chapter/aspect queries instead of sampled chunk vectors")
+    parser.add_argument("--output", help="Optional path to write the report as JSON")
+    args = parser.parse_args()
+
+    report = run_report(k=args.k, n_queries=args.queries, encode_queries=args.encode_queries)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
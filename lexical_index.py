@@ -0,0 +1,160 @@
+"""
+Lexical Index - Compact BM25 inverted index stored next to the FAISS index
+
+History questions hinge on names, dates and treaties, where exact term matching is cheap and
+precise. The index is stored as flat arrays rather than pickled dicts:
+- bm25_terms.json      sorted vocabulary (term i owns postings[offsets[i]:offsets[i + 1]])
+- bm25_offsets.npy     int64 postings offsets per term
+- bm25_docs.npy        int32 row ids (= FAISS positions), ascending within each term
+- bm25_tfs.npy         uint16 term frequencies, parallel to bm25_docs
+- bm25_doclens.npy     int32 token count per row
+
+The arrays are opened with mmap, like the columnar docstore in vector_storage.py.
+"""
+import json
+import os
+import re
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+TERMS_FILE = "bm25_terms.json"  # Written last, so its presence marks a complete index
+OFFSETS_FILE = "bm25_offsets.npy"
+DOCS_FILE = "bm25_docs.npy"
+TFS_FILE = "bm25_tfs.npy"
+DOCLENS_FILE = "bm25_doclens.npy"
+
+# Small English stopword list; dates and proper nouns are what we want to keep
+STOPWORDS = frozenset("""
+a an and are as at be but by for from had has have he her his in into is it its of on or
+that the their them there these they this to was were what when which who will with would
+""".split())
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercased alphanumeric tokens without stopwords; years like 1919 are kept whole."""
+    return [token for token in _TOKEN_RE.findall(text.lower()) if token not in STOPWORDS]
+
+
+class BM25Index:
+    """Okapi BM25 over postings arrays; rows are FAISS vector positions."""
+
+    def __init__(self, terms: List[str], offsets, docs, tfs, doc_lengths, k1: float = 1.5, b: float = 0.75):
+        self.terms = terms
+        self.term_ids = {term: i for i, term in enumerate(terms)}
+        self.offsets = offsets
+        self.docs = docs
+        self.tfs = tfs
+        self.doc_lengths = doc_lengths
+        self.k1 = k1
+        self.b = b
+        self.n_docs = len(doc_lengths)
+        self.avg_length = float(np.mean(doc_lengths)) if self.n_docs else 0.0
+        # Per-row length normalization is query independent, so it is computed once
+        self._norm = k1 * (1 - b + b * np.asarray(doc_lengths, dtype=np.float32) / max(self.avg_length, 1e-9))
+
+    @classmethod
+    def from_texts(cls, texts: Iterable[str], **kwargs) -> "BM25Index":
+        """Builds the index in memory from texts given in row order."""
+        postings: Dict[str, List[Tuple[int, int]]] = {}
+        doc_lengths = []
+        for row, text in enumerate(texts):
+            tokens = tokenize(text)
+            doc_lengths.append(len(tokens))
+            counts: Dict[str, int] = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, count in counts.items():
+                postings.setdefault(token, []).append((row, count))
+
+        terms = sorted(postings)
+        offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+        for i, term in enumerate(terms):
+            offsets[i + 1] = offsets[i] + len(postings[term])
+        docs = np.empty(int(offsets[-1]), dtype=np.int32)
+        tfs = np.empty(int(offsets[-1]), dtype=np.uint16)
+        for i, term in enumerate(terms):
+            entries = postings[term]
+            docs[offsets[i]:offsets[i + 1]] = [row for row, _ in entries]
+            tfs[offsets[i]:offsets[i + 1]] = [min(count, 65535) for _, count in entries]
+        return cls(terms, offsets, docs, tfs, np.array(doc_lengths, dtype=np.int32), **kwargs)
+
+    @classmethod
+    def load(cls, directory: Path, **kwargs) -> Optional["BM25Index"]:
+        """Opens a saved index with mmap, or returns None if the directory has none."""
+        directory = Path(directory)
+        if not (directory / TERMS_FILE).exists():
+            return None
+        with open(directory / TERMS_FILE, 'r', encoding='utf-8') as f:
+            terms = json.load(f)
+        return cls(
+            terms,
+            np.load(directory / OFFSETS_FILE, mmap_mode="r"),
+            np.load(directory / DOCS_FILE, mmap_mode="r"),
+            np.load(directory / TFS_FILE, mmap_mode="r"),
+            np.load(directory / DOCLENS_FILE, mmap_mode="r"),
+            **kwargs
+        )
+
+    def save(self, directory: Path) -> None:
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        for filename, array in ((OFFSETS_FILE, self.offsets), (DOCS_FILE, self.docs),
+                                (TFS_FILE, self.tfs), (DOCLENS_FILE, self.doc_lengths)):
+            tmp_path = directory / (filename + ".tmp")
+            with open(tmp_path, 'wb') as f:
+                np.save(f, np.asarray(array))
+            os.replace(tmp_path, directory / filename)
+        tmp_terms = directory / (TERMS_FILE + ".tmp")
+        with open(tmp_terms, 'w', encoding='utf-8') as f:
+            json.dump(self.terms, f)
+        os.replace(tmp_terms, directory / TERMS_FILE)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(np.asarray(a).nbytes for a in (self.offsets, self.docs, self.tfs, self.doc_lengths))
+
+    def search(self, query: str, k: int = 10, rows: Optional[np.ndarray] = None) -> List[Tuple[int, float]]:
+        """
+        Top-k (row, score) pairs for a query, optionally restricted to the given rows.
+
+        Only the postings of the query's terms are touched, and scores are accumulated over the
+        rows they contain, so cost grows with how common those terms are rather than with the
+        corpus size. `rows` is intersected with each term's postings, not expanded into a mask.
+        """
+        if not self.n_docs:
+            return []
+        allowed = None if rows is None else np.asarray(rows, dtype=np.int64)
+        hits, contributions = [], []
+        for term in set(tokenize(query)):
+            term_id = self.term_ids.get(term)
+            if term_id is None:
+                continue
+            start, end = int(self.offsets[term_id]), int(self.offsets[term_id + 1])
+            docs = np.asarray(self.docs[start:end])
+            tfs = np.asarray(self.tfs[start:end], dtype=np.float32)
+            idf = np.log(1 + (self.n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            if allowed is not None:
+                keep = np.isin(docs, allowed)
+                docs, tfs = docs[keep], tfs[keep]
+            hits.append(docs)
+            contributions.append(idf * tfs * (self.k1 + 1) / (tfs + self._norm[docs]))
+        if not hits:
+            return []
+        candidates, slots = np.unique(np.concatenate(hits), return_inverse=True)
+        scores = np.zeros(len(candidates), dtype=np.float32)
+        np.add.at(scores, slots, np.concatenate(contributions))
+        top = np.argsort(-scores, kind="stable")[:k]
+        return [(int(candidates[i]), float(scores[i])) for i in top if scores[i] > 0]
+
+
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = 60) -> List[Tuple[str, float]]:
+    """Fuses ranked ID lists: each ID scores sum(1 / (k + rank)) over the lists it appears in."""
+    fused: Dict[str, float] = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking, start=1):
+            fused[item] = fused.get(item, 0.0) + 1.0 / (k + rank)
+    return sorted(fused.items(), key=lambda pair: pair[1], reverse=True)
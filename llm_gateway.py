@@ -0,0 +1,299 @@
+"""
+LLM Gateway - Shared admission control for chat model calls
+
+Every chat call in the process passes through one gateway, so a class-wide burst queues here
+instead of tripping the provider's rate limits and landing in the callers' fallbacks:
+- a semaphore caps the calls in flight
+- requests-per-minute and tokens-per-minute buckets pace calls to the account's limits; a call
+  reserves its prompt estimate plus `max_tokens` (what OpenAI counts against TPM) and gets the
+  unused part back once the reply reports its usage
+- 429, 5xx and connection errors are retried with exponential backoff and full jitter, honouring
+  Retry-After; the slot is released while backing off
+- the queue is bounded: a call that would wait behind `LLM_MAX_QUEUE` others, or longer than
+  `LLM_MAX_WAIT_S`, raises `LLMBusyError` at once, which the API turns into a 503
+- queue time (bucket wait plus semaphore wait) and errors are kept for `stats()`
+
+`GatewayChatModel` wraps any LangChain chat model, so chains such as RetrievalQA go through the
+gateway too. `main.model_registry` hands out wrapped models; `gated(llm)` wraps any other one.
+Streams are only retried before their first chunk, since text already shown cannot be taken back.
+"""
+import os
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+
+LLM_MAX_CONCURRENCY = max(1, int(os.getenv("LLM_MAX_CONCURRENCY", "8")))  # Chat calls in flight per process
+LLM_RPM = int(os.getenv("LLM_RPM", "500"))  # Requests per minute; 0 = unlimited
+LLM_TPM = int(os.getenv("LLM_TPM", "200000"))  # Tokens per minute (prompt + max_tokens); 0 = unlimited
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "4"))  # Retries of a call after 429/5xx/connection errors
+LLM_BACKOFF_BASE_S = float(os.getenv("LLM_BACKOFF_BASE_S", "0.5"))  # First backoff ceiling; doubles per retry
+LLM_BACKOFF_MAX_S = float(os.getenv("LLM_BACKOFF_MAX_S", "20"))  # Largest backoff ceiling
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "64"))  # Calls waiting for admission before new ones are refused; 0 = unbounded
+LLM_MAX_WAIT_S = float(os.getenv("LLM_MAX_WAIT_S", "30"))  # Longest admission wait before a call is refused; 0 = unbounded
+
+_CONNECTION_ERRORS = ("APIConnectionError", "APITimeoutError")  # openai's errors without a status code
+
+
+class LLMBusyError(RuntimeError):
+    """Raised when a chat call would queue behind LLM_MAX_QUEUE others or wait longer than LLM_MAX_WAIT_S."""
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (4 characters per token); only used for pacing."""
+    return len(text) // 4 + 1
+
+
+def _error_kind(error: Exception) -> Optional[str]:
+    """"429", "5xx" or "connection" for errors worth retrying, None for the rest."""
+    status = getattr(error, "status_code", None)
+    if status == 429:
+        return "429"
+    if isinstance(status, int) and status >= 500:
+        return "5xx"
+    if status is None and type(error).__name__ in _CONNECTION_ERRORS:
+        return "connection"
+    return None
+
+
+def _retry_after(error: Exception) -> float:
+    """Seconds from the Retry-After header of an OpenAI error response, or 0."""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after", 0))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class TokenBucket:
+    """
+    Refills `per_minute` units per minute, holding at most one minute's worth.
+
+    Reservations are taken immediately and may run the bucket into debt; each caller then waits
+    until the debt it added is paid off, so waiting callers are served in arrival order.
+    """
+
+    def __init__(self, per_minute: int):
+        self.per_minute = per_minute
+        self._level = float(per_minute)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._level = min(self.per_minute, self._level + (now - self._updated) * self.per_minute / 60)
+        self._updated = now
+
+    def reserve(self, amount: int) -> float:
+        """Takes `amount` units; returns the seconds to wait before using them."""
+        if self.per_minute <= 0:
+            return 0.0
+        with self._lock:
+            self._refill()
+            self._level -= amount
+            return max(0.0, -self._level * 60 / self.per_minute)
+
+    def refund(self, amount: int) -> None:
+        """Returns units reserved but not used."""
+        if self.per_minute <= 0 or amount <= 0:
+            return
+        with self._lock:
+            self._refill()
+            self._level = min(self.per_minute, self._level + amount)
+
+
+class LLMGateway:
+    """Process-wide concurrency limit, RPM/TPM pacing and retries for chat model calls."""
+
+    def __init__(self, max_concurrency: int = LLM_MAX_CONCURRENCY, rpm: int = LLM_RPM, tpm: int = LLM_TPM,
+                 max_retries: int = LLM_MAX_RETRIES, backoff_base_s: float = LLM_BACKOFF_BASE_S,
+                 backoff_max_s: float = LLM_BACKOFF_MAX_S, max_queue: int = LLM_MAX_QUEUE,
+                 max_wait_s: float = LLM_MAX_WAIT_S, max_samples: int = 1000):
+        self.max_concurrency = max(1, max_concurrency)
+        self.max_queue = max(0, max_queue)
+        self.max_wait_s = max(0.0, max_wait_s)
+        self.max_retries = max(0, max_retries)
+        self.backoff_base_s = backoff_base_s
+        self.backoff_max_s = backoff_max_s
+        self.max_samples = max_samples
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+        self._lock = threading.Lock()
+        self._queue_waits: List[float] = []
+        self.in_flight = 0
+        self.waiting = 0
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.rejected = 0
+        self.errors: Dict[str, int] = {}
+
+    # --- Admission ---
+    def _admit(self, tokens: int) -> None:
+        """Blocks until the buckets allow the call and a slot is free; raises LLMBusyError past the bounds."""
+        start = time.perf_counter()
+        with self._lock:
+            if self.max_queue and self.waiting >= self.max_queue:
+                self.rejected += 1
+                raise LLMBusyError(f"{self.waiting} chat calls already waiting")
+            self.waiting += 1
+        try:
+            wait = max(self.requests.reserve(1), self.tokens.reserve(tokens))
+            if self.max_wait_s and wait > self.max_wait_s:
+                self._refuse(tokens, f"rate limits need a {wait:.1f}s wait")
+            if wait:
+                time.sleep(wait)
+            if self.max_wait_s:
+                if not self._slots.acquire(timeout=max(0.0, self.max_wait_s - (time.perf_counter() - start))):
+                    self._refuse(tokens, f"no free slot within {self.max_wait_s:g}s")
+            else:
+                self._slots.acquire()
+        finally:
+            with self._lock:
+                self.waiting -= 1
+        with self._lock:
+            self.in_flight += 1
+            self.calls += 1
+            self._queue_waits.append(time.perf_counter() - start)
+            del self._queue_waits[:-self.max_samples]  # Recent samples only
+
+    def _refuse(self, tokens: int, reason: str) -> None:
+        """Gives back the bucket reservations of a call that will not be made, and raises LLMBusyError."""
+        self.requests.refund(1)
+        self.tokens.refund(tokens)
+        with self._lock:
+            self.rejected += 1
+        raise LLMBusyError(reason)
+
+    def _release(self) -> None:
+        with self._lock:
+            self.in_flight -= 1
+        self._slots.release()
+
+    def _retry_delay(self, error: Exception, attempt: int) -> Optional[float]:
+        """Seconds to back off before retrying, or None if the error is final."""
+        kind = _error_kind(error)
+        with self._lock:
+            self.errors[kind or "other"] = self.errors.get(kind or "other", 0) + 1
+            if kind is None or attempt >= self.max_retries:
+                self.failures += 1
+                return None
+            self.retries += 1
+        ceiling = min(self.backoff_max_s, self.backoff_base_s * 2 ** attempt)
+        return max(_retry_after(error), random.uniform(0, ceiling))  # Full jitter spreads out a burst of retries
+
+    # --- Calls ---
+    def call(self, fn: Callable[[], Any], tokens: int) -> Any:
+        """Runs `fn` under admission control, retrying transient API errors."""
+        attempt = 0
+        while True:
+            self._admit(tokens)
+            try:
+                return fn()
+            except Exception as e:
+                kind, delay = _error_kind(e), self._retry_delay(e, attempt)
+                if delay is None:
+                    raise
+            finally:
+                self._release()
+            print(f"⚠️ LLM call failed ({kind}); retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+
+    def stream(self, open_stream: Callable[[], Iterator], tokens: int) -> Iterator:
+        """Yields from `open_stream()` under admission control; retries only before the first chunk."""
+        attempt = 0
+        while True:
+            self._admit(tokens)
+            started = False
+            try:
+                for chunk in open_stream():
+                    started = True
+                    yield chunk
+                return
+            except Exception as e:
+                # Once text has been yielded the error is final, whatever its kind
+                kind, delay = _error_kind(e), self._retry_delay(e, self.max_retries if started else attempt)
+                if delay is None:
+                    raise
+            finally:
+                self._release()
+            print(f"⚠️ LLM stream failed ({kind}); retry {attempt + 1}/{self.max_retries} in {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            waits = sorted(self._queue_waits)
+            return {
+                "max_concurrency": self.max_concurrency,
+                "max_queue": self.max_queue,
+                "max_wait_s": self.max_wait_s,
+                "rpm": self.requests.per_minute,
+                "tpm": self.tokens.per_minute,
+                "in_flight": self.in_flight,
+                "waiting": self.waiting,
+                "calls": self.calls,
+                "retries": self.retries,
+                "failures": self.failures,
+                "rejected": self.rejected,
+                "errors": dict(self.errors),
+                "queue_wait_p50_s": waits[len(waits) // 2] if waits else 0.0,
+                "queue_wait_p95_s": waits[int(len(waits) * 0.95)] if waits else 0.0,
+                "queue_wait_max_s": waits[-1] if waits else 0.0,
+            }
+
+
+llm_gateway = LLMGateway()
+
+
+class GatewayChatModel(BaseChatModel):
+    """Chat model wrapper that sends every call of `inner` through the shared gateway."""
+
+    inner: BaseChatModel
+    gateway: Any = None  # Defaults to the process-wide llm_gateway
+
+    @property
+    def _llm_type(self) -> str:
+        return f"gateway-{self.inner._llm_type}"
+
+    @property
+    def _identifying_params(self) -> Dict[str, Any]:
+        return self.inner._identifying_params
+
+    def _gateway(self) -> LLMGateway:
+        return self.gateway or llm_gateway
+
+    def _token_estimate(self, messages: List[BaseMessage]) -> int:
+        prompt = sum(estimate_tokens(str(message.content)) for message in messages)
+        return prompt + (getattr(self.inner, "max_tokens", None) or 0)
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager=None, **kwargs: Any) -> ChatResult:
+        gateway = self._gateway()
+        reserved = self._token_estimate(messages)
+        result = gateway.call(
+            lambda: self.inner._generate(messages, stop=stop, run_manager=run_manager, **kwargs), reserved
+        )
+        used = ((result.llm_output or {}).get("token_usage") or {}).get("total_tokens")
+        if used:
+            gateway.tokens.refund(reserved - used)
+        return result
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                run_manager=None, **kwargs: Any) -> Iterator[ChatGenerationChunk]:
+        # Streams report no usage, so the whole reservation stays charged
+        yield from self._gateway().stream(
+            lambda: self.inner._stream(messages, stop=stop, run_manager=run_manager, **kwargs),
+            self._token_estimate(messages),
+        )
+
+
+def gated(llm: BaseChatModel) -> BaseChatModel:
+    """Returns `llm` routed through the shared gateway (models from model_registry already are)."""
+    return llm if isinstance(llm, GatewayChatModel) else GatewayChatModel(inner=llm)
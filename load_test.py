@@ -0,0 +1,333 @@
+"""
+Load Test - Simulated students against the quiz API
+
+Each simulated student logs in and then repeats generate-question -> submit-answer rounds until
+the run ends, submitting the expected answer with probability --correct-rate and an unrelated
+one otherwise. The report gives:
+- throughput: completed rounds and HTTP requests per second
+- latency p50/p95/p99 per endpoint, plus time to the first event with --stream (SSE endpoints)
+- error rate per endpoint, broken down by HTTP status (0 = connection error or timeout)
+
+--serve starts `uvicorn quiz_api:app` with CHAT_BACKEND=fake and the given FAKE_LLM_* settings
+(see fake_chat_model.py), so a laptop run needs no OpenAI key or budget; the vector store must
+exist or be buildable locally. Simulated students log in as `load-<ts>-<i>`, so --serve also sets
+STUDENT_DB_PATH to a throwaway SQLite file that is deleted after the run; a server started by hand for
+--url should be given its own STUDENT_DB_PATH too, or the load-test students land in student.db.
+Without --serve, --url points at a server that is already running.
+Raise --students across runs, comparing with --baseline, to find where latency starts to climb.
+
+Usage:
+    python load_test.py --serve [--students 20] [--duration 60] [--stream] [--latency-ms 600]
+                        [--error-rate 0.02] [--output load.json] [--baseline previous.json]
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+BASE_DIR = Path(__file__).resolve().parent
+WRONG_ANSWER = "I am honestly not sure about this one, sorry"  # Long enough to be graded, shares no content words
+
+
+class LoadStats:
+    """Thread-safe latency samples (milliseconds) and error counts per endpoint."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples: Dict[str, List[float]] = {}
+        self.errors: Dict[str, Dict[str, int]] = {}
+        self.requests = 0
+        self.rounds = 0
+
+    def record(self, endpoint: str, seconds: float, status: int) -> None:
+        with self._lock:
+            self.requests += 1
+            self.samples.setdefault(endpoint, []).append(seconds * 1000)
+            if status != 200:
+                counts = self.errors.setdefault(endpoint, {})
+                counts[str(status)] = counts.get(str(status), 0) + 1
+
+    def record_first_event(self, endpoint: str, seconds: float) -> None:
+        with self._lock:
+            self.samples.setdefault(f"{endpoint} (first event)", []).append(seconds * 1000)
+
+    def record_round(self) -> None:
+        with self._lock:
+            self.rounds += 1
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            summary = {}
+            for endpoint, values in self.samples.items():
+                values = sorted(values)
+                errors = sum(self.errors.get(endpoint, {}).values())
+                summary[endpoint] = {
+                    "n": len(values),
+                    "p50_ms": _percentile(values, 50),
+                    "p95_ms": _percentile(values, 95),
+                    "p99_ms": _percentile(values, 99),
+                    "max_ms": values[-1],
+                    "error_rate": errors / len(values),
+                }
+            return summary
+
+
+def _percentile(sorted_values: List[float], p: float) -> float:
+    """Nearest-rank percentile of an ascending list."""
+    index = max(0, min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def _post(url: str, payload: dict, timeout: float) -> Tuple[int, Optional[dict]]:
+    request = urllib.request.Request(url, data=json.dumps(payload).encode("utf-8"),
+                                     headers={"Content-Type": "application/json"})
+    return _send(request, timeout)
+
+
+def _get(url: str, timeout: float) -> Tuple[int, Optional[dict]]:
+    return _send(urllib.request.Request(url), timeout)
+
+
+def _send(request, timeout: float) -> Tuple[int, Optional[dict]]:
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            return response.status, json.loads(response.read().decode("utf-8"))
+    except urllib.error.HTTPError as e:
+        return e.code, None
+    except (urllib.error.URLError, OSError, ValueError):
+        return 0, None
+
+
+def _post_stream(url: str, payload: dict, timeout: float) -> Tuple[int, List[dict], Optional[float]]:
+    """POSTs to an SSE endpoint; returns (status, events, seconds until the first event)."""
+    request = urllib.request.Request(url, data=json.dumps(payload).encode("utf-8"),
+                                     headers={"Content-Type": "application/json", "Accept": "text/event-stream"})
+    start = time.perf_counter()
+    events, first_event_s = [], None
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            for raw in response:
+                line = raw.decode("utf-8").strip()
+                if line.startswith("data:"):
+                    if first_event_s is None:
+                        first_event_s = time.perf_counter() - start
+                    events.append(json.loads(line[len("data:"):]))
+            return response.status, events, first_event_s
+    except urllib.error.HTTPError as e:
+        return e.code, events, first_event_s
+    except (urllib.error.URLError, OSError, ValueError):
+        return 0, events, first_event_s
+
+
+class SimulatedStudent(threading.Thread):
+    """One student: login, then generate/submit rounds until `deadline`."""
+
+    def __init__(self, student_id: str, url: str, chapters: List[str], stats: LoadStats, deadline: float,
+                 correct_rate: float, stream: bool, think_s: float, timeout: float, seed: int):
+        super().__init__(name=student_id, daemon=True)
+        self.student_id = student_id
+        self.url = url.rstrip("/")
+        self.chapters = chapters
+        self.stats = stats
+        self.deadline = deadline
+        self.correct_rate = correct_rate
+        self.stream = stream
+        self.think_s = think_s
+        self.timeout = timeout
+        self.rng = random.Random(seed)
+
+    def _call(self, endpoint: str, payload: dict) -> Optional[dict]:
+        """Calls an endpoint and records it; returns the JSON body (or final SSE event), or None on error."""
+        start = time.perf_counter()
+        if not self.stream or endpoint == "/login":
+            status, body = _post(self.url + endpoint, payload, self.timeout)
+            self.stats.record(endpoint, time.perf_counter() - start, status)
+            return body if status == 200 else None
+        status, events, first_event_s = _post_stream(self.url + endpoint + "/stream", payload, self.timeout)
+        final = events[-1] if events else None
+        if status == 200 and (not final or final.get("event") == "error"):
+            status = 0  # The stream broke off or reported an error
+        self.stats.record(endpoint + "/stream", time.perf_counter() - start, status)
+        if first_event_s is not None:
+            self.stats.record_first_event(endpoint + "/stream", first_event_s)
+        return final if status == 200 else None
+
+    def run(self) -> None:
+        if self._call("/login", {"student_id": self.student_id, "name": self.student_id}) is None:
+            return
+        while time.perf_counter() < self.deadline:
+            question = self._call("/generate-question", {
+                "student_id": self.student_id,
+                "chapter_title": self.rng.choice(self.chapters),
+            })
+            if question is None or time.perf_counter() >= self.deadline:
+                time.sleep(self.think_s)
+                continue
+            time.sleep(self.think_s)
+            correct = self.rng.random() < self.correct_rate
+            result = self._call("/submit-answer", {
+                "student_id": self.student_id,
+                "question": question["question"],
+                "expected_answer": question["expected_answer"],
+                "user_answer": question["expected_answer"] if correct else WRONG_ANSWER,
+            })
+            if result is not None:
+                self.stats.record_round()
+            time.sleep(self.think_s)
+
+
+def start_server(port: int, fake_env: Dict[str, str], startup_timeout: float,
+                 student_db: str) -> subprocess.Popen:
+    """Starts quiz_api under uvicorn with the fake chat model and student_db as its student database,
+    and waits until it answers."""
+    env = dict(os.environ, CHAT_BACKEND="fake", STUDENT_DB_PATH=student_db, **fake_env)
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "quiz_api:app", "--host", "127.0.0.1", "--port", str(port)],
+        cwd=BASE_DIR, env=env,
+    )
+    deadline = time.perf_counter() + startup_timeout
+    while time.perf_counter() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"quiz_api exited with code {server.returncode} during startup")
+        if _get(f"http://127.0.0.1:{port}/chapters", timeout=2)[0] == 200:
+            return server
+        time.sleep(0.5)
+    server.terminate()
+    raise RuntimeError(f"quiz_api did not come up within {startup_timeout:.0f}s")
+
+
+def run_load_test(url: str, students: int = 10, duration: float = 60.0, correct_rate: float = 0.5,
+                  stream: bool = False, think_ms: float = 0.0, timeout: float = 120.0, seed: int = 0) -> dict:
+    status, chapters = _get(url.rstrip("/") + "/chapters", timeout=timeout)
+    if status != 200 or not chapters:
+        raise RuntimeError(f"Could not list chapters from {url} (status {status})")
+    titles = [chapter["title"] for chapter in chapters]
+
+    stats = LoadStats()
+    run_id = int(time.time())
+    start = time.perf_counter()
+    threads = [
+        SimulatedStudent(f"load-{run_id}-{i}", url, titles, stats, start + duration, correct_rate, stream,
+                         think_ms / 1000, timeout, seed + i)
+        for i in range(students)
+    ]
+    print(f"Running {students} simulated students against {url} for {duration:.0f}s...")
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start  # Includes requests still in flight at the deadline
+
+    server_stats = {}
+    for endpoint in ("/question-bank", "/grading-cache", "/local-grader", "/hint-cache", "/stream-latency",
+                     "/llm-gateway", "/context-packing"):
+        status, body = _get(url.rstrip("/") + endpoint, timeout=10)
+        if status == 200:
+            server_stats[endpoint.lstrip("/")] = body
+    return {
+        "config": {"url": url, "students": students, "duration_s": duration, "correct_rate": correct_rate,
+                   "stream": stream, "think_ms": think_ms},
+        "elapsed_s": elapsed,
+        "throughput": {
+            "rounds": stats.rounds,
+            "requests": stats.requests,
+            "rounds_per_s": stats.rounds / elapsed,
+            "requests_per_s": stats.requests / elapsed,
+        },
+        "latency": stats.summary(),
+        "errors": stats.errors,
+        "server": server_stats,
+    }
+
+
+def print_report(report: dict, baseline: dict = None) -> None:
+    def delta(endpoint: str, key: str) -> str:
+        try:
+            return f" ({report['latency'][endpoint][key] - baseline['latency'][endpoint][key]:+.0f})"
+        except (KeyError, TypeError):
+            return ""
+
+    throughput = report["throughput"]
+    line = (f"\nThroughput: {throughput['rounds_per_s']:.2f} rounds/s, {throughput['requests_per_s']:.2f} requests/s "
+            f"({throughput['rounds']} rounds, {throughput['requests']} requests in {report['elapsed_s']:.1f}s)")
+    if baseline:
+        line += f" ({throughput['rounds_per_s'] - baseline['throughput']['rounds_per_s']:+.2f} rounds/s vs baseline)"
+    print(line)
+    print(f"\n{'endpoint':<40} {'n':>6} {'p50 ms':>14} {'p95 ms':>14} {'p99 ms':>14} {'errors':>8}")
+    for endpoint, stats in report["latency"].items():
+        cells = [f"{stats[key]:.0f}{delta(endpoint, key)}" for key in ("p50_ms", "p95_ms", "p99_ms")]
+        print(f"{endpoint:<40} {stats['n']:>6} {cells[0]:>14} {cells[1]:>14} {cells[2]:>14} {stats['error_rate']:>7.1%}")
+    for endpoint, counts in report["errors"].items():
+        breakdown = ", ".join(f"{status}: {count}" for status, count in sorted(counts.items()))
+        print(f"❌ {endpoint}: {breakdown}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate concurrent students against the quiz API.")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="Base URL of a running quiz API")
+    parser.add_argument("--serve", action="store_true", help="Start quiz_api with the fake chat model for the run")
+    parser.add_argument("--port", type=int, default=8765, help="Port for --serve")
+    parser.add_argument("--students", type=int, default=10, help="Concurrent simulated students")
+    parser.add_argument("--duration", type=float, default=60.0, help="Seconds to keep starting new rounds")
+    parser.add_argument("--correct-rate", type=float, default=0.5, help="Share of answers that match the expected one")
+    parser.add_argument("--stream", action="store_true", help="Use the SSE endpoints and record time to first event")
+    parser.add_argument("--think-ms", type=float, default=0.0, help="Pause between a student's requests")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Per-request timeout in seconds")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for chapter and answer choices")
+    parser.add_argument("--latency-ms", type=float, help="--serve: median fake LLM time to first token")
+    parser.add_argument("--latency-sigma", type=float, help="--serve: log-normal shape of the fake LLM latency")
+    parser.add_argument("--token-ms", type=float, help="--serve: fake LLM time per output token")
+    parser.add_argument("--error-rate", type=float, help="--serve: share of fake LLM calls that fail (429/5xx)")
+    parser.add_argument("--answer-tokens", type=int, help="--serve: length of fake answers and feedback")
+    parser.add_argument("--startup-timeout", type=float, default=600.0, help="--serve: seconds to wait for the API")
+    parser.add_argument("--output", help="Optional path to write the report as JSON")
+    parser.add_argument("--baseline", help="Earlier report JSON to print deltas against")
+    args = parser.parse_args()
+
+    server = None
+    student_dir = None
+    url = args.url
+    if args.serve:
+        fake_env = {name: str(value) for name, value in (
+            ("FAKE_LLM_LATENCY_MS", args.latency_ms),
+            ("FAKE_LLM_LATENCY_SIGMA", args.latency_sigma),
+            ("FAKE_LLM_TOKEN_MS", args.token_ms),
+            ("FAKE_LLM_ERROR_RATE", args.error_rate),
+            ("FAKE_LLM_ANSWER_TOKENS", args.answer_tokens),
+        ) if value is not None}
+        student_dir = tempfile.TemporaryDirectory(prefix="load-test-")
+        try:
+            server = start_server(args.port, fake_env, args.startup_timeout,
+                                  os.path.join(student_dir.name, "student.db"))
+        except Exception:
+            student_dir.cleanup()
+            raise
+        url = f"http://127.0.0.1:{args.port}"
+    try:
+        report = run_load_test(url, students=args.students, duration=args.duration, correct_rate=args.correct_rate,
+                               stream=args.stream, think_ms=args.think_ms, timeout=args.timeout, seed=args.seed)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait(timeout=30)
+        if student_dir is not None:
+            student_dir.cleanup()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
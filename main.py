@@ -29,29 +29,35 @@ import sys
 import re
 import json
 import random
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
 from pathlib import Path
-from typing import List, Dict, Tuple, Optional, Set, Any, Union
+from typing import List, Dict, Tuple, Optional, Set, Any, Union, TYPE_CHECKING
 
 # Third-party imports
-import fitz  # PyMuPDF - For PDF processing: https://pypi.org/project/PyMuPDF/
+# Importing this module must stay cheap: quiz_api and streamlit_frontend import it on every worker
+# start or reload. Heavy packages (PyMuPDF, FAISS, torch-backed models, langchain_openai, fuzzywuzzy,
+# numpy) are imported inside the functions that use them; run startup_report.py to check the cost.
 from dotenv import load_dotenv  # For loading environment variables
-from fuzzywuzzy import fuzz  # For string matching: https://github.com/seatgeek/fuzzywuzzy
-
-# LangChain imports
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.docstore.document import Document
-from langchain_community.vectorstores import FAISS  # FAISS for vector search: https://github.com/facebookresearch/faiss
-from langchain_community.embeddings import HuggingFaceBgeEmbeddings  # BERT-based embeddings
-from langchain.chains import RetrievalQA
-from langchain_openai import ChatOpenAI  # OpenAI's chat models
-from langchain.prompts import PromptTemplate
-from langchain.retrievers import ContextualCompressionRetriever
-from langchain_community.cross_encoders import HuggingFaceCrossEncoder
-from langchain.retrievers.document_compressors import CrossEncoderReranker
+
+# LangChain imports (core interfaces only)
+from langchain_core.documents import Document
 from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_community.cross_encoders.base import BaseCrossEncoder
+
+# Every chat call goes through the shared gateway (concurrency limit, RPM/TPM pacing, retries)
+from llm_gateway import LLMBusyError, gated
+from context_packer import pack_context  # Token-budgeted, overlap-free prompt context
 
-# Local imports
-from ZPD_calculator import ZPDCalculator  # Custom module for ZPD calculations
+if TYPE_CHECKING:  # numpy-backed; imported where the index is built or loaded
+    from lexical_index import BM25Index
 
 # Load environment variables
 load_dotenv()
@@ -62,10 +68,57 @@ BASE_DIR = Path(__file__).resolve().parent
 PDF_PATH = BASE_DIR / "data" / "raw" / "history.pdf"  # Path to the source PDF
 VECTORSTORE_PATH = BASE_DIR / "data" / "faiss_index_optimized"  # Where FAISS index will be stored
 CHAPTER_MAP_PATH = BASE_DIR / "data" / "raw" / "chapter_map.json"  # Chapter metadata
+MANIFEST_FILENAME = "manifest.json"  # Per-page/per-chunk content hashes, stored inside VECTORSTORE_PATH
+
+# --- Model Constants ---
+EMBEDDING_MODEL_NAME = "BAAI/bge-base-en-v1.5"
+RERANKER_MODEL_NAME = "BAAI/bge-reranker-base"
+BGE_QUERY_INSTRUCTION = "Represent this sentence for searching relevant passages:"
+CHAT_MODEL_NAME = os.getenv("CHAT_MODEL_NAME", "gpt-4.1-nano")  # Default OpenAI chat model
+CHAT_BACKEND = os.getenv("CHAT_BACKEND", "openai")  # "fake" serves fake_chat_model.FakeChatModel, e.g. for load tests
+RETRIEVER_CACHE_SIZE = int(os.getenv("RETRIEVER_CACHE_SIZE", "8"))  # Max per-chapter retriever views kept alive
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "256"))  # Max cached query vectors
+RERANK_CACHE_PATH = BASE_DIR / "data" / "rerank_cache.db"  # Persistent cross-encoder scores, next to the index
+RERANK_CACHE_SIZE = int(os.getenv("RERANK_CACHE_SIZE", "4096"))  # Max in-memory (query, chunk) scores
+RERANK_CACHE_MAX_ROWS = int(os.getenv("RERANK_CACHE_MAX_ROWS", "100000"))  # Max scores kept on disk
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "32"))  # Chunks per encode batch during index builds
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", "1"))  # Encode processes during index builds (>1 enables the pool)
+INDEX_TYPES = ("flat", "sq8", "ivf_flat", "ivf_pq")
+INDEX_TYPE = os.getenv("INDEX_TYPE", "flat")  # FAISS index type written by create_and_save_vectorstore
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "torch")  # "onnx" serves both models via ONNX Runtime int8
+ADAPTIVE_RERANK = os.getenv("ADAPTIVE_RERANK", "0") == "1"  # Skip the cross-encoder when dense scores settle the top 4
+RERANK_SKIP_MARGIN = float(os.getenv("RERANK_SKIP_MARGIN", "0.05"))  # Cosine gap at the cut that skips reranking
+RERANK_BOUNDARY_BAND = float(os.getenv("RERANK_BOUNDARY_BAND", "0.02"))  # Cosine band around the cut that gets reranked
+HYBRID_RETRIEVAL = os.getenv("HYBRID_RETRIEVAL", "0") == "1"  # Fuse BM25 and dense candidates before reranking
+HYBRID_FUSED_K = int(os.getenv("HYBRID_FUSED_K", "6"))  # Fused candidates sent to the cross-encoder
+RETRIEVAL_WORKERS = max(1, int(os.getenv("RETRIEVAL_WORKERS", "2")))  # Retrievals (embed + search + rerank) run at once
+RETRIEVAL_MAX_PENDING = int(os.getenv("RETRIEVAL_MAX_PENDING", "32"))  # Queued retrievals before callers get RetrievalBusyError
+INTRA_OP_THREADS = int(os.getenv("INTRA_OP_THREADS", "0"))  # torch/ONNX threads per retrieval; 0 = cores // RETRIEVAL_WORKERS
+QUESTION_CANDIDATES = int(os.getenv("QUESTION_CANDIDATES", "4"))  # Question/answer pairs per generation call; 1 = retry loop only
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "900"))  # Max context tokens in generation prompts; 0 = no limit
+SPARE_QUESTION_OWNERS = int(os.getenv("SPARE_QUESTION_OWNERS", "1024"))  # Students whose unused candidates are kept
+STRUCTURED_GRADING = os.getenv("STRUCTURED_GRADING", "1") == "1"  # Grade with one JSON call instead of up to three
+LAZY_HINTS = os.getenv("LAZY_HINTS", "1") == "1"  # Leave hints out of grading; fetch them with get_hint on demand
+HINT_PREFETCH = os.getenv("HINT_PREFETCH", "0") == "1"  # With lazy hints, generate them in the background after grading
+HINT_PREFETCH_WORKERS = max(1, int(os.getenv("HINT_PREFETCH_WORKERS", "2")))  # Background hint generations at once
+HINT_CACHE_SIZE = int(os.getenv("HINT_CACHE_SIZE", "2048"))  # Hints kept per (question, expected answer, ZPD band)
+GRADING_CACHE = os.getenv("GRADING_CACHE", "1") == "1"  # Reuse verdicts of near-identical answers to the same question
+GRADING_CACHE_PATH = BASE_DIR / "data" / "grading_cache.db"  # Persistent verdicts with answer embeddings
+GRADING_CACHE_THRESHOLD = float(os.getenv("GRADING_CACHE_THRESHOLD", "0.97"))  # Answer cosine similarity that reuses a verdict
+GRADING_CACHE_SIZE = int(os.getenv("GRADING_CACHE_SIZE", "10000"))  # Max graded answers held in memory (~3 KB each)
+GRADING_CACHE_MAX_ROWS = int(os.getenv("GRADING_CACHE_MAX_ROWS", "200000"))  # Max graded answers kept on disk
+GRADING_CACHE_MIN_WORDS = int(os.getenv("GRADING_CACHE_MIN_WORDS", "4"))  # Shorter answers only reuse exact repeats
+LOCAL_GRADING = os.getenv("LOCAL_GRADING", "0") == "1"  # Grade clear-cut answers locally; calibrate with grader_calibration.py first
+LOCAL_GRADING_RELEVANCE = float(os.getenv("LOCAL_GRADING_RELEVANCE", "0.55"))  # Answer/expected cosine below which an answer is off-topic
+LOCAL_GRADING_CORRECT = float(os.getenv("LOCAL_GRADING_CORRECT", "0.9"))  # Cross-encoder score at or above which an answer is correct
+LOCAL_GRADING_INCORRECT = float(os.getenv("LOCAL_GRADING_INCORRECT", "0.05"))  # Cross-encoder score at or below which it is incorrect
 
 # --- Utility Functions ---
 def check_environment():
     """Checks for the OpenAI API key in the environment variables."""
+    if CHAT_BACKEND == "fake":
+        print("Using the fake chat model (CHAT_BACKEND=fake); no OpenAI API key needed.")
+        return
     if not os.getenv("OPENAI_API_KEY"):
         print("Error: OPENAI_API_KEY not found in environment variables.")
         print("Please create a '.env' file and add your key: OPENENAI_API_KEY='your_key_here'")
@@ -88,11 +141,47 @@ def load_chapter_map(map_path: Path) -> list[dict]:
         print(f"An unexpected error occurred while loading chapter map: {e}")
         sys.exit(1)
 
-def extract_text_with_metadata(pdf_path: Path, chapter_map: list[dict]) -> list[Document]:
+def _extract_page_range(pdf_path: str, start_page: int, end_page: int) -> list[tuple[int, str]]:
+    """
+    Extracts whitespace-normalized text for pages [start_page, end_page] (1-based, inclusive).
+
+    Runs in a worker process, so it opens its own PyMuPDF document.
+    """
+    import fitz  # PyMuPDF - For PDF processing: https://pypi.org/project/PyMuPDF/
+
+    pages = []
+    with fitz.open(pdf_path) as pdf_document:
+        for page_num in range(start_page, end_page + 1):
+            text = re.sub(r'\s+', ' ', pdf_document[page_num - 1].get_text()).strip()
+            pages.append((page_num, text))
+    return pages
+
+def _page_ranges(page_count: int, parts: int) -> list[tuple[int, int]]:
+    """Splits 1..page_count into at most `parts` contiguous, roughly equal ranges."""
+    parts = max(1, min(parts, page_count))
+    size, extra = divmod(page_count, parts)
+    ranges, start = [], 1
+    for i in range(parts):
+        end = start + size - 1 + (1 if i < extra else 0)
+        ranges.append((start, end))
+        start = end + 1
+    return ranges
+
+def extract_text_with_metadata(pdf_path: Path, chapter_map: list[dict], workers: Optional[int] = None) -> list[Document]:
     """
     Extracts text and page numbers from a PDF using PyMuPDF (fitz) and enriches metadata with chapter info.
     Each page's text is stored as a LangChain Document with metadata.
+    
+    Pages are split into contiguous ranges that are extracted in a process pool (one PyMuPDF
+    document per worker) and merged back in page order.
+    
+    Args:
+        pdf_path: Path to the source PDF
+        chapter_map: Chapter definitions with start/end pages
+        workers: Number of worker processes; defaults to the number of CPUs, 1 disables the pool
     """
+    import fitz  # PyMuPDF - For PDF processing: https://pypi.org/project/PyMuPDF/
+
     if not pdf_path.exists():
         raise FileNotFoundError(f"Error: PDF file not found at {pdf_path}")
 
@@ -100,34 +189,49 @@ def extract_text_with_metadata(pdf_path: Path, chapter_map: list[dict]) -> list[
     docs = []
     try:
         with fitz.open(pdf_path) as pdf_document:
-            print(f"Found {len(pdf_document)} pages in the PDF.")
-            for page_num, page in enumerate(pdf_document, start=1):
-                text = re.sub(r'\s+', ' ', page.get_text()).strip()
-                current_chapter_id = "unknown"
-                current_chapter_title = "Unknown Chapter"
-                for chapter_info in chapter_map:
-                    if chapter_info["start_page"] <= page_num <= chapter_info["end_page"]:
-                        current_chapter_id = chapter_info["id"]
-                        current_chapter_title = chapter_info["title"]
-                        break
-                if text:
-                    docs.append(Document(
-                        page_content=text,
-                        metadata={
-                            "source": str(pdf_path.name),
-                            "page": page_num,
-                            "chapter_id": current_chapter_id,
-                            "chapter_title": current_chapter_title
-                        }
-                    ))
-            print(f"Successfully extracted text from {len(docs)} pages.")
-            return docs
+            page_count = len(pdf_document)
+        print(f"Found {page_count} pages in the PDF.")
+
+        workers = workers or os.cpu_count() or 1
+        ranges = _page_ranges(page_count, workers)
+        if len(ranges) <= 1:
+            page_texts = _extract_page_range(str(pdf_path), 1, page_count) if page_count else []
+        else:
+            print(f"Extracting text with {len(ranges)} worker processes...")
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=len(ranges)) as pool:
+                results = pool.map(_extract_page_range, [str(pdf_path)] * len(ranges),
+                                   [start for start, _ in ranges], [end for _, end in ranges])
+                page_texts = [page for result in results for page in result]  # map() preserves range order
+
+        # Resolve each page's chapter once instead of scanning the chapter map per page
+        page_chapters = {}
+        for chapter_info in reversed(chapter_map):  # Earlier chapters win on overlapping ranges
+            for page_num in range(chapter_info["start_page"], chapter_info["end_page"] + 1):
+                page_chapters[page_num] = (chapter_info["id"], chapter_info["title"])
+
+        for page_num, text in page_texts:
+            current_chapter_id, current_chapter_title = page_chapters.get(page_num, ("unknown", "Unknown Chapter"))
+            if text:
+                docs.append(Document(
+                    page_content=text,
+                    metadata={
+                        "source": str(pdf_path.name),
+                        "page": page_num,
+                        "chapter_id": current_chapter_id,
+                        "chapter_title": current_chapter_title
+                    }
+                ))
+        print(f"Successfully extracted text from {len(docs)} pages.")
+        return docs
     except Exception as e:
         print(f"Error processing PDF with PyMuPDF: {e}")
         sys.exit(1)
 
 def split_documents(docs: list[Document], chunk_size: int = 1000, chunk_overlap: int = 200) -> list[Document]:
     """Splits a list of Documents into smaller chunks while preserving metadata."""
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
     print(f"Splitting {len(docs)} documents into chunks...")
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=chunk_size, chunk_overlap=chunk_overlap, separators=["\n\n", "\n", ". ", " ", ""], length_function=len
@@ -136,13 +240,793 @@ def split_documents(docs: list[Document], chunk_size: int = 1000, chunk_overlap:
     print(f"Split documents into {len(chunks)} chunks.")
     return chunks
 
-def create_and_save_vectorstore(chunks: list[Document]):
+# --- Query Embedding Cache ---
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper with a bounded LRU cache and single-flight coalescing for queries.
+
+    Retrieval queries come from a tiny vocabulary (chapter title + focus aspect), so the same
+    text is encoded over and over. Query vectors are cached by (model name, normalized text);
+    concurrent lookups for the same uncached text wait on one encode instead of each running it.
+    Document embedding (index builds) passes straight through to the wrapped model.
+    """
+
+    def __init__(self, embeddings_model, max_size: int = QUERY_EMBEDDING_CACHE_SIZE):
+        self.inner = embeddings_model
+        self.model_name = getattr(embeddings_model, "model_name", type(embeddings_model).__name__)
+        self.max_size = max(1, max_size)
+        self._cache: "OrderedDict[Tuple[str, str], List[float]]" = OrderedDict()
+        self._in_flight: Dict[Tuple[str, str], Future] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def __getattr__(self, name):
+        # Only called for attributes not found on the wrapper, e.g. `query_instruction` or `client`
+        if name == "inner":
+            raise AttributeError(name)
+        return getattr(self.inner, name)
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Collapses whitespace so trivially different spellings of a query share one entry."""
+        return re.sub(r'\s+', ' ', text).strip()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.inner.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        normalized = self.normalize(text)
+        key = (self.model_name, normalized)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return self._cache[key]
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                owner = False
+            else:
+                self.misses += 1
+                future = Future()
+                self._in_flight[key] = future
+                owner = True
+        if not owner:
+            return future.result()  # Re-raises the owner's exception, if any
+        try:
+            vector = self.inner.embed_query(normalized)
+        except Exception as e:
+            with self._lock:
+                del self._in_flight[key]
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._cache[key] = vector
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+            del self._in_flight[key]
+        future.set_result(vector)
+        return vector
+
+    def clear(self) -> None:
+        """Drops every cached vector; counters are kept."""
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters for the query cache."""
+        with self._lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                "model": self.model_name,
+                "size": len(self._cache),
+                "capacity": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "hit_rate": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+            }
+
+# --- Cross-Encoder Score Cache ---
+def _text_hash(text: str) -> str:
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def _index_fingerprint(index_dir: Path) -> str:
+    """Identifies one build of the FAISS index by the size and mtime of its files."""
+    parts = []
+    for name in ("index.faiss", "index.pkl", "columns.json"):
+        path = index_dir / name
+        if path.exists():
+            stat = path.stat()
+            parts.append(f"{name}:{stat.st_size}:{stat.st_mtime_ns}")
+    return "|".join(parts)
+
+class CachedCrossEncoder(BaseCrossEncoder):
+    """
+    Cross-encoder wrapper that remembers scores per (query hash, chunk hash, model).
+
+    Scores live in an in-memory LRU backed by a small SQLite table, so a warm restart reuses
+    everything scored before. The table is wiped automatically whenever the FAISS index
+    files change, i.e. after a rebuild.
+    """
+
+    def __init__(self, cross_encoder, model_name: str = RERANKER_MODEL_NAME,
+                 db_path: Path = RERANK_CACHE_PATH, index_dir: Path = VECTORSTORE_PATH,
+                 max_size: int = RERANK_CACHE_SIZE, max_rows: int = RERANK_CACHE_MAX_ROWS):
+        self.inner = cross_encoder
+        self.model_name = model_name
+        self.db_path = Path(db_path)
+        self.index_dir = Path(index_dir)
+        self.max_size = max(1, max_size)
+        self.max_rows = max_rows
+        self.prune_every = max(1, max_rows // 20)  # Disk rows may overshoot max_rows by this much between prunes
+        self._cache: "OrderedDict[Tuple[str, str], float]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._fingerprint = None
+        self._writes_since_prune = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._create_tables()
+
+    def __getattr__(self, name):
+        if name == "inner":
+            raise AttributeError(name)
+        return getattr(self.inner, name)
+
+    def _get_connection(self):
+        return sqlite3.connect(str(self.db_path))
+
+    def _create_tables(self):
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._get_connection() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS rerank_scores (
+                    model TEXT NOT NULL,
+                    query_hash TEXT NOT NULL,
+                    chunk_hash TEXT NOT NULL,
+                    score REAL NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (model, query_hash, chunk_hash)
+                )
+            ''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_rerank_scores_created ON rerank_scores(created_at)")
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS rerank_meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                )
+            ''')
+            conn.commit()
+
+    def _check_index(self) -> None:
+        """Clears memory and disk entries if the index was rebuilt since they were stored."""
+        fingerprint = _index_fingerprint(self.index_dir)
+        if fingerprint == self._fingerprint:
+            return
+        with self._get_connection() as conn:
+            row = conn.execute("SELECT value FROM rerank_meta WHERE key = 'index_fingerprint'").fetchone()
+            if not row or row[0] != fingerprint:
+                if row:
+                    print("Index rebuilt since rerank scores were cached; clearing rerank cache.")
+                conn.execute("DELETE FROM rerank_scores")
+                conn.execute("INSERT OR REPLACE INTO rerank_meta (key, value) VALUES ('index_fingerprint', ?)",
+                             (fingerprint,))
+                conn.commit()
+        self._cache.clear()
+        self._fingerprint = fingerprint
+
+    def _remember(self, key: Tuple[str, str], score: float) -> None:
+        self._cache[key] = score
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    def score(self, text_pairs: List[Tuple[str, str]]) -> List[float]:
+        keys = [(_text_hash(query), _text_hash(chunk)) for query, chunk in text_pairs]
+        scores: List[Optional[float]] = [None] * len(keys)
+        with self._lock:
+            self._check_index()
+            for i, key in enumerate(keys):
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    scores[i] = self._cache[key]
+                    self.hits += 1
+
+        # Fall back to the on-disk store for anything not held in memory
+        missing = [i for i, value in enumerate(scores) if value is None]
+        if missing:
+            with self._get_connection() as conn:
+                for i in missing:
+                    row = conn.execute(
+                        "SELECT score FROM rerank_scores WHERE model = ? AND query_hash = ? AND chunk_hash = ?",
+                        (self.model_name, *keys[i])
+                    ).fetchone()
+                    if row:
+                        scores[i] = row[0]
+            with self._lock:
+                for i in missing:
+                    if scores[i] is not None:
+                        self.disk_hits += 1
+                        self._remember(keys[i], scores[i])
+
+        # Only pairs never seen before reach the cross-encoder
+        to_score = [i for i, value in enumerate(scores) if value is None]
+        if to_score:
+            fresh = self.inner.score([text_pairs[i] for i in to_score])
+            rows = []
+            with self._lock:
+                for i, value in zip(to_score, fresh):
+                    scores[i] = float(value)
+                    self.misses += 1
+                    self._remember(keys[i], scores[i])
+                    rows.append((self.model_name, *keys[i], scores[i]))
+                self._writes_since_prune += len(rows)
+                prune = self._writes_since_prune >= self.prune_every
+                if prune:
+                    self._writes_since_prune = 0
+            with self._get_connection() as conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO rerank_scores (model, query_hash, chunk_hash, score) VALUES (?, ?, ?, ?)",
+                    rows
+                )
+                if prune:
+                    self._prune(conn)
+                conn.commit()
+        return scores
+
+    def _prune(self, conn) -> None:
+        """Deletes the oldest disk rows beyond max_rows (run every `prune_every` writes, not per miss)."""
+        excess = conn.execute("SELECT COUNT(*) FROM rerank_scores").fetchone()[0] - self.max_rows
+        if excess > 0:
+            conn.execute('''
+                DELETE FROM rerank_scores WHERE rowid IN (
+                    SELECT rowid FROM rerank_scores ORDER BY created_at LIMIT ?
+                )
+            ''', (excess,))
+
+    def stats(self) -> Dict[str, Any]:
+        """Memory/disk hit counters for the rerank score cache."""
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "model": self.model_name,
+                "size": len(self._cache),
+                "capacity": self.max_size,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
+
+# --- Ingestion Manifest ---
+def _assign_chunk_ids(chunks: list[Document]) -> list[str]:
+    """
+    Deterministic docstore IDs derived from each chunk's page and content.
+
+    Identical chunks on the same page get an occurrence suffix so IDs stay unique.
+    """
+    ids, seen = [], {}
+    for chunk in chunks:
+        base = _text_hash(f"{chunk.metadata.get('page')}:{chunk.page_content}")
+        seen[base] = seen.get(base, 0) + 1
+        ids.append(base if seen[base] == 1 else f"{base}-{seen[base]}")
+    return ids
+
+def _build_manifest(pages: list[Document], chunks: list[Document], chunk_ids: list[str]) -> dict:
+    """
+    Records a content hash per page and per chunk, so later rebuilds can embed only the diff,
+    and each page's chapter, so edits to the chapter map (moves and renames) can be applied.
+    """
+    return {
+        "version": 1,
+        "embedding_model": EMBEDDING_MODEL_NAME,
+        "pages": {
+            str(page.metadata["page"]): {
+                "hash": _text_hash(page.page_content),
+                "chapter_id": page.metadata.get("chapter_id", "unknown"),
+                "chapter_title": page.metadata.get("chapter_title", "Unknown Chapter"),
+            }
+            for page in pages
+        },
+        "chunks": {
+            chunk_id: {"page": chunk.metadata.get("page"), "hash": _text_hash(chunk.page_content)}
+            for chunk_id, chunk in zip(chunk_ids, chunks)
+        },
+    }
+
+def load_manifest(index_dir: Path = VECTORSTORE_PATH) -> Optional[dict]:
+    """Loads the ingestion manifest stored alongside the FAISS index, if there is one."""
+    manifest_path = index_dir / MANIFEST_FILENAME
+    if not manifest_path.exists():
+        return None
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (json.JSONDecodeError, OSError) as e:
+        print(f"⚠️ Could not read ingestion manifest ({e}); a full rebuild is required.")
+        return None
+
+def save_manifest(manifest: dict, index_dir: Path = VECTORSTORE_PATH) -> None:
+    index_dir.mkdir(parents=True, exist_ok=True)
+    with open(index_dir / MANIFEST_FILENAME, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+
+# --- FAISS Index Variants ---
+def choose_index_params(n_vectors: int, dim: int) -> Dict[str, int]:
+    """
+    Picks IVF/PQ parameters from the corpus size.
+
+    nlist follows the usual ~4*sqrt(N) rule but is capped so every list gets at least 39
+    training points; PQ uses 8-dimensional sub-vectors and drops to fewer bits per code when
+    the corpus is too small to train 256 centroids per sub-quantizer.
+    """
+    nlist = max(1, min(int(4 * n_vectors ** 0.5), n_vectors // 39))
+    pq_m = next(m for m in (96, 64, 48, 32, 16, 8, 4, 2, 1) if dim % m == 0 and m <= dim)
+    pq_nbits = 8 if n_vectors >= 256 * 39 else 6 if n_vectors >= 64 * 39 else 4
+    nprobe = min(nlist, max(1, nlist // 8, 8))
+    return {"nlist": nlist, "pq_m": pq_m, "pq_nbits": pq_nbits, "nprobe": nprobe}
+
+def reconstruct_vectors(index, positions: List[int] = None):
+    """Returns the stored vectors (approximate for quantized indexes) as a float32 array."""
+    import faiss
+    import numpy as np
+
+    try:
+        faiss.extract_index_ivf(index).make_direct_map()  # IVF indexes need a direct map to reconstruct
+    except RuntimeError:
+        pass  # Not an IVF index
+    if positions is None:
+        return index.reconstruct_n(0, index.ntotal).astype("float32")
+    if not positions:
+        return np.zeros((0, index.d), dtype="float32")
+    return np.vstack([index.reconstruct(int(i)) for i in positions]).astype("float32")
+
+def build_faiss_index(vectors, index_type: str = "flat", metric_type: int = None):
+    """
+    Builds (and trains, where needed) a FAISS index of the given type over `vectors`.
+
+    Supported types: "flat" (exact float32), "sq8" (scalar-quantized int8), "ivf_flat" and
+    "ivf_pq". Vectors are added in order, so position i still maps to the i-th chunk.
+    """
+    import faiss
+
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type '{index_type}'. Choose one of: {', '.join(INDEX_TYPES)}")
+    metric_type = faiss.METRIC_L2 if metric_type is None else metric_type
+    n_vectors, dim = vectors.shape
+    params = choose_index_params(n_vectors, dim)
+    factory = {
+        "flat": "Flat",
+        "sq8": "SQ8",
+        "ivf_flat": f"IVF{params['nlist']},Flat",
+        "ivf_pq": f"IVF{params['nlist']},PQ{params['pq_m']}x{params['pq_nbits']}",
+    }[index_type]
+    index = faiss.index_factory(dim, factory, metric_type)
+    if not index.is_trained:
+        print(f"Training {factory} index on {n_vectors} vectors...")
+        index.train(vectors)
+    index.add(vectors)
+    if index_type.startswith("ivf"):
+        faiss.extract_index_ivf(index).nprobe = params["nprobe"]
+    return index
+
+# --- Shared Model Registry ---
+def _estimate_model_nbytes(model) -> int:
+    """Rough parameter footprint of a HuggingFace/sentence-transformers model wrapper, in bytes."""
+    module = getattr(model, "client", model)  # LangChain wrappers keep the real model on `.client`
+    module = getattr(module, "model", module)  # CrossEncoder keeps its torch module on `.model`
+    try:
+        return sum(p.numel() * p.element_size() for p in module.parameters())
+    except Exception:
+        return 0
+
+def _estimate_vectorstore_nbytes(vectorstore) -> int:
+    """Rough footprint of a FAISS vector store: raw vectors plus stored chunk text."""
+    from vector_storage import ColumnarDocstore
+
+    try:
+        index_bytes = vectorstore.index.ntotal * vectorstore.index.d * 4
+    except Exception:
+        index_bytes = 0
+    try:
+        if isinstance(vectorstore.docstore, ColumnarDocstore):
+            text_bytes = vectorstore.docstore.nbytes  # Memory-mapped, shared through the page cache
+        else:
+            text_bytes = sum(len(doc.page_content) for doc in vectorstore.docstore._dict.values())
+    except Exception:
+        text_bytes = 0
+    return index_bytes + text_bytes
+
+class ChapterIndex:
+    """
+    Search-only view of the shared FAISS index restricted to one chapter's positions.
+
+    Searches go to the shared index with an `IDSelectorBatch` over the chapter's positions, so
+    no vectors are copied: a memory-mapped index stays mapped and SQ8/PQ codes stay compressed.
+    Results are positions in the shared index. IVF indexes probe every list for chapter searches,
+    since a chapter's chunks are spread over lists the query's nearest centroids may not cover;
+    the selector skips other chapters' codes before any distance is computed.
+    """
+
+    def __init__(self, index, positions: List[int]):
+        import faiss  # Installed with faiss-cpu; only needed once a chapter view is built
+        import numpy as np
+
+        self.index = index
+        self.d = index.d
+        self.ntotal = len(positions)
+        self.metric_type = index.metric_type
+        self._selector = faiss.IDSelectorBatch(np.asarray(positions, dtype="int64"))
+        try:
+            ivf = faiss.extract_index_ivf(index)
+            self._params = faiss.SearchParametersIVF(sel=self._selector, nprobe=ivf.nlist)
+        except RuntimeError:  # Not an IVF index
+            self._params = faiss.SearchParameters(sel=self._selector)
+
+    def search(self, x, k, **kwargs):
+        return self.index.search(x, k, params=self._params)
+
+def _build_chapter_vectorstore(vectorstore, positions: List[int]):
+    """
+    A FAISS store whose searches only return the chunks at `positions` of the shared store.
+
+    Searching it costs a selector check per vector plus distances for the chapter's own chunks,
+    and every hit belongs to the chapter, unlike the LangChain `filter=` path which over-fetches
+    from the whole corpus and post-filters in Python. Index, docstore and ID map are all shared.
+    """
+    from langchain_community.vectorstores import FAISS
+
+    return FAISS(
+        embedding_function=vectorstore.embedding_function,
+        index=ChapterIndex(vectorstore.index, positions),
+        docstore=vectorstore.docstore,
+        index_to_docstore_id=vectorstore.index_to_docstore_id,
+        distance_strategy=vectorstore.distance_strategy,
+        normalize_L2=vectorstore._normalize_L2,
+    )
+
+def build_cross_encoder():
+    """Constructs the BGE cross-encoder for the configured INFERENCE_BACKEND, without the score cache."""
+    if INFERENCE_BACKEND == "onnx":
+        from onnx_backend import OnnxCrossEncoder  # Optional dependency: onnxruntime
+        return OnnxCrossEncoder(RERANKER_MODEL_NAME, threads=intra_op_threads())
+    from langchain_community.cross_encoders import HuggingFaceCrossEncoder
+    return HuggingFaceCrossEncoder(
+        model_name=RERANKER_MODEL_NAME,  # Pre-trained re-ranking model
+        model_kwargs={"max_length": 512}  # Maximum sequence length for the model
+    )
+
+class ModelRegistry:
+    """
+    Process-wide owner of the heavy retrieval objects.
+
+    Exactly one BGE embedder, one BGE cross-encoder and one loaded FAISS vector store exist per
+    process. Per-chapter retrievers are lightweight views over these shared objects and are kept
+    in a size-bounded LRU, so asking for a chapter again is free and an evicted view costs nothing
+    but a few small wrapper objects to rebuild. Nothing is constructed until first requested, so
+    importing this module (and starting a worker) stays cheap.
+    """
+
+    def __init__(self, max_retrievers: int = RETRIEVER_CACHE_SIZE):
+        self.max_retrievers = max(1, max_retrievers)
+        self._lock = threading.RLock()
+        self._embeddings = None
+        self._reranker = None
+        self._vectorstore = None
+        self._chapter_positions: Dict[str, List[int]] = {}
+        self._chapter_vectorstores: Dict[str, Any] = {}
+        self._lexical_index = None
+        self._chat_models: Dict[Tuple, Any] = {}
+        self._retrievers: "OrderedDict[str, Any]" = OrderedDict()
+        self._nbytes: Dict[str, int] = {}
+        self.retriever_hits = 0
+        self.retriever_misses = 0
+        self.retriever_evictions = 0
+
+    def get_embeddings(self):
+        """Returns the shared BGE embedder, constructing it on first use."""
+        with self._lock:
+            if self._embeddings is None:
+                print(f"Initializing shared BGE embeddings ({INFERENCE_BACKEND} backend)...")
+                if INFERENCE_BACKEND == "onnx":
+                    from onnx_backend import OnnxBgeEmbeddings  # Optional dependency: onnxruntime
+                    embeddings_model = OnnxBgeEmbeddings(EMBEDDING_MODEL_NAME, query_instruction=BGE_QUERY_INSTRUCTION,
+                                                         threads=intra_op_threads())
+                else:
+                    from langchain_community.embeddings import HuggingFaceBgeEmbeddings  # BERT-based embeddings
+                    embeddings_model = HuggingFaceBgeEmbeddings(
+                        model_name=EMBEDDING_MODEL_NAME,
+                        model_kwargs={'device': 'cpu'},  # Using CPU for compatibility
+                        encode_kwargs={'normalize_embeddings': True},  # Normalize embeddings for cosine similarity
+                        query_instruction=BGE_QUERY_INSTRUCTION
+                    )
+                self._embeddings = CachedEmbeddings(embeddings_model)
+                self._nbytes["embeddings"] = _estimate_model_nbytes(self._embeddings)
+            return self._embeddings
+
+    def set_embeddings(self, embeddings_model) -> None:
+        """Installs a caller-built embedder as the shared one, if none has been loaded yet."""
+        with self._lock:
+            if self._embeddings is None:
+                if not isinstance(embeddings_model, CachedEmbeddings):
+                    embeddings_model = CachedEmbeddings(embeddings_model)
+                self._embeddings = embeddings_model
+                self._nbytes["embeddings"] = _estimate_model_nbytes(embeddings_model)
+            elif embeddings_model is not self._embeddings and embeddings_model is not self._embeddings.inner:
+                print("Shared embeddings already loaded; ignoring the additional embeddings model.")
+
+    def get_reranker(self):
+        """Returns the shared BGE cross-encoder, constructing it on first use."""
+        with self._lock:
+            if self._reranker is None:
+                print(f"Initializing shared BGE-Reranker ({INFERENCE_BACKEND} backend)...")
+                # Quantized scores differ slightly, so they get their own cache namespace
+                model_name = f"{RERANKER_MODEL_NAME}:onnx-int8" if INFERENCE_BACKEND == "onnx" else RERANKER_MODEL_NAME
+                self._reranker = CachedCrossEncoder(build_cross_encoder(), model_name=model_name)
+                self._nbytes["reranker"] = _estimate_model_nbytes(self._reranker)
+            return self._reranker
+
+    def get_scoring_cross_encoder(self):
+        """
+        The shared cross-encoder without the rerank score cache, for pairs that are not retrieval
+        (e.g. grading): caching them would only evict (query, chunk) scores. Shares the weights.
+        """
+        reranker = self.get_reranker()
+        return getattr(reranker, "inner", reranker)
+
+    def set_reranker(self, cross_encoder) -> None:
+        """Installs a caller-built cross-encoder, used as given (no score cache), if none has been loaded yet."""
+        with self._lock:
+            if self._reranker is None:
+                self._reranker = cross_encoder
+                self._nbytes["reranker"] = _estimate_model_nbytes(cross_encoder)
+            elif cross_encoder is not self._reranker:
+                print("Shared reranker already loaded; ignoring the additional cross-encoder.")
+
+    def get_chat_model(self, model_name: str = CHAT_MODEL_NAME, temperature: float = 0.7, max_tokens: int = 1500, **kwargs):
+        """
+        Returns the shared chat model for this configuration, constructing it on first use.
+
+        The model comes wrapped in llm_gateway's GatewayChatModel, so its calls share the
+        process-wide concurrency limit, rate limits and retries. With CHAT_BACKEND=fake, every
+        caller gets the offline FakeChatModel instead of ChatOpenAI; its latency and error rate come
+        from the FAKE_LLM_* environment variables.
+        """
+        key = (model_name, temperature, max_tokens, tuple(sorted(kwargs.items())))
+        with self._lock:
+            if key not in self._chat_models:
+                if CHAT_BACKEND == "fake":
+                    from fake_chat_model import FakeChatModel
+                    model = FakeChatModel(model_name=f"fake:{model_name}", max_tokens=max_tokens)
+                else:
+                    from langchain_openai import ChatOpenAI  # OpenAI's chat models
+                    # The gateway retries with backoff outside the concurrency slot; the client must not retry too
+                    kwargs.setdefault("max_retries", 0)
+                    model = ChatOpenAI(model_name=model_name, temperature=temperature, max_tokens=max_tokens, **kwargs)
+                self._chat_models[key] = gated(model)
+            return self._chat_models[key]
+
+    def get_vectorstore(self):
+        """Returns the shared FAISS vector store, loading it from disk on first use."""
+        with self._lock:
+            if self._vectorstore is None:
+                if not VECTORSTORE_PATH.exists():
+                    raise FileNotFoundError(f"Vector store not found at {VECTORSTORE_PATH}")
+                print("Loading FAISS vector store...")
+                from vector_storage import load_vectorstore  # mmap-able index storage
+                # Memory-mapped when saved in the columnar layout, so workers share pages
+                self._vectorstore = load_vectorstore(VECTORSTORE_PATH, self.get_embeddings())
+                self._nbytes["vectorstore"] = _estimate_vectorstore_nbytes(self._vectorstore)
+                self._index_chapters()
+            return self._vectorstore
+
+    def _index_chapters(self) -> None:
+        """Precomputes the chapter -> vector position map from each chunk's `chapter_id` metadata."""
+        from vector_storage import ColumnarDocstore
+
+        docstore = self._vectorstore.docstore
+        if isinstance(docstore, ColumnarDocstore):
+            # Rows are stored in FAISS position order, so the chapter column is the map
+            self._chapter_positions = docstore.chapter_rows()
+        else:
+            positions: Dict[str, List[int]] = {}
+            for position, doc_id in self._vectorstore.index_to_docstore_id.items():
+                doc = docstore.search(doc_id)
+                chapter_id = doc.metadata.get("chapter_id", "unknown") if isinstance(doc, Document) else "unknown"
+                positions.setdefault(chapter_id, []).append(position)
+            self._chapter_positions = {chapter_id: sorted(p) for chapter_id, p in positions.items()}
+        self._chapter_vectorstores.clear()
+        print(f"Indexed {len(self._chapter_positions)} chapters in the vector store.")
+
+    def chapter_positions(self, chapter_id: Optional[str]) -> Optional[List[int]]:
+        """FAISS positions of a chapter's chunks in the shared store, or None for "all"."""
+        with self._lock:
+            self.get_vectorstore()
+            if not chapter_id or chapter_id == "all":
+                return None
+            return self._chapter_positions.get(chapter_id, [])
+
+    def get_lexical_index(self):
+        """Returns the BM25 index saved with the vector store, building one in memory if missing."""
+        with self._lock:
+            if self._lexical_index is None:
+                from lexical_index import BM25Index  # BM25 postings stored next to the FAISS index
+                self._lexical_index = BM25Index.load(VECTORSTORE_PATH)
+                if self._lexical_index is None:
+                    print("No saved BM25 index found; building one in memory from the vector store...")
+                    self._lexical_index = _build_lexical_index(self.get_vectorstore())
+                self._nbytes["lexical_index"] = self._lexical_index.nbytes
+            return self._lexical_index
+
+    def get_chapter_vectorstore(self, chapter_id: Optional[str]):
+        """
+        Returns a vector store scoped to one chapter, or the shared store for "all"/None.
+
+        Chapter views search the shared index restricted to the precomputed position map (see
+        `ChapterIndex`); they hold no vectors of their own and are built once and reused.
+        """
+        with self._lock:
+            vectorstore = self.get_vectorstore()
+            if not chapter_id or chapter_id == "all":
+                return vectorstore
+            if chapter_id not in self._chapter_vectorstores:
+                positions = self._chapter_positions.get(chapter_id, [])
+                if not positions:
+                    print(f"⚠️ No indexed chunks found for chapter: {chapter_id}")
+                self._chapter_vectorstores[chapter_id] = _build_chapter_vectorstore(vectorstore, positions)
+            return self._chapter_vectorstores[chapter_id]
+
+    def get_retriever(self, chapter_id: Optional[str], factory, variant: str = ""):
+        """
+        Returns the cached retriever view for a chapter, building it with `factory()` on a miss.
+
+        `variant` distinguishes differently configured views of the same chapter. The least
+        recently used view is evicted once more than `max_retrievers` are held.
+        """
+        key = (chapter_id or "all") + (f"|{variant}" if variant else "")
+        with self._lock:
+            if key in self._retrievers:
+                self._retrievers.move_to_end(key)
+                self.retriever_hits += 1
+                return self._retrievers[key]
+            self.retriever_misses += 1
+            retriever = factory()
+            self._retrievers[key] = retriever
+            while len(self._retrievers) > self.max_retrievers:
+                evicted, _ = self._retrievers.popitem(last=False)
+                self.retriever_evictions += 1
+                print(f"Evicted retriever view for chapter: {evicted}")
+            return retriever
+
+    def invalidate(self) -> None:
+        """Drops the loaded vector store and every retriever view, e.g. after the index is rebuilt."""
+        with self._lock:
+            self._vectorstore = None
+            self._chapter_positions = {}
+            self._chapter_vectorstores.clear()
+            self._lexical_index = None
+            self._nbytes.pop("lexical_index", None)
+            self._nbytes.pop("vectorstore", None)
+            self._retrievers.clear()
+
+    def memory_usage(self) -> Dict[str, Any]:
+        """Approximate bytes held by each shared object, plus retriever-cache counters."""
+        with self._lock:
+            usage = dict(self._nbytes)
+            usage["total_bytes"] = sum(self._nbytes.values())
+            usage["retriever_views"] = len(self._retrievers)
+            usage["retriever_capacity"] = self.max_retrievers
+            usage["retriever_hits"] = self.retriever_hits
+            usage["retriever_misses"] = self.retriever_misses
+            usage["retriever_evictions"] = self.retriever_evictions
+            if self._embeddings is not None:
+                usage["query_cache"] = self._embeddings.stats()
+            if self._reranker is not None:
+                usage["rerank_cache"] = self._reranker.stats()
+            usage["rerank_gate"] = rerank_gate_stats.as_dict()
+            return usage
+
+def _build_lexical_index(vectorstore) -> "BM25Index":
+    """BM25 over the store's chunks, with rows in FAISS position order."""
+    from lexical_index import BM25Index
+
+    return BM25Index.from_texts(
+        vectorstore.docstore.search(doc_id).page_content
+        for _, doc_id in sorted(vectorstore.index_to_docstore_id.items())
+    )
+
+def _save_index_files(vectorstore) -> None:
+    """Writes the FAISS index, the columnar docstore and the BM25 index side by side."""
+    from vector_storage import save_vectorstore
+
+    save_vectorstore(vectorstore, VECTORSTORE_PATH)
+    _build_lexical_index(vectorstore).save(VECTORSTORE_PATH)
+
+# One registry per process, shared by the CLI, the FastAPI backend and the Streamlit frontend
+model_registry = ModelRegistry()
+
+def embed_chunks_into_vectorstore(chunks: list[Document], chunk_ids: list[str], vectorstore=None,
+                                  batch_size: int = EMBED_BATCH_SIZE, workers: int = EMBED_WORKERS):
+    """
+    Embeds chunks in batches and adds each batch to the FAISS store as soon as it is encoded.
+
+    With `workers > 1` the sentence-transformers model behind the shared embedder runs a
+    multi-process encode pool on CPU, and each step hands the pool `batch_size * workers` texts so
+    every process stays busy. Throughput (embeddings/sec) is printed per step and overall.
+
+    Returns the vector store, creating it from the first batch if `vectorstore` is None.
+    """
+    if not chunks:
+        raise ValueError("No chunks to embed")
+    import numpy as np
+    from langchain_community.vectorstores import FAISS  # FAISS for vector search: https://github.com/facebookresearch/faiss
+
+    embeddings = model_registry.get_embeddings()
+    client = getattr(embeddings, "client", None)
+    normalize = (getattr(embeddings, "encode_kwargs", None) or {}).get("normalize_embeddings", False)
+    pool = None
+    if workers > 1 and hasattr(client, "start_multi_process_pool"):
+        print(f"Starting {workers}-process CPU encode pool...")
+        pool = client.start_multi_process_pool(target_devices=["cpu"] * workers)
+    step = max(1, batch_size) * (workers if pool else 1)
+
+    embedded, build_start = 0, time.perf_counter()
+    try:
+        for offset in range(0, len(chunks), step):
+            batch = chunks[offset:offset + step]
+            texts = [chunk.page_content for chunk in batch]
+            batch_start = time.perf_counter()
+            if pool:
+                vectors = client.encode_multi_process([t.replace("\n", " ") for t in texts], pool, batch_size=batch_size)
+                if normalize:
+                    vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+                vectors = vectors.tolist()
+            else:
+                vectors = embeddings.embed_documents(texts)
+            batch_seconds = time.perf_counter() - batch_start
+
+            text_embeddings = list(zip(texts, vectors))
+            metadatas = [chunk.metadata for chunk in batch]
+            ids = chunk_ids[offset:offset + step]
+            if vectorstore is None:
+                vectorstore = FAISS.from_embeddings(text_embeddings, embeddings, metadatas=metadatas, ids=ids)
+            else:
+                vectorstore.add_embeddings(text_embeddings, metadatas=metadatas, ids=ids)
+            embedded += len(batch)
+            print(f"Embedded {embedded}/{len(chunks)} chunks "
+                  f"({len(batch) / max(batch_seconds, 1e-9):.1f} embeddings/sec)")
+    finally:
+        if pool:
+            client.stop_multi_process_pool(pool)
+
+    total_seconds = time.perf_counter() - build_start
+    print(f"Embedded {embedded} chunks in {total_seconds:.1f}s "
+          f"({embedded / max(total_seconds, 1e-9):.1f} embeddings/sec overall)")
+    return vectorstore
+
+def create_and_save_vectorstore(chunks: list[Document], pages: list[Document] = None,
+                                batch_size: int = EMBED_BATCH_SIZE, workers: int = EMBED_WORKERS,
+                                index_type: str = INDEX_TYPE):
     """
     Creates and saves a FAISS (Facebook AI Similarity Search) vector store from document chunks.
     
     This function uses BGE (BAAI General Embedding) model to create dense vector representations
     of the text chunks and stores them in a FAISS index for efficient similarity search.
     
+    Chunks are stored under content-derived IDs and an ingestion manifest is written next to
+    the index, so `update_vectorstore` can later re-embed only what changed. Passing the source
+    `pages` lets the manifest skip unchanged pages entirely.
+    
+    Chunks are encoded `batch_size` at a time (across `workers` processes when > 1) and added
+    to the index as each batch finishes.
+    
+    `index_type` selects the saved index: "flat" (exact), "sq8", "ivf_flat" or "ivf_pq", with
+    IVF/PQ parameters picked from the corpus size (see `choose_index_params`). Use
+    `index_report.py` to compare their recall and latency before switching a deployment.
+    
     References:
     - FAISS: https://github.com/facebookresearch/faiss
     - BGE Embeddings: https://huggingface.co/BAAI/bge-base-en-v1.5
@@ -151,27 +1035,319 @@ def create_and_save_vectorstore(chunks: list[Document]):
         print("Initializing BGE embeddings for vector store creation...")
         # Using BGE (BAAI General Embedding) model for creating document embeddings
         # Model card: https://huggingface.co/BAAI/bge-base-en-v1.5
-        embeddings = HuggingFaceBgeEmbeddings(
-            model_name="BAAI/bge-base-en-v1.5",
-            model_kwargs={'device': 'cpu'},  # Using CPU for compatibility
-            encode_kwargs={'normalize_embeddings': True}  # Normalize embeddings for cosine similarity
-        )
+        model_registry.get_embeddings()
         
         # Create FAISS index from document chunks
         # FAISS provides efficient similarity search and clustering of dense vectors
         print(f"Creating FAISS index from {len(chunks)} chunks...")
-        vectorstore = FAISS.from_documents(chunks, embeddings)
+        chunk_ids = _assign_chunk_ids(chunks)
+        vectorstore = embed_chunks_into_vectorstore(chunks, chunk_ids, batch_size=batch_size, workers=workers)
+        if index_type != "flat":
+            print(f"Converting flat index to {index_type}...")
+            vectorstore.index = build_faiss_index(
+                reconstruct_vectors(vectorstore.index), index_type, vectorstore.index.metric_type
+            )
         
-        # Save the vector store for later use
-        VECTORSTORE_PATH.mkdir(parents=True, exist_ok=True)
-        vectorstore.save_local(str(VECTORSTORE_PATH))
+        # Save the vector store (index + columnar docstore + BM25 postings) for later use
+        _save_index_files(vectorstore)
+        manifest = _build_manifest(pages or [], chunks, chunk_ids)
+        manifest["index_type"] = index_type
+        save_manifest(manifest)
+        model_registry.invalidate()  # Retriever views must pick up the new index
         print(f"✅ Vector store created and saved successfully at: {VECTORSTORE_PATH}")
         
     except Exception as e:
         print(f"❌ Error creating vector store: {e}")
         sys.exit(1)
 
-def load_retriever_and_reranker(embeddings_model, query_instruction: str, selected_chapter_id: str = None):
+def delete_chunks(vectorstore, chunk_ids: List[str]) -> None:
+    """
+    Deletes chunks by docstore ID, keeping FAISS positions and `index_to_docstore_id` aligned.
+
+    LangChain's `delete` renumbers the ID map to 0..n-1, which matches flat-code indexes (Flat,
+    SQ8) since their `remove_ids` compacts. `IndexIVF.remove_ids` does not renumber, so surviving
+    vectors would point at the wrong chunks and later adds would reuse live IDs. IVF indexes are
+    therefore refilled with the surviving vectors instead, keeping the trained quantizer.
+    """
+    import faiss
+
+    try:
+        faiss.extract_index_ivf(vectorstore.index)
+    except RuntimeError:  # Not an IVF index
+        vectorstore.delete(chunk_ids)
+        return
+    doomed = set(chunk_ids) & set(vectorstore.index_to_docstore_id.values())
+    kept = [position for position, doc_id in sorted(vectorstore.index_to_docstore_id.items())
+            if doc_id not in doomed]
+    vectors = reconstruct_vectors(vectorstore.index, kept)  # PQ codes decode to their own centroids
+    index = faiss.clone_index(vectorstore.index)
+    index.reset()
+    if len(kept):
+        index.add(vectors)
+    vectorstore.docstore.delete(list(doomed))
+    vectorstore.index_to_docstore_id = {
+        i: vectorstore.index_to_docstore_id[position] for i, position in enumerate(kept)
+    }
+    vectorstore.index = index
+
+def update_vectorstore(pdf_path: Path = PDF_PATH, chapter_map: list[dict] = None) -> dict:
+    """
+    Brings the saved vector store in line with the PDF and chapter map, embedding only the diff.
+
+    Pages whose content hash matches the manifest are not re-split. Chunks are matched by
+    content hash: new or changed chunks are embedded and added, chunks that no longer exist are
+    deleted, and chunks on pages that moved to another chapter, or whose chapter was renamed,
+    have their chapter_id and chapter_title rewritten in place. Falls back to a full build when
+    there is no index or no manifest yet.
+
+    Returns a summary with the number of added, deleted, remapped and unchanged chunks.
+    """
+    if chapter_map is None:
+        chapter_map = load_chapter_map(CHAPTER_MAP_PATH)
+    manifest = load_manifest()
+    pages = extract_text_with_metadata(pdf_path, chapter_map)
+    if manifest is None or not (VECTORSTORE_PATH / "index.faiss").exists() \
+            or manifest.get("embedding_model") != EMBEDDING_MODEL_NAME:
+        print("No usable ingestion manifest found. Performing a full build...")
+        chunks = split_documents(pages)
+        create_and_save_vectorstore(chunks, pages=pages)
+        return {"full_rebuild": True, "added": len(chunks), "deleted": 0, "remapped": 0, "unchanged": 0}
+
+    old_pages = manifest.get("pages", {})
+    old_chunks = manifest.get("chunks", {})
+    chunk_ids_by_page: Dict[str, List[str]] = {}
+    for chunk_id, entry in old_chunks.items():
+        chunk_ids_by_page.setdefault(str(entry.get("page")), []).append(chunk_id)
+
+    # Unchanged pages keep their chunks as-is; only changed or new pages are re-split
+    kept_ids: List[str] = []
+    remap: Dict[str, Document] = {}
+    changed_pages: List[Document] = []
+    for page in pages:
+        page_key = str(page.metadata["page"])
+        old_page = old_pages.get(page_key)
+        if old_page and old_page["hash"] == _text_hash(page.page_content):
+            kept_ids.extend(chunk_ids_by_page.get(page_key, []))
+            if (old_page.get("chapter_id"), old_page.get("chapter_title")) != \
+                    (page.metadata["chapter_id"], page.metadata["chapter_title"]):
+                remap[page_key] = page  # Moved to another chapter, or its chapter was renamed
+        else:
+            changed_pages.append(page)
+    new_chunks = split_documents(changed_pages) if changed_pages else []
+    new_chunk_ids = _assign_chunk_ids(new_chunks)
+
+    live_ids = set(kept_ids) | set(new_chunk_ids)
+    to_add = [(chunk_id, chunk) for chunk_id, chunk in zip(new_chunk_ids, new_chunks) if chunk_id not in old_chunks]
+    to_delete = [chunk_id for chunk_id in old_chunks if chunk_id not in live_ids]
+    # Chunks that survived a page edit unchanged may still need their chapter rewritten
+    for chunk_id, chunk in zip(new_chunk_ids, new_chunks):
+        if chunk_id in old_chunks:
+            remap[str(chunk.metadata["page"])] = chunk
+    print(f"Ingestion diff: {len(changed_pages)} changed pages, {len(to_add)} chunks to embed, "
+          f"{len(to_delete)} to delete, {len(remap)} pages to remap.")
+
+    from vector_storage import load_vectorstore
+
+    # A writable copy: mmap'd indexes and the columnar docstore are read-only
+    vectorstore = load_vectorstore(VECTORSTORE_PATH, model_registry.get_embeddings(), use_mmap=False)
+    if to_delete:
+        delete_chunks(vectorstore, to_delete)
+    remapped = 0
+    if remap:
+        for chunk_id in live_ids & set(old_chunks):
+            page_key = str(old_chunks[chunk_id].get("page"))
+            if page_key in remap:
+                doc = vectorstore.docstore.search(chunk_id)
+                source = remap[page_key].metadata
+                if isinstance(doc, Document) and \
+                        (doc.metadata.get("chapter_id"), doc.metadata.get("chapter_title")) != \
+                        (source["chapter_id"], source["chapter_title"]):
+                    doc.metadata["chapter_id"] = source["chapter_id"]
+                    doc.metadata["chapter_title"] = source["chapter_title"]
+                    remapped += 1
+    if to_add:
+        print(f"Embedding {len(to_add)} new or changed chunks...")
+        embed_chunks_into_vectorstore([chunk for _, chunk in to_add], [chunk_id for chunk_id, _ in to_add], vectorstore)
+
+    if to_add or to_delete or remapped:
+        _save_index_files(vectorstore)
+        model_registry.invalidate()  # Retriever views must pick up the new index
+
+    # Rebuild the manifest from what is now in the index
+    manifest_chunks: Dict[str, dict] = {
+        chunk_id: old_chunks[chunk_id] for chunk_id in live_ids if chunk_id in old_chunks
+    }
+    for chunk_id, chunk in zip(new_chunk_ids, new_chunks):
+        manifest_chunks[chunk_id] = {"page": chunk.metadata.get("page"), "hash": _text_hash(chunk.page_content)}
+    index_type = manifest.get("index_type", "flat")
+    manifest = _build_manifest(pages, [], [])
+    manifest["chunks"] = manifest_chunks
+    manifest["index_type"] = index_type
+    save_manifest(manifest)
+
+    summary = {
+        "full_rebuild": False,
+        "added": len(to_add),
+        "deleted": len(to_delete),
+        "remapped": remapped,
+        "unchanged": len(live_ids) - len(to_add),
+    }
+    print(f"✅ Vector store updated: {summary}")
+    return summary
+
+# --- Confidence-Gated Reranking ---
+class RerankGateStats:
+    """Thread-safe counters for how often the adaptive retriever skipped the cross-encoder."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.skipped = 0
+        self.partial = 0
+        self.full = 0
+        self.pairs_scored = 0
+        self.pairs_saved = 0
+        self.audits = 0
+        self.agreement_total = 0.0
+
+    def record(self, mode: str, scored: int, candidates: int) -> None:
+        with self._lock:
+            self.queries += 1
+            setattr(self, mode, getattr(self, mode) + 1)
+            self.pairs_scored += scored
+            self.pairs_saved += candidates - scored
+
+    def record_audit(self, agreement: float) -> None:
+        with self._lock:
+            self.audits += 1
+            self.agreement_total += agreement
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "queries": self.queries,
+                "skipped": self.skipped,
+                "partial": self.partial,
+                "full": self.full,
+                "skip_rate": self.skipped / self.queries if self.queries else 0.0,
+                "pairs_scored": self.pairs_scored,
+                "pairs_saved": self.pairs_saved,
+                "audits": self.audits,
+                "rank_agreement": self.agreement_total / self.audits if self.audits else None,
+            }
+
+rerank_gate_stats = RerankGateStats()
+
+def _dense_similarity(vectorstore, score: float) -> float:
+    """Converts a FAISS score to cosine similarity, assuming normalized embeddings."""
+    from langchain_community.vectorstores.utils import DistanceStrategy
+
+    if vectorstore.distance_strategy == DistanceStrategy.MAX_INNER_PRODUCT:
+        return score
+    return 1.0 - score / 2.0  # Squared L2 between unit vectors is 2 - 2*cos
+
+class AdaptiveRerankRetriever(BaseRetriever):
+    """
+    Dense retrieval followed by a cross-encoder pass only where the dense ranking is unsure.
+
+    If the cosine gap between the last kept (top_n-th) and first dropped candidate is at least
+    `skip_margin`, the dense top_n is returned as-is. Otherwise candidates more than
+    `boundary_band` above the cut are kept, candidates more than `boundary_band` below it are
+    dropped, and only the ones in between are scored by the cross-encoder to fill the remaining
+    slots. A fraction `audit_rate` of gated queries is also fully reranked to measure how often
+    the shortcut agrees with the full ranking.
+    """
+
+    vectorstore: Any
+    reranker: Any
+    k: int = 10
+    top_n: int = 4
+    skip_margin: float = 0.05
+    boundary_band: float = 0.02
+    audit_rate: float = 0.05
+    stats: Any = None
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun, **kwargs) -> List[Document]:
+        stats = self.stats or rerank_gate_stats
+        hits = self.vectorstore.similarity_search_with_score(query, k=kwargs.get("k", self.k))
+        docs = [doc for doc, _ in hits]
+        sims = [_dense_similarity(self.vectorstore, score) for _, score in hits]
+        if len(docs) <= self.top_n:
+            stats.record("skipped", 0, len(docs))
+            return docs
+
+        if sims[self.top_n - 1] - sims[self.top_n] >= self.skip_margin:
+            selected, mode, scored = list(range(self.top_n)), "skipped", 0
+        else:
+            boundary = (sims[self.top_n - 1] + sims[self.top_n]) / 2
+            sure = [i for i in range(len(docs)) if sims[i] > boundary + self.boundary_band][:self.top_n]
+            rest = [i for i in range(len(docs)) if i not in sure]
+            slots = self.top_n - len(sure)
+            if slots == 0:  # The whole top_n clears the band; scoring the rest could not change it
+                selected, mode, scored = sure, "skipped", 0
+            else:
+                uncertain = [i for i in rest if sims[i] >= boundary - self.boundary_band]
+                if len(uncertain) < slots + 1:
+                    uncertain = rest[:slots + 1]  # Always give the cross-encoder a real choice
+                scores = self.reranker.score([(query, docs[i].page_content) for i in uncertain])
+                ranked = [i for _, i in sorted(zip(scores, uncertain), key=lambda pair: pair[0], reverse=True)]
+                selected = sure + ranked[:slots]
+                mode = "full" if len(uncertain) == len(docs) else "partial"
+                scored = len(uncertain)
+        stats.record(mode, scored, len(docs))
+
+        if mode != "full" and random.random() < self.audit_rate:
+            full_scores = self.reranker.score([(query, doc.page_content) for doc in docs])
+            full_top = set(sorted(range(len(docs)), key=lambda i: full_scores[i], reverse=True)[:self.top_n])
+            stats.record_audit(len(full_top & set(selected)) / self.top_n)
+        return [docs[i] for i in selected]
+
+# --- Hybrid Lexical + Dense Retrieval ---
+class HybridRerankRetriever(BaseRetriever):
+    """
+    Fuses dense (FAISS) and lexical (BM25) candidates with reciprocal-rank fusion, then reranks.
+
+    Lexical matching catches names, dates and treaties that dense search can rank low. Because
+    the fused list already agrees across two signals, only `fused_k` candidates (instead of the
+    usual 10) are sent through the cross-encoder before keeping `top_n`.
+    """
+
+    vectorstore: Any
+    lexical_index: Any
+    reranker: Any
+    global_ids: Dict[int, str]
+    rows: Any = None  # FAISS positions the lexical search is restricted to (a chapter), or None
+    dense_k: int = 10
+    lexical_k: int = 10
+    fused_k: int = 6
+    top_n: int = 4
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun, **kwargs) -> List[Document]:
+        import numpy as np
+        from lexical_index import reciprocal_rank_fusion
+
+        # Dense candidates, as docstore IDs (chapter views return positions in the shared index)
+        query_vector = np.array([self.vectorstore.embedding_function.embed_query(query)], dtype=np.float32)
+        if self.vectorstore._normalize_L2:
+            import faiss
+            faiss.normalize_L2(query_vector)
+        _, positions = self.vectorstore.index.search(query_vector, kwargs.get("k", self.dense_k))
+        dense_ids = [self.vectorstore.index_to_docstore_id[int(p)] for p in positions[0] if p != -1]
+
+        lexical_ids = [self.global_ids[row] for row, _ in self.lexical_index.search(query, self.lexical_k, self.rows)]
+        fused = reciprocal_rank_fusion([dense_ids, lexical_ids])[:self.fused_k]
+        docs = [self.vectorstore.docstore.search(doc_id) for doc_id, _ in fused]
+        docs = [doc for doc in docs if isinstance(doc, Document)]
+        if len(docs) <= 1:
+            return docs
+        scores = self.reranker.score([(query, doc.page_content) for doc in docs])
+        ranked = sorted(zip(scores, range(len(docs))), key=lambda pair: pair[0], reverse=True)
+        return [docs[i] for _, i in ranked[:self.top_n]]
+
+def load_retriever_and_reranker(embeddings_model=None, query_instruction: str = "", selected_chapter_id: str = None,
+                                adaptive_rerank: bool = ADAPTIVE_RERANK, skip_margin: float = RERANK_SKIP_MARGIN,
+                                boundary_band: float = RERANK_BOUNDARY_BAND, hybrid: bool = HYBRID_RETRIEVAL,
+                                fused_k: int = HYBRID_FUSED_K):
     """
     Loads the vector store and sets up a sophisticated retriever with a re-ranking stage.
     
@@ -179,72 +1355,185 @@ def load_retriever_and_reranker(embeddings_model, query_instruction: str, select
     re-ranker to improve retrieval quality. The re-ranker uses BGE-Reranker to reorder the
     initial results based on more sophisticated semantic understanding.
     
+    The embedder, cross-encoder and vector store come from the process-wide `model_registry`,
+    so the returned retriever is only a thin per-chapter view; repeated calls for the same
+    chapter return the cached view.
+    
     References:
     - FAISS: https://github.com/facebookresearch/faiss
     - BGE-Reranker: https://huggingface.co/BAAI/bge-reranker-base
     - LangChain Retriever: https://python.langchain.com/docs/modules/data_connection/retrievers/
     
     Args:
-        embeddings_model: The embeddings model used for the vector store
+        embeddings_model: Optional embeddings model; used as the shared embedder if none is loaded yet
         query_instruction: Instruction for query processing
         selected_chapter_id: Optional chapter ID to filter results
+        adaptive_rerank: Only run the cross-encoder where the dense ranking is unsure
+            (see `AdaptiveRerankRetriever`); skip-rate is reported in `model_registry.memory_usage()`
+        skip_margin: Cosine gap at the top-4 cut above which reranking is skipped entirely
+        boundary_band: Cosine band around the cut whose candidates are reranked
+        hybrid: Fuse BM25 and dense candidates with reciprocal-rank fusion and rerank only the
+            top `fused_k` of them (see `HybridRerankRetriever`); takes precedence over adaptive_rerank
+        fused_k: Number of fused candidates sent to the cross-encoder in hybrid mode
     
     """
     try:
-        print("Loading FAISS vector store...")
         if not VECTORSTORE_PATH.exists():
             print(f"❌ Vector store not found at {VECTORSTORE_PATH}. Please run the ingestion process first.")
             sys.exit(1)
+        if embeddings_model is not None:
+            model_registry.set_embeddings(embeddings_model)
+
+        def build_retriever():
+            # Chapter scoping happens inside the index: chapter views search the shared index
+            # with an ID selector, so all k hits come from the requested chapter without a post-filter
+            if selected_chapter_id and selected_chapter_id != "all":
+                print(f"Scoping retrieval to chapter: {selected_chapter_id}")
+            else:
+                print("No chapter filter applied (retrieving from all chapters).")
+            vectorstore = model_registry.get_chapter_vectorstore(selected_chapter_id)
+
+            if hybrid:
+                return HybridRerankRetriever(
+                    vectorstore=vectorstore,
+                    lexical_index=model_registry.get_lexical_index(),
+                    reranker=model_registry.get_reranker(),
+                    global_ids=dict(model_registry.get_vectorstore().index_to_docstore_id),
+                    rows=model_registry.chapter_positions(selected_chapter_id),
+                    fused_k=fused_k,
+                    top_n=4,
+                )
+
+            if adaptive_rerank:
+                return AdaptiveRerankRetriever(
+                    vectorstore=vectorstore,
+                    reranker=model_registry.get_reranker(),
+                    k=10,
+                    top_n=4,
+                    skip_margin=skip_margin,
+                    boundary_band=boundary_band,
+                )
+
+            from langchain.retrievers import ContextualCompressionRetriever
+            from langchain.retrievers.document_compressors import CrossEncoderReranker
+
+            # Configure search parameters
+            search_kwargs = {"k": 10}  # Retrieve top 10 documents initially
+
+            # Create base retriever from FAISS index
+            base_retriever = vectorstore.as_retriever(search_kwargs=search_kwargs)
             
-        # Load the FAISS index with the embeddings model
-        vectorstore = FAISS.load_local(
-            str(VECTORSTORE_PATH),
-            embeddings_model,
-            allow_dangerous_deserialization=True  # Required for FAISS deserialization
-        )
+            # Create re-ranker that will reorder the top 4 results
+            # BGE-Reranker provides better semantic understanding than pure vector similarity
+            compressor = CrossEncoderReranker(
+                model=model_registry.get_reranker(),
+                top_n=4  # Only re-rank and return top 4 most relevant results
+            )
+            
+            # Combine the base retriever with the re-ranker
+            return ContextualCompressionRetriever(
+                base_compressor=compressor,
+                base_retriever=base_retriever
+            )
 
-        # Configure search parameters
-        search_kwargs = {"k": 10}  # Retrieve top 10 documents initially
-        
-        # Apply chapter filter if specified
-        if selected_chapter_id and selected_chapter_id != "all":
-            print(f"Filtering retrieval for chapter: {selected_chapter_id}")
-            search_kwargs["filter"] = {"chapter_id": selected_chapter_id}
+        if hybrid:
+            variant = f"hybrid:{fused_k}"
+        elif adaptive_rerank:
+            variant = f"adaptive:{skip_margin}:{boundary_band}"
         else:
-            print("No chapter filter applied (retrieving from all chapters).")
-
-        # Create base retriever from FAISS index
-        base_retriever = vectorstore.as_retriever(search_kwargs=search_kwargs)
-        
-        # Initialize cross-encoder for re-ranking
-        # BGE-Reranker provides better semantic understanding than pure vector similarity
-        print("Initializing BGE-Reranker for improved retrieval quality...")
-        reranker = HuggingFaceCrossEncoder(
-            model_name="BAAI/bge-reranker-base",  # Pre-trained re-ranking model
-            model_kwargs={"max_length": 512}  # Maximum sequence length for the model
-        )
-        
-        # Create re-ranker that will reorder the top 4 results
-        compressor = CrossEncoderReranker(
-            model=reranker,
-            top_n=4  # Only re-rank and return top 4 most relevant results
-        )
-        
-        # Combine the base retriever with the re-ranker
-        compression_retriever = ContextualCompressionRetriever(
-            base_compressor=compressor,
-            base_retriever=base_retriever
-        )
-        
+            variant = ""
+        retriever = model_registry.get_retriever(selected_chapter_id, build_retriever, variant)
         print("✅ Retriever with re-ranking is ready.")
-        return compression_retriever
+        return retriever
         
     except Exception as e:
         print(f"❌ Error initializing retriever: {e}")
         sys.exit(1)
 
+# --- Async Retrieval ---
+class RetrievalBusyError(RuntimeError):
+    """Raised when more retrievals are pending than RETRIEVAL_MAX_PENDING allows."""
+
+_retrieval_executor = None
+_retrieval_executor_lock = threading.Lock()
+_retrieval_slots = threading.BoundedSemaphore(RETRIEVAL_WORKERS + RETRIEVAL_MAX_PENDING)
+_retrieval_thread = threading.local()
+
+def _mark_retrieval_thread() -> None:
+    _retrieval_thread.active = True
+
+def intra_op_threads() -> int:
+    """
+    Intra-op threads per model call: the CPU budget split between the retrieval workers.
+
+    RETRIEVAL_WORKERS concurrent retrievals each running a torch/ONNX kernel on every core would
+    oversubscribe the machine, so the intra-op pool is capped at cores // workers by default.
+    """
+    return INTRA_OP_THREADS or max(1, (os.cpu_count() or 1) // RETRIEVAL_WORKERS)
+
+def _configure_intra_op_threads() -> int:
+    """Applies `intra_op_threads` to torch; ONNX sessions get it when the models are built."""
+    threads = intra_op_threads()
+    if INFERENCE_BACKEND != "onnx":
+        import torch
+        torch.set_num_threads(threads)
+    return threads
+
+def get_retrieval_executor():
+    """Returns the process-wide retrieval thread pool, creating it on first use."""
+    global _retrieval_executor
+    with _retrieval_executor_lock:
+        if _retrieval_executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            threads = _configure_intra_op_threads()
+            print(f"Starting retrieval executor: {RETRIEVAL_WORKERS} workers x {threads} intra-op threads")
+            _retrieval_executor = ThreadPoolExecutor(
+                max_workers=RETRIEVAL_WORKERS,
+                thread_name_prefix="retrieval",
+                initializer=_mark_retrieval_thread,
+            )
+        return _retrieval_executor
+
+def submit_retrieval_work(fn, *args, **kwargs) -> Future:
+    """
+    Schedules CPU-bound retrieval work (embedding, FAISS search, reranking) on the retrieval executor.
+
+    Raises RetrievalBusyError instead of queueing without bound when the executor is saturated.
+    """
+    if not _retrieval_slots.acquire(blocking=False):
+        raise RetrievalBusyError(f"More than {RETRIEVAL_WORKERS + RETRIEVAL_MAX_PENDING} retrievals in flight")
+    try:
+        future = get_retrieval_executor().submit(fn, *args, **kwargs)
+    except BaseException:
+        _retrieval_slots.release()
+        raise
+    future.add_done_callback(lambda _: _retrieval_slots.release())
+    return future
+
+def run_retrieval_work(fn, *args, **kwargs):
+    """Runs `fn` on the retrieval executor and waits for it; runs inline if already on a retrieval worker."""
+    if getattr(_retrieval_thread, "active", False):
+        return fn(*args, **kwargs)  # Waiting on our own pool from inside it could deadlock
+    return submit_retrieval_work(fn, *args, **kwargs).result()
+
+async def arun_retrieval_work(fn, *args, **kwargs):
+    """Awaitable form of `run_retrieval_work`; the event loop stays free while the executor works."""
+    import asyncio
+    return await asyncio.wrap_future(submit_retrieval_work(fn, *args, **kwargs))
+
+def retrieve(retriever, query: str, **kwargs) -> List[Document]:
+    """`retriever.get_relevant_documents` on the retrieval executor, from any thread."""
+    return run_retrieval_work(retriever.get_relevant_documents, query, **kwargs)
+
+async def aretrieve(retriever, query: str, **kwargs) -> List[Document]:
+    """Async retrieval for event-loop callers such as FastAPI endpoints."""
+    return await arun_retrieval_work(retriever.get_relevant_documents, query, **kwargs)
+
 def setup_qa_chain(llm, retriever):
     """Sets up the RetrievalQA chain with a custom prompt."""
+    from langchain.chains import RetrievalQA
+    from langchain.prompts import PromptTemplate
+
     print("Setting up QA chain...")
     prompt_template = """You are an expert historian specializing in the content of the provided document. Your task is to provide accurate answers based ONLY on the following context.
 CONTEXT:
@@ -260,12 +1549,245 @@ ANSWER:
 """
     PROMPT = PromptTemplate(template=prompt_template, input_variables=["context", "question"])
     qa_chain = RetrievalQA.from_chain_type(
-        llm=llm, chain_type="stuff", retriever=retriever, return_source_documents=True, chain_type_kwargs={"prompt": PROMPT}
+        llm=gated(llm), chain_type="stuff", retriever=retriever, return_source_documents=True, chain_type_kwargs={"prompt": PROMPT}
     )
     print("QA chain setup complete.")
     return qa_chain
 
-def generate_question_from_chapter_content(retriever, llm, zpd_score: float, selected_chapter_title: str, previous_questions: set = None):
+# Representative ZPD score per difficulty band, e.g. for generating questions ahead of time
+DIFFICULTY_BAND_ZPD = {"beginner": 2.5, "intermediate": 5.5, "advanced": 8.5}
+
+DIFFICULTY_INSTRUCTIONS = {
+    "beginner": "Focus on basic facts, dates, and key terms.",
+    "intermediate": "Ask about causes, effects, and basic analysis.",
+    "advanced": "Require critical thinking, comparison, and evaluation.",
+}
+
+# Different question types to ensure variety
+QUESTION_TYPES = [
+    "a cause-and-effect question",
+    "a comparison question between two events or concepts",
+    "a question about historical significance",
+    "a question about primary sources or evidence",
+    "a question about different historical perspectives",
+    "a question about long-term consequences",
+    "a question about historical context"
+]
+
+# Different content aspects to focus on
+CONTENT_ASPECTS = [
+    "key events",
+    "important figures",
+    "main themes",
+    "historical context",
+    "primary sources",
+    "causes and effects",
+    "different perspectives"
+]
+
+def difficulty_band(zpd_score: float) -> str:
+    """Maps a ZPD score (1.0-10.0) to the beginner/intermediate/advanced question band."""
+    if zpd_score < 4.0:
+        return "beginner"
+    if zpd_score < 7.0:
+        return "intermediate"
+    return "advanced"
+
+def source_chunk_ids(docs: list[Document]) -> list[str]:
+    """Docstore IDs of retrieved chunks (stores built by create_and_save_vectorstore use content hashes)."""
+    computed = _assign_chunk_ids(docs)
+    return [getattr(doc, "id", None) or chunk_id for doc, chunk_id in zip(docs, computed)]
+
+# --- Multi-Candidate Question Generation ---
+class SpareQuestions:
+    """
+    Unused question candidates, kept per (owner, chapter title, difficulty) for the next request.
+
+    Owners are typically student IDs. The least recently used owners are dropped beyond `max_owners`.
+    """
+
+    def __init__(self, max_owners: int = SPARE_QUESTION_OWNERS):
+        self.max_owners = max(1, max_owners)
+        self._spares: "OrderedDict[Tuple[str, str, str], List[Tuple[str, str, list]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.served = 0
+
+    def put(self, owner: str, chapter_title: str, difficulty: str, candidates: List[Tuple[str, str, list]]) -> None:
+        if not candidates:
+            return
+        key = (owner, chapter_title, difficulty)
+        with self._lock:
+            self._spares.setdefault(key, []).extend(candidates)
+            self._spares.move_to_end(key)
+            while len(self._spares) > self.max_owners:
+                self._spares.popitem(last=False)
+
+    def pop(self, owner: str, chapter_title: str, difficulty: str, is_new) -> Optional[Tuple[str, str, list]]:
+        """Removes and returns the first spare that `is_new(question)` accepts; stale ones are discarded."""
+        key = (owner, chapter_title, difficulty)
+        with self._lock:
+            spares = self._spares.get(key, [])
+            while spares:
+                candidate = spares.pop(0)
+                if is_new(candidate[0]):
+                    self.served += 1
+                    return candidate
+            self._spares.pop(key, None)
+        return None
+
+spare_questions = SpareQuestions()
+
+def _is_new_question(question: str, previous_questions: set, fuzz) -> bool:
+    """Rejects exact, contained and fuzzy (ratio > 80) repeats of earlier questions."""
+    q_lower = question.lower()
+    for prev_q in previous_questions:
+        if q_lower == prev_q.lower() or \
+           q_lower in prev_q.lower() or \
+           prev_q.lower() in q_lower or \
+           fuzz.ratio(q_lower, prev_q.lower()) > 80:  # Using fuzzy matching
+            return False
+    return True
+
+def _chapter_context_docs(retriever, chapter_title: str, focus_aspect: str) -> list[Document]:
+    """Retrieves context for a question, keeping only chunks from the selected chapter."""
+    retrieved_docs = retrieve(retriever, f"{chapter_title} {focus_aspect}", k=5)
+    if not retrieved_docs:
+        print("No relevant documents found, trying a different approach...")
+        return []
+    # Filter documents to only include those from the selected chapter
+    # (chapter retrievers are already scoped by their index view; "All Chapters" spans the corpus)
+    if chapter_title == "All Chapters":
+        return retrieved_docs
+    filtered_docs = [doc for doc in retrieved_docs if doc.metadata.get('chapter_title') == chapter_title]
+    if not filtered_docs:
+        print(f"No documents found for chapter: {chapter_title}")
+    return filtered_docs
+
+def _parse_question_candidates(response: str) -> List[Tuple[str, str]]:
+    """Extracts (question, answer) pairs from a JSON array, tolerating code fences and extra text."""
+    start, end = response.find("["), response.rfind("]")
+    if start == -1 or end <= start:
+        return []
+    try:
+        items = json.loads(response[start:end + 1])
+    except json.JSONDecodeError:
+        return []
+    candidates = []
+    for item in items if isinstance(items, list) else []:
+        if isinstance(item, dict) and item.get("question") and item.get("answer"):
+            candidates.append((_normalize_question(str(item["question"])), str(item["answer"]).strip()))
+    return candidates
+
+def _question_candidates_messages(context: str, chapter_title: str, focus_aspect: str, difficulty: str,
+                                  instruction: str, question_types: List[str], n: int) -> list:
+    """Prompt asking for `n` distinct question/answer pairs in a single JSON response."""
+    types = ", ".join(random.sample(question_types, min(n, len(question_types))))
+    prompt = f"""You are a history professor creating exam questions. Your task is to generate {n} different {difficulty}-level questions.
+
+CHAPTER: {chapter_title}
+FOCUS ASPECT: {focus_aspect}
+DIFFICULTY: {difficulty}
+QUESTION TYPES (use a different one for each question where possible): {types}
+
+INSTRUCTIONS:
+1. Create {n} distinct {difficulty}-level history questions based on the context; no two may ask about the same fact.
+2. {instruction}
+3. Each question should be clear, specific, and require understanding of the material.
+4. Make sure no question is too broad or too narrow.
+5. Give each a detailed answer (2-3 sentences) that demonstrates {difficulty}-level understanding.
+6. Respond with ONLY a JSON array, no other text:
+[{{"question": "...?", "answer": "..."}}, ...]
+
+CONTEXT:
+{context}"""
+    return [
+        SystemMessage(content="You are a history professor creating unique exam questions. You reply with JSON only."),
+        HumanMessage(content=prompt)
+    ]
+
+def _generate_question_candidates(llm, context: str, chapter_title: str, focus_aspect: str, difficulty: str,
+                                  instruction: str, question_types: List[str], n: int) -> List[Tuple[str, str]]:
+    """Asks for `n` distinct question/answer pairs in a single JSON response."""
+    response = gated(llm).invoke(_question_candidates_messages(
+        context, chapter_title, focus_aspect, difficulty, instruction, question_types, n
+    )).content
+    return _parse_question_candidates(response)
+
+def _select_candidate(candidates: List[Tuple[str, str]], is_new, fuzz,
+                      source_docs: list) -> Tuple[Optional[Tuple[str, str]], List[Tuple[str, str, list]]]:
+    """
+    The first candidate that passes `is_new`, and the later ones that also pass and repeat no
+    other candidate of the batch, as spares: (accepted or None, [(question, answer, source_docs)]).
+    """
+    accepted, spares, batch = None, [], set()
+    for question, answer in candidates:
+        if not is_new(question) or not _is_new_question(question, batch, fuzz):
+            continue  # Repeats an earlier question or another candidate in this batch
+        batch.add(question)
+        if accepted is None:
+            accepted = (question, answer)
+        else:
+            spares.append((question, answer, source_docs))
+    return accepted, spares
+
+def _take_spare_question(student_id: Optional[str], chapter_title: str, difficulty: str, is_new,
+                         previous_questions: set) -> Optional[Tuple[str, str, list]]:
+    """A spare (question, answer, source_docs) kept for this student, recorded as asked, or None."""
+    if student_id is None:
+        return None
+    spare = spare_questions.pop(student_id, chapter_title, difficulty, is_new)
+    if spare:
+        print(f"Serving a spare {difficulty}-level question from {chapter_title}.")
+        previous_questions.add(spare[0])
+    return spare
+
+def _single_question_messages(context: str, chapter_title: str, focus_aspect: str, difficulty: str,
+                              instruction: str, question_type: str) -> list:
+    """Prompt asking for one question/answer pair in the "QUESTION: ... ANSWER: ..." format."""
+    prompt = f"""You are a history professor creating exam questions. Your task is to generate a {difficulty}-level question.
+
+CHAPTER: {chapter_title}
+FOCUS ASPECT: {focus_aspect}
+DIFFICULTY: {difficulty}
+QUESTION TYPE: {question_type}
+
+INSTRUCTIONS:
+1. Create ONE {difficulty}-level history question based on the context.
+2. {instruction}
+3. The question should be clear, specific, and require understanding of the material.
+4. Make sure the question is not too broad or too narrow.
+5. Provide a detailed answer (2-3 sentences) that demonstrates {difficulty}-level understanding.
+6. Format your response exactly as shown below:
+
+QUESTION: [Your question here?]
+ANSWER: [Your answer here.]
+
+CONTEXT:
+{context}
+
+Now, generate the question and answer:"""
+    return [
+        SystemMessage(content="""You are a history professor creating unique exam questions. 
+                Ensure each question is distinct and tests different aspects of the material."""),
+        HumanMessage(content=prompt)
+    ]
+
+def _normalize_question(question: str) -> str:
+    question = question.strip()
+    if not question.endswith('?'):
+        question = question.rstrip('.') + '?'
+    return question
+
+def _parse_question_answer(response: str) -> Optional[Tuple[str, str]]:
+    """Extracts (question, answer) from a "QUESTION: ... ANSWER: ..." reply, or None."""
+    if "QUESTION:" not in response or "ANSWER:" not in response:
+        return None
+    question = response.split("QUESTION:", 1)[1].split("ANSWER:")[0]
+    answer = response.split("ANSWER:", 1)[1].strip()
+    return _normalize_question(question), answer
+
+def generate_question_from_chapter_content(retriever, llm, zpd_score: float, selected_chapter_title: str, previous_questions: set = None,
+                                           student_id: str = None):
     """
     Generates a unique question and its expected answer based on content retrieved
     from a specific chapter or the entire document, with difficulty adjusted by ZPD score.
@@ -276,44 +1798,66 @@ def generate_question_from_chapter_content(retriever, llm, zpd_score: float, sel
         selected_chapter_title: Title of the chapter to generate questions from
         previous_questions: Set of previously asked questions to avoid repetition
         zpd_score: The user's Zone of Proximal Development score (1.0-10.0)
+        student_id: If given, unused candidate questions are kept for this student's next request
         
+    """
+    return generate_question_with_sources(retriever, llm, zpd_score, selected_chapter_title, previous_questions,
+                                          student_id=student_id)[:3]
+
+def generate_question_with_sources(retriever, llm, zpd_score: float, selected_chapter_title: str, previous_questions: set = None,
+                                   student_id: str = None, candidates: int = QUESTION_CANDIDATES):
+    """
+    Same as `generate_question_from_chapter_content`, but also returns the context chunks the
+    question was written from: (question, answer, difficulty, source_docs). `source_docs` is
+    empty when every attempt failed and a generic default question is returned.
+
+    With `candidates` > 1 the model is first asked for that many question/answer pairs in one
+    JSON response, and the first that passes the uniqueness check is used. When `student_id`
+    is given, the other candidates are kept as spares and served (without any LLM call) on
+    that student's next request for the same chapter and difficulty. The sequential retry loop
+    only runs if this yields nothing usable.
     """
     if previous_questions is None:
         previous_questions = set()
         
     # Map ZPD score to difficulty level
-    if zpd_score < 4.0:
-        difficulty = "beginner"
-        instruction = "Focus on basic facts, dates, and key terms."
-    elif zpd_score < 7.0:
-        difficulty = "intermediate"
-        instruction = "Ask about causes, effects, and basic analysis."
-    else:
-        difficulty = "advanced"
-        instruction = "Require critical thinking, comparison, and evaluation."
-    
-    # Define different question types to ensure variety
-    question_types = [
-        "a cause-and-effect question",
-        "a comparison question between two events or concepts",
-        "a question about historical significance",
-        "a question about primary sources or evidence",
-        "a question about different historical perspectives",
-        "a question about long-term consequences",
-        "a question about historical context"
-    ]
+    difficulty = difficulty_band(zpd_score)
+    instruction = DIFFICULTY_INSTRUCTIONS[difficulty]
     
-    # Define different content aspects to focus on
-    content_aspects = [
-        "key events",
-        "important figures",
-        "main themes",
-        "historical context",
-        "primary sources",
-        "causes and effects",
-        "different perspectives"
-    ]
+    # Vary question types and content aspects across attempts
+    question_types, content_aspects = QUESTION_TYPES, CONTENT_ASPECTS
     
+    from fuzzywuzzy import fuzz  # For string matching: https://github.com/seatgeek/fuzzywuzzy
+
+    def is_new(question: str) -> bool:
+        return _is_new_question(question, previous_questions, fuzz)
+
+    spare = _take_spare_question(student_id, selected_chapter_title, difficulty, is_new, previous_questions)
+    if spare:
+        return spare[0], spare[1], difficulty, spare[2]
+
+    if candidates > 1:
+        print(f"\nGenerating {candidates} {difficulty}-level candidate questions from {selected_chapter_title}...")
+        try:
+            focus_aspect = random.choice(content_aspects)
+            filtered_docs = _chapter_context_docs(retriever, selected_chapter_title, focus_aspect)
+            if filtered_docs:
+                context, filtered_docs = pack_context(filtered_docs, CONTEXT_TOKEN_BUDGET, CHAT_MODEL_NAME)
+                accepted, spares = _select_candidate(
+                    _generate_question_candidates(llm, context, selected_chapter_title, focus_aspect, difficulty,
+                                                  instruction, question_types, candidates),
+                    is_new, fuzz, filtered_docs)
+                if accepted:
+                    previous_questions.add(accepted[0])
+                    if student_id is not None:
+                        spare_questions.put(student_id, selected_chapter_title, difficulty, spares)
+                    return accepted[0], accepted[1], difficulty, filtered_docs
+                print("No usable candidate in the batch, falling back to sequential attempts...")
+        except (RetrievalBusyError, LLMBusyError):
+            raise  # Saturated retrieval pool or LLM queue: let the API answer 503 instead of retrying
+        except Exception as e:
+            print(f"❌ Error generating candidate questions: {e}")
+
     max_attempts = 5
     attempt = 0
     
@@ -326,71 +1870,28 @@ def generate_question_from_chapter_content(retriever, llm, zpd_score: float, sel
             focus_aspect = random.choice(content_aspects)
             
             # Retrieve relevant context with a specific focus
-            retrieved_docs = retriever.get_relevant_documents(f"{selected_chapter_title} {focus_aspect}", k=5)
-            if not retrieved_docs:
-                print("No relevant documents found, trying a different approach...")
-                continue
-                
-            # Filter documents to only include those from the selected chapter
-            filtered_docs = [doc for doc in retrieved_docs if doc.metadata.get('chapter_title') == selected_chapter_title]
+            filtered_docs = _chapter_context_docs(retriever, selected_chapter_title, focus_aspect)
             if not filtered_docs:
-                print(f"No documents found for chapter: {selected_chapter_title}")
                 continue
                 
-            context = "\n\n".join([doc.page_content for doc in filtered_docs])
+            context, filtered_docs = pack_context(filtered_docs, CONTEXT_TOKEN_BUDGET, CHAT_MODEL_NAME)
             
             # Select a random question type for variety
             question_type = random.choice(question_types)
             
             # Generate question and answer specific to the difficulty level
-            prompt = f"""You are a history professor creating exam questions. Your task is to generate a {difficulty}-level question.
-
-CHAPTER: {selected_chapter_title}
-FOCUS ASPECT: {focus_aspect}
-DIFFICULTY: {difficulty}
-QUESTION TYPE: {question_type}
-
-INSTRUCTIONS:
-1. Create ONE {difficulty}-level history question based on the context.
-2. {instruction}
-3. The question should be clear, specific, and require understanding of the material.
-4. Make sure the question is not too broad or too narrow.
-5. Provide a detailed answer (2-3 sentences) that demonstrates {difficulty}-level understanding.
-6. Format your response exactly as shown below:
-
-QUESTION: [Your question here?]
-ANSWER: [Your answer here.]
-
-CONTEXT:
-{context}
-
-Now, generate the question and answer:"""
-            
-            response = llm.invoke([
-                SystemMessage(content="""You are a history professor creating unique exam questions. 
-                Ensure each question is distinct and tests different aspects of the material."""),
-                HumanMessage(content=prompt)
-            ]).content
+            response = gated(llm).invoke(_single_question_messages(
+                context, selected_chapter_title, focus_aspect, difficulty, instruction, question_type
+            )).content
 
             # Parse the response
-            if "QUESTION:" in response and "ANSWER:" in response:
-                question = response.split("QUESTION:", 1)[1].split("ANSWER:")[0].strip()
-                answer = response.split("ANSWER:", 1)[1].strip()
-                
-                # Validate question format and check for uniqueness
-                if not question.endswith('?'):
-                    question = question.rstrip('.') + '?'
+            parsed = _parse_question_answer(response)
+            if parsed:
+                question, answer = parsed
                 
                 # Check if this question is too similar to previous ones
-                is_unique = True
+                is_unique = is_new(question)
                 q_lower = question.lower()
-                for prev_q in previous_questions:
-                    if q_lower == prev_q.lower() or \
-                       q_lower in prev_q.lower() or \
-                       prev_q.lower() in q_lower or \
-                       fuzz.ratio(q_lower, prev_q.lower()) > 80:  # Using fuzzy matching
-                        is_unique = False
-                        break
                 
                 # Check if the question focuses on the same aspect as previous questions
                 if is_unique:
@@ -404,16 +1905,22 @@ Now, generate the question and answer:"""
                     
                     if len(recent_aspects) < 3:  # Only allow if not too many similar aspects
                         previous_questions.add(question)
-                        return question, answer, difficulty
+                        return question, answer, difficulty, filtered_docs
                     else:
                         print(f"Too many similar aspect questions ({focus_aspect}), trying different aspect...")
                 else:
                     print("Generated a similar question, trying again...")
                     
+        except (RetrievalBusyError, LLMBusyError):
+            raise  # Saturated retrieval pool or LLM queue: let the API answer 503 instead of retrying
         except Exception as e:
             print(f"❌ Error generating question: {e}")
     
     # If we've tried max_attempts times, return a default question
+    return (*_default_question(selected_chapter_title, difficulty), [])
+
+def _default_question(selected_chapter_title: str, difficulty: str) -> Tuple[str, str, str]:
+    """Generic (question, answer, difficulty) used when no unique question could be generated."""
     print("⚠️ Could not generate a unique question after multiple attempts. Using a default question.")
     default_questions = {
         "beginner": (f"What was a key event in {selected_chapter_title}?", 
@@ -425,17 +1932,8 @@ Now, generate the question and answer:"""
     }
     return default_questions[difficulty]
 
-def generate_hint(question: str, expected_answer: str, zpd_score: float, llm) -> str:
-    """Generate a hint based on the ZPD score.
-    
-    Args:
-        question: The question being asked
-        expected_answer: The expected answer
-        zpd_score: The student's ZPD score (1.0-10.0)
-        llm: The language model to use
-        
-    """
-    # Determine hint style and detail level based on ZPD score
+def _hint_style(zpd_score: float) -> Tuple[str, str, str]:
+    """Hint style, detail level and guidance text for a ZPD score."""
     if zpd_score < 4.0:  # Beginner
         hint_style = "simple and direct"
         detail_level = "very detailed"
@@ -454,6 +1952,26 @@ def generate_hint(question: str, expected_answer: str, zpd_score: float, llm) ->
         guidance = "Provide a subtle nudge in the right direction. The hint should be quite " \
                  "minimal and require the student to do most of the thinking. Focus on " \
                  "broader concepts rather than specific details."
+    return hint_style, detail_level, guidance
+
+def _trim_hint(hint: str, zpd_score: float) -> str:
+    """Ensures the hint is not too revealing for the student's level."""
+    if zpd_score < 4.0 and len(hint.split()) > 30:  # For beginners, keep hints concise
+        hint = ' '.join(hint.split()[:30]) + '...'
+    elif zpd_score >= 7.0 and len(hint.split()) > 15:  # For advanced, keep hints very brief
+        hint = ' '.join(hint.split()[:15]) + '...'
+    return hint
+
+HINT_FALLBACKS = {
+    "beginner": "Think about the key concepts we've discussed. What's the main idea behind this question?",
+    "intermediate": "Consider how different factors might be connected in this situation.",
+    "advanced": "What patterns or themes can you identify that might be relevant here?",
+}
+
+def _request_hint(question: str, expected_answer: str, zpd_score: float, llm) -> str:
+    """Asks the LLM for a hint suited to the ZPD band; raises on LLM errors."""
+    # Determine hint style and detail level based on ZPD score
+    hint_style, detail_level, guidance = _hint_style(zpd_score)
     
     prompt = f"""You are a helpful history tutor providing a {hint_style} hint for a student.
 
@@ -469,36 +1987,656 @@ INSTRUCTIONS:
 
 HINT:"""
     
+    response = gated(llm).invoke([
+        SystemMessage(content=f"You are a history tutor providing a {hint_style} hint. Your hints are {detail_level}."),
+        HumanMessage(content=prompt)
+    ])
+    
+    # Clean up the response
+    hint = response.content.strip()
+    if 'hint:' in hint.lower():
+        hint = re.split('hint:', hint, maxsplit=1, flags=re.IGNORECASE)[1].strip()
+    
+    # Ensure the hint is not too revealing for the student's level
+    return _trim_hint(hint, zpd_score)
+
+def generate_hint(question: str, expected_answer: str, zpd_score: float, llm) -> str:
+    """Generate a hint based on the ZPD score.
+    
+    Args:
+        question: The question being asked
+        expected_answer: The expected answer
+        zpd_score: The student's ZPD score (1.0-10.0)
+        llm: The language model to use
+    """
     try:
-        response = llm.invoke([
-            SystemMessage(content=f"You are a history tutor providing a {hint_style} hint. Your hints are {detail_level}."),
-            HumanMessage(content=prompt)
-        ])
-        
-        # Clean up the response
-        hint = response.content.strip()
-        if 'hint:' in hint.lower():
-            hint = hint.split('hint:', 1)[1].strip()
-        
-        # Ensure the hint is not too revealing for the student's level
-        if zpd_score < 4.0 and len(hint.split()) > 30:  # For beginners, keep hints concise
-            hint = ' '.join(hint.split()[:30]) + '...'
-        elif zpd_score >= 7.0 and len(hint.split()) > 15:  # For advanced, keep hints very brief
-            hint = ' '.join(hint.split()[:15]) + '...'
-            
-        return hint
-        
+        return _request_hint(question, expected_answer, zpd_score, llm)
     except Exception as e:
         print(f"Error generating hint: {e}")
         # Fallback hints based on ZPD
-        if zpd_score < 4.0:
-            return "Think about the key concepts we've discussed. What's the main idea behind this question?"
-        elif zpd_score < 7.0:
-            return "Consider how different factors might be connected in this situation."
-        else:
-            return "What patterns or themes can you identify that might be relevant here?"
+        return HINT_FALLBACKS[difficulty_band(zpd_score)]
+
+# --- Hint Cache ---
+class HintCache:
+    """
+    Bounded LRU of generated hints keyed by (question, expected answer, ZPD band).
+
+    `_hint_style` and `_trim_hint` only distinguish the three bands, so every student in a band
+    can share one hint, and bank questions served again never pay for the same hint twice.
+    Concurrent requests for the same uncached hint wait on one LLM call. Fallback hints returned
+    after an LLM error are not cached.
+    """
+
+    def __init__(self, max_size: int = HINT_CACHE_SIZE):
+        self.max_size = max(1, max_size)
+        self._cache: "OrderedDict[Tuple[str, str], str]" = OrderedDict()
+        self._in_flight: Dict[Tuple[str, str], Future] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.stored = 0  # Hints added with put(), e.g. by structured grading
+
+    @staticmethod
+    def key(question: str, expected_answer: str, zpd_score: float) -> Tuple[str, str]:
+        digest = hashlib.sha1(f"{question}\x00{expected_answer}".encode("utf-8")).hexdigest()
+        return digest, difficulty_band(zpd_score)
+
+    def _store(self, key: Tuple[str, str], hint: str) -> None:
+        self._cache[key] = hint
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_size:
+            self._cache.popitem(last=False)
+
+    def put(self, question: str, expected_answer: str, zpd_score: float, hint: str) -> None:
+        """Caches a hint produced elsewhere, so a later `get` for the same band reuses it."""
+        if not hint:
+            return
+        with self._lock:
+            self._store(self.key(question, expected_answer, zpd_score), hint)
+            self.stored += 1
+
+    def get(self, question: str, expected_answer: str, zpd_score: float, llm) -> str:
+        """Returns the cached hint for the band, generating it on a miss."""
+        key = self.key(question, expected_answer, zpd_score)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return self._cache[key]
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                owner = False
+            else:
+                self.misses += 1
+                future = Future()
+                self._in_flight[key] = future
+                owner = True
+        if not owner:
+            return future.result()
+        try:
+            hint = _request_hint(question, expected_answer, zpd_score, llm)
+        except Exception as e:
+            print(f"Error generating hint: {e}")
+            hint = None
+        with self._lock:
+            if hint:
+                self._store(key, hint)
+            del self._in_flight[key]
+        hint = hint or HINT_FALLBACKS[key[1]]
+        future.set_result(hint)
+        return hint
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters for the hint cache."""
+        with self._lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                "size": len(self._cache),
+                "capacity": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "stored": self.stored,
+                "hit_rate": (self.hits + self.coalesced) / lookups if lookups else 0.0,
+            }
+
+hint_cache = HintCache()
+_hint_executor = None
+_hint_executor_lock = threading.Lock()
+
+def get_hint(question: str, expected_answer: str, zpd_score: float, llm) -> str:
+    """Hint for a question at the student's ZPD band, generated on demand and memoized in `hint_cache`."""
+    return hint_cache.get(question, expected_answer, zpd_score, llm)
+
+def prefetch_hint(question: str, expected_answer: str, zpd_score: float, llm) -> Optional[Future]:
+    """Generates the hint in the background so a later `get_hint` is a cache hit."""
+    global _hint_executor
+    with _hint_executor_lock:
+        if _hint_executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _hint_executor = ThreadPoolExecutor(max_workers=HINT_PREFETCH_WORKERS, thread_name_prefix="hint")
+    try:
+        return _hint_executor.submit(get_hint, question, expected_answer, zpd_score, llm)
+    except RuntimeError as e:  # Executor shut down with the interpreter
+        print(f"⚠️ Could not prefetch hint: {e}")
+        return None
+
+def _answer_hint(question: str, expected_answer: str, zpd_score: float, llm, lazy: bool,
+                 graded_hint: str = "") -> Optional[str]:
+    """
+    Hint to return alongside a graded answer.
+
+    A hint that came with structured grading is cached and returned as is, since it cost nothing
+    extra. Otherwise, lazy mode returns None (callers fetch it with `get_hint` when the student
+    asks) and optionally prefetches it; eager mode generates it now.
+    """
+    if graded_hint:
+        hint = _trim_hint(graded_hint, zpd_score)
+        hint_cache.put(question, expected_answer, zpd_score, hint)
+        return hint
+    if not lazy:
+        return get_hint(question, expected_answer, zpd_score, llm)
+    if HINT_PREFETCH:
+        prefetch_hint(question, expected_answer, zpd_score, llm)
+    return None
+
+GRADING_VERDICTS = {"correct": 1.0, "partially correct": 0.5, "incorrect": 0.0}
+
+def _parse_grading(response: str) -> Optional[Dict[str, Any]]:
+    """Validates a structured grading reply; returns None if it is not usable JSON of the expected shape."""
+    start, end = response.find("{"), response.rfind("}")
+    if start == -1 or end <= start:
+        return None
+    try:
+        data = json.loads(response[start:end + 1])
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(data, dict) or not isinstance(data.get("relevant"), bool):
+        return None
+    verdict = str(data.get("verdict", "")).strip().lower().replace("_", " ")
+    if verdict not in GRADING_VERDICTS:
+        return None
+    try:
+        score = min(1.0, max(0.0, float(data.get("score", GRADING_VERDICTS[verdict]))))
+    except (TypeError, ValueError):
+        return None
+    if not data["relevant"]:
+        verdict, score = "incorrect", 0.0
+    return {
+        "relevant": data["relevant"],
+        "verdict": verdict,
+        "score": score,
+        "hint": str(data.get("hint") or "").strip(),
+        "feedback": str(data.get("feedback") or "").strip(),
+    }
+
+def _grade_answer_structured(question: str, student_answer: str, expected_answer: str, llm, zpd_score: float):
+    """
+    Grades an answer with one LLM call returning relevance, verdict, score, hint and feedback as JSON.
+
+    Replaces the relevance call, the verdict call and the separate hint call of the sequential
+    path. Returns None if the reply cannot be parsed, so the caller can fall back.
+    """
+    response = gated(llm).invoke(_structured_grading_messages(question, student_answer, expected_answer, zpd_score)).content
+    grading = _parse_grading(response)
+    if grading is None:
+        print("⚠️ Could not parse structured grading; falling back to sequential grading.")
+    return grading
+
+def _structured_grading_messages(question: str, student_answer: str, expected_answer: str, zpd_score: float) -> list:
+    # "feedback" comes before "hint" so that streamed replies reach the visible text early
+    hint_style, detail_level, guidance = _hint_style(zpd_score)
+    prompt = f"""Grade a student's answer to a history question.
+
+QUESTION: {question}
+EXPECTED ANSWER: {expected_answer}
+STUDENT'S ANSWER: {student_answer}
+
+INSTRUCTIONS:
+1. "relevant": true if the answer addresses the question at all, otherwise false.
+2. "verdict": one of "correct", "partially correct", "incorrect", judged against the expected answer.
+3. "score": a number from 0 to 1 (about 1 for correct, 0.5 for partially correct, 0 for incorrect).
+4. "feedback": one short, encouraging sentence on what the answer got right or missed.
+5. "hint": if the verdict is not "correct", a {hint_style}, {detail_level} hint of 1-2 sentences that
+   helps the student without giving away the answer. {guidance} Otherwise an empty string.
+
+Respond with ONLY a JSON object:
+{{"relevant": true, "verdict": "...", "score": 0.0, "feedback": "...", "hint": "..."}}"""
+    return [
+        SystemMessage(content="You are a history professor grading answers. You reply with JSON only."),
+        HumanMessage(content=prompt)
+    ]
+
+NOT_RELEVANT_FEEDBACK = "Your answer doesn't seem to address the question. Please focus on the specific topic being asked about."
+
+VERDICT_FEEDBACK = {
+    "correct": "✅ Correct! Your answer demonstrates good understanding of the topic.",
+    "partially correct": "⚠️ Partially correct. You're on the right track, but there's room for improvement.",
+    "incorrect": "❌ Incorrect. Let's review this concept together.",
+}
+
+def _grading_headline(grading: Dict[str, Any]) -> str:
+    """Fixed first part of the feedback for a structured verdict."""
+    return VERDICT_FEEDBACK[grading['verdict']] if grading['relevant'] else NOT_RELEVANT_FEEDBACK
+
+def _analysis_from_grading(grading: Dict[str, Any], question: str, expected_answer: str, llm, zpd_score: float,
+                           lazy_hints: bool) -> Dict[str, Any]:
+    is_correct = grading['verdict'] == 'correct'
+    feedback = _grading_headline(grading)
+    if grading['relevant'] and grading['feedback']:
+        feedback += " " + grading['feedback']
+    hint = None
+    if not is_correct:
+        hint = _answer_hint(question, expected_answer, zpd_score, llm, lazy_hints, grading['hint'])
+    return {
+        'is_correct': is_correct,
+        'partially_correct': grading['verdict'] == 'partially correct',
+        'relevant': grading['relevant'],
+        'score': grading['score'],
+        'feedback': feedback,
+        'hint': hint
+    }
+
+# --- Semantic Grading Cache ---
+GRADING_CACHE_FIELDS = ('is_correct', 'partially_correct', 'relevant', 'score', 'feedback')
+
+def normalize_answer(text: str) -> str:
+    """Lowercases, drops punctuation and collapses whitespace, so trivially different answers match exactly."""
+    return re.sub(r'\s+', ' ', re.sub(r'[^\w\s]', ' ', text.lower())).strip()
+
+_NEGATION = re.compile(r"\b(?:not|no|never|none|nor|neither|nothing|nobody|without|cannot)\b|\b\w+n t\b")
+
+def _answer_guard(normalized: str) -> Optional[str]:
+    """
+    Numbers and negations of a normalized answer, which a semantic hit must share exactly, or None
+    if the answer is too short to be matched by similarity at all. Embeddings barely separate
+    "in 1917" from "in 1918", or "was" from "was not", while they flip the verdict.
+    """
+    if len(normalized.split()) < GRADING_CACHE_MIN_WORDS:
+        return None
+    numbers = sorted(set(re.findall(r'\d+', normalized)))
+    negations = sorted("not" if match.endswith(" t") else match for match in _NEGATION.findall(normalized))
+    return f"{','.join(numbers)}|{','.join(negations)}"
+
+def _cached_verdict(analysis: Dict[str, Any]) -> Dict[str, Any]:
+    """The cacheable part of an analysis: the verdict, with only the fixed headline as feedback."""
+    verdict = {field: analysis.get(field) for field in GRADING_CACHE_FIELDS}
+    if not analysis.get('relevant'):
+        verdict['feedback'] = NOT_RELEVANT_FEEDBACK
+    elif analysis.get('is_correct'):
+        verdict['feedback'] = VERDICT_FEEDBACK["correct"]
+    elif analysis.get('partially_correct'):
+        verdict['feedback'] = VERDICT_FEEDBACK["partially correct"]
+    else:
+        verdict['feedback'] = VERDICT_FEEDBACK["incorrect"]
+    return verdict
+
+def _answer_vector(normalized: str, embeddings=None):
+    """Unit-length float32 embedding of a normalized answer (shared embedder by default)."""
+    import numpy as np
+
+    embeddings = embeddings or model_registry.get_embeddings()
+    vector = np.asarray(run_retrieval_work(embeddings.embed_documents, [normalized])[0], dtype=np.float32)
+    return vector / (np.linalg.norm(vector) or 1.0)
+
+class GradingCache:
+    """
+    Verdicts of graded answers per question, reused for repeated or near-identical answers.
+
+    Entries are keyed on (question id, embedding of the normalized answer). An answer whose cosine
+    similarity to one already graded for the same question reaches `threshold`, and that has the
+    same numbers and negations (see `_answer_guard`), gets that verdict without an LLM call; exact
+    repeats skip the embedding as well. Only the verdict and its fixed headline are stored, not the
+    LLM's feedback sentence, which was written about someone else's answer. The answers of recently asked
+    questions are held in memory (at most `max_size` answers, least recently used questions dropped
+    first) and backed by a SQLite table trimmed to `max_rows`, least recently used rows first.
+    Disk writes are amortised: hit counts are flushed in batches of `touch_batch` (or with the next
+    store), and the table is trimmed every `prune_every` stores, so it may briefly overshoot.
+    Hints are not stored, since they depend on the student's ZPD band; see `HintCache`.
+    """
+
+    def __init__(self, db_path: Path = GRADING_CACHE_PATH, threshold: float = GRADING_CACHE_THRESHOLD,
+                 max_size: int = GRADING_CACHE_SIZE, max_rows: int = GRADING_CACHE_MAX_ROWS,
+                 embeddings=None, model_name: str = EMBEDDING_MODEL_NAME, touch_batch: int = 64):
+        self.db_path = Path(db_path)
+        self.threshold = threshold
+        self.max_size = max(1, max_size)
+        self.max_rows = max_rows
+        self.touch_batch = max(1, touch_batch)
+        self.prune_every = max(1, max_rows // 20)
+        self.embeddings = embeddings  # Defaults to the shared embedder, loaded on first miss
+        self.model_name = model_name
+        # question id -> answer hash -> (unit-length float32 answer vector, verdict, semantic guard)
+        self._questions: "OrderedDict[str, Dict[str, Tuple[Any, Dict[str, Any], Optional[str]]]]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._touched: Dict[Tuple[str, str], int] = {}  # (question id, answer hash) -> hits not yet on disk
+        self._stores_since_prune = 0
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self._create_tables()
+
+    def _get_connection(self):
+        return sqlite3.connect(str(self.db_path))
+
+    def _create_tables(self):
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._get_connection() as conn:
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(graded_answers)")]
+            if columns and "guard" not in columns:
+                # Older rows hold per-answer LLM feedback and no guard; regrading them is cheaper than trusting them
+                print("Grading cache predates semantic guards; clearing it.")
+                conn.execute("DROP TABLE graded_answers")
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS graded_answers (
+                    model TEXT NOT NULL,
+                    question_id TEXT NOT NULL,
+                    answer_hash TEXT NOT NULL,
+                    embedding BLOB NOT NULL,  -- float32, unit length
+                    verdict TEXT NOT NULL,  -- JSON with GRADING_CACHE_FIELDS
+                    guard TEXT,  -- _answer_guard of the answer; NULL = exact hits only
+                    hits INTEGER DEFAULT 0,
+                    last_used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (model, question_id, answer_hash)
+                )
+            ''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_graded_answers_last_used ON graded_answers(last_used_at)")
+            conn.commit()
+
+    @staticmethod
+    def question_id(question: str, expected_answer: str) -> str:
+        """Grading depends on the expected answer as much as on the question, so both identify it."""
+        return _text_hash(f"{question}\x00{expected_answer}")
+
+    def _embed(self, normalized: str):
+        return _answer_vector(normalized, self.embeddings)
+
+    def _answers(self, question_id: str) -> Dict[str, Tuple[Any, Dict[str, Any], Optional[str]]]:
+        """Graded answers for a question, read from disk when it is not held in memory."""
+        with self._lock:
+            answers = self._questions.get(question_id)
+            if answers is not None:
+                self._questions.move_to_end(question_id)
+                return answers
+        with self._get_connection() as conn:
+            rows = conn.execute(
+                "SELECT answer_hash, embedding, verdict, guard FROM graded_answers WHERE model = ? AND question_id = ?",
+                (self.model_name, question_id)
+            ).fetchall()
+        import numpy as np
+
+        loaded = {answer_hash: (np.frombuffer(blob, dtype=np.float32), json.loads(verdict), guard)
+                  for answer_hash, blob, verdict, guard in rows}
+        with self._lock:
+            answers = self._questions.setdefault(question_id, loaded)  # Another thread may have loaded it meanwhile
+            if answers is loaded:
+                self._size += len(loaded)
+                self._evict(keep=question_id)
+            return answers
+
+    def _evict(self, keep: str) -> None:
+        while self._size > self.max_size and len(self._questions) > 1:
+            question_id, answers = next(iter(self._questions.items()))
+            if question_id == keep:
+                self._questions.move_to_end(question_id)
+                continue
+            del self._questions[question_id]
+            self._size -= len(answers)
+
+    def _touch(self, question_id: str, answer_hash: str) -> None:
+        """Counts a hit in memory; the disk row is updated once a batch has built up."""
+        with self._lock:
+            key = (question_id, answer_hash)
+            self._touched[key] = self._touched.get(key, 0) + 1
+            if len(self._touched) < self.touch_batch:
+                return
+            touched, self._touched = self._touched, {}
+        with self._get_connection() as conn:
+            self._flush_touches(conn, touched)
+            conn.commit()
+
+    def _flush_touches(self, conn, touched: Dict[Tuple[str, str], int]) -> None:
+        conn.executemany('''
+            UPDATE graded_answers SET hits = hits + ?, last_used_at = CURRENT_TIMESTAMP
+            WHERE model = ? AND question_id = ? AND answer_hash = ?
+        ''', [(hits, self.model_name, question_id, answer_hash)
+              for (question_id, answer_hash), hits in touched.items()])
+
+    def _prune(self, conn) -> None:
+        """Deletes the least recently used rows beyond max_rows."""
+        excess = conn.execute("SELECT COUNT(*) FROM graded_answers").fetchone()[0] - self.max_rows
+        if excess > 0:
+            conn.execute('''
+                DELETE FROM graded_answers WHERE rowid IN (
+                    SELECT rowid FROM graded_answers ORDER BY last_used_at, rowid LIMIT ?
+                )
+            ''', (excess,))
+
+    def lookup(self, question: str, expected_answer: str, answer: str) -> Tuple[Optional[Dict[str, Any]], Any]:
+        """
+        Returns (cached verdict or None, answer vector).
+
+        Pass the vector on to `store` after grading a miss, so the answer is not embedded twice.
+        """
+        question_id = self.question_id(question, expected_answer)
+        normalized = normalize_answer(answer)
+        answer_hash = _text_hash(normalized)
+        guard = _answer_guard(normalized)
+        answers = self._answers(question_id)
+        with self._lock:
+            entry = answers.get(answer_hash)
+            if entry is not None:
+                self.hits += 1
+            elif guard is not None:
+                candidates = [(candidate_hash, candidate) for candidate_hash, candidate in answers.items()
+                              if candidate[2] == guard]
+            else:
+                candidates = []
+        if entry is not None:
+            self._touch(question_id, answer_hash)
+            return dict(entry[1]), entry[0]
+
+        vector = self._embed(normalized)
+        if candidates:
+            import numpy as np
+
+            similarities = np.stack([candidate[0] for _, candidate in candidates]) @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.threshold:
+                best_hash, (_, verdict, _) = candidates[best]
+                with self._lock:
+                    self.semantic_hits += 1
+                self._touch(question_id, best_hash)
+                return dict(verdict), vector
+        with self._lock:
+            self.misses += 1
+        return None, vector
+
+    def store(self, question: str, expected_answer: str, answer: str, vector,
+              analysis: Dict[str, Any]) -> None:
+        """Remembers the verdict for an answer graded after a `lookup` miss."""
+        question_id = self.question_id(question, expected_answer)
+        normalized = normalize_answer(answer)
+        answer_hash = _text_hash(normalized)
+        guard = _answer_guard(normalized)
+        verdict = _cached_verdict(analysis)
+        with self._lock:
+            answers = self._questions.get(question_id)
+            if answers is not None:  # Otherwise the next lookup reads it back from disk
+                if answer_hash not in answers:
+                    self._size += 1
+                answers[answer_hash] = (vector, verdict, guard)
+                self._questions.move_to_end(question_id)
+                self._evict(keep=question_id)
+            # Pending hits ride along with this write, so pruning sees up-to-date recency
+            touched, self._touched = self._touched, {}
+            self._stores_since_prune += 1
+            prune = self._stores_since_prune >= self.prune_every
+            if prune:
+                self._stores_since_prune = 0
+        with self._get_connection() as conn:
+            conn.execute('''
+                INSERT OR REPLACE INTO graded_answers (model, question_id, answer_hash, embedding, verdict, guard)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (self.model_name, question_id, answer_hash, vector.tobytes(), json.dumps(verdict), guard))
+            if touched:
+                self._flush_touches(conn, touched)
+            if prune:
+                self._prune(conn)
+            conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        """Exact/semantic hit counters for the grading cache."""
+        with self._lock:
+            lookups = self.hits + self.semantic_hits + self.misses
+            return {
+                "model": self.model_name,
+                "threshold": self.threshold,
+                "questions": len(self._questions),
+                "size": self._size,
+                "capacity": self.max_size,
+                "hits": self.hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.semantic_hits) / lookups if lookups else 0.0,
+            }
+
+_grading_cache = None
+_grading_cache_lock = threading.Lock()
+
+def get_grading_cache() -> GradingCache:
+    """Returns the process-wide grading cache, opening its SQLite file on first use."""
+    global _grading_cache
+    with _grading_cache_lock:
+        if _grading_cache is None:
+            _grading_cache = GradingCache()
+        return _grading_cache
 
-def analyze_student_answer(question: str, student_answer: str, expected_answer: str, llm, zpd_score: float):
+# --- Tiered Local Grading ---
+def local_verdict(similarity: float, cross_score: Optional[float], relevance_threshold: float,
+                  correct_threshold: float, incorrect_threshold: float) -> Optional[str]:
+    """"off-topic", "correct" or "incorrect" for a clear-cut answer; None when the LLM must decide."""
+    if similarity < relevance_threshold:
+        return "off-topic"
+    if cross_score is None:
+        return None
+    if cross_score >= correct_threshold:
+        return "correct"
+    if cross_score <= incorrect_threshold:
+        return "incorrect"
+    return None
+
+class LocalGrader:
+    """
+    Grades clear-cut answers with the BGE embedder and cross-encoder already loaded for retrieval.
+
+    1. Relevance: an answer whose embedding's cosine similarity to the expected answer's is below
+       `relevance_threshold` is off-topic.
+    2. Verdict: the cross-encoder scores the (expected answer, answer) pair; at or above
+       `correct_threshold` the answer is correct, at or below `incorrect_threshold` incorrect.
+    3. Anything in between is left to the LLM, the only grader that awards partial credit.
+
+    Thresholds should come from grader_calibration.py run on a labelled answer set. Expected
+    answer vectors are kept in a small LRU, since every student answering a question shares one.
+    """
+
+    def __init__(self, relevance_threshold: float = LOCAL_GRADING_RELEVANCE,
+                 correct_threshold: float = LOCAL_GRADING_CORRECT,
+                 incorrect_threshold: float = LOCAL_GRADING_INCORRECT,
+                 embeddings=None, cross_encoder=None, max_expected: int = 1024):
+        self.relevance_threshold = relevance_threshold
+        self.correct_threshold = correct_threshold
+        self.incorrect_threshold = incorrect_threshold
+        self.embeddings = embeddings  # Default to the shared models, loaded on first use
+        self.cross_encoder = cross_encoder
+        self.max_expected = max(1, max_expected)
+        self._expected: "OrderedDict[str, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.counts = {"off-topic": 0, "correct": 0, "incorrect": 0, "escalated": 0}
+
+    def similarity(self, expected_answer: str, answer: str, vector=None) -> float:
+        """Cosine similarity of the answers; `vector` is the answer's, if `GradingCache.lookup` embedded it."""
+        normalized = normalize_answer(expected_answer)
+        with self._lock:
+            expected = self._expected.get(normalized)
+            if expected is not None:
+                self._expected.move_to_end(normalized)
+        if expected is None:
+            expected = _answer_vector(normalized, self.embeddings)
+            with self._lock:
+                self._expected[normalized] = expected
+                while len(self._expected) > self.max_expected:
+                    self._expected.popitem(last=False)
+        if vector is None:
+            vector = _answer_vector(normalize_answer(answer), self.embeddings)
+        return float(expected @ vector)
+
+    def cross_score(self, expected_answer: str, answer: str) -> float:
+        # Uncached: every student answer is a new pair, so it would only churn the rerank cache
+        cross_encoder = self.cross_encoder or model_registry.get_scoring_cross_encoder()
+        return float(run_retrieval_work(cross_encoder.score, [(expected_answer, answer)])[0])
+
+    def grade(self, expected_answer: str, answer: str, vector=None) -> Optional[Dict[str, Any]]:
+        """Analysis fields for a clear-cut answer (without 'hint'), or None to escalate to the LLM."""
+        similarity = self.similarity(expected_answer, answer, vector)
+        cross_score = None
+        if similarity >= self.relevance_threshold:
+            cross_score = self.cross_score(expected_answer, answer)
+        verdict = local_verdict(similarity, cross_score, self.relevance_threshold,
+                                self.correct_threshold, self.incorrect_threshold)
+        with self._lock:
+            self.counts[verdict or "escalated"] += 1
+        if verdict is None:
+            return None
+        return {
+            'is_correct': verdict == "correct",
+            'partially_correct': False,
+            'relevant': verdict != "off-topic",
+            'score': 1.0 if verdict == "correct" else 0.0,
+            'feedback': VERDICT_FEEDBACK[verdict] if verdict != "off-topic" else NOT_RELEVANT_FEEDBACK,
+            'graded_locally': True,
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            graded = sum(self.counts.values())
+            return {
+                "thresholds": {"relevance": self.relevance_threshold, "correct": self.correct_threshold,
+                               "incorrect": self.incorrect_threshold},
+                **self.counts,
+                "local_rate": (graded - self.counts["escalated"]) / graded if graded else 0.0,
+            }
+
+_local_grader = None
+_local_grader_lock = threading.Lock()
+
+def get_local_grader() -> LocalGrader:
+    """Returns the process-wide local grader."""
+    global _local_grader
+    with _local_grader_lock:
+        if _local_grader is None:
+            _local_grader = LocalGrader()
+        return _local_grader
+
+def _local_analysis(question: str, student_answer: str, expected_answer: str, llm, zpd_score: float,
+                    lazy_hints: bool, vector) -> Optional[Dict[str, Any]]:
+    """`LocalGrader` verdict as a full analysis, or None when the answer needs the LLM."""
+    try:
+        analysis = get_local_grader().grade(expected_answer, student_answer, vector)
+    except Exception as e:  # e.g. RetrievalBusyError while scoring the answer
+        print(f"⚠️ Local grading unavailable: {e}")
+        return None
+    if analysis is not None:
+        analysis['hint'] = None if analysis['is_correct'] else _answer_hint(question, expected_answer, zpd_score,
+                                                                            llm, lazy_hints)
+    return analysis
+
+def analyze_student_answer(question: str, student_answer: str, expected_answer: str, llm, zpd_score: float,
+                           structured: bool = STRUCTURED_GRADING, lazy_hints: bool = LAZY_HINTS,
+                           use_cache: bool = GRADING_CACHE, local: bool = LOCAL_GRADING):
     """
     Analyzes the student's answer and evaluates its correctness.
     
@@ -508,25 +2646,74 @@ def analyze_student_answer(question: str, student_answer: str, expected_answer:
         expected_answer: The expected answer
         llm: The language model to use
         zpd_score: The student's ZPD score (1.0-10.0)
+        structured: Grade with a single JSON call (see `_grade_answer_structured`), falling back
+            to the sequential relevance/verdict/hint calls if its reply cannot be parsed
+        lazy_hints: Skip the separate hint call; 'hint' is None unless grading produced one,
+            and callers fetch it with `get_hint` when the student asks
+        use_cache: Reuse the verdict of a near-identical answer to the same question (see `GradingCache`)
+        local: Grade clear-cut answers with the local models (see `LocalGrader`); only the
+            ambiguous ones reach the LLM
     """
+    cached, vector = _cached_analysis(question, student_answer, expected_answer, llm, zpd_score, lazy_hints) \
+        if use_cache else (None, None)
+    if cached is not None:
+        return cached
+    analysis = _local_analysis(question, student_answer, expected_answer, llm, zpd_score, lazy_hints, vector) \
+        if local else None
+    if analysis is None:
+        analysis = _evaluate_answer(question, student_answer, expected_answer, llm, zpd_score, structured, lazy_hints)
+    _remember_analysis(question, student_answer, expected_answer, vector, analysis)
+    return analysis
+
+def _cached_analysis(question: str, student_answer: str, expected_answer: str, llm, zpd_score: float,
+                     lazy_hints: bool) -> Tuple[Optional[Dict[str, Any]], Any]:
+    """Grading-cache lookup; returns (analysis or None, answer vector for `_remember_analysis`)."""
+    try:
+        cached, vector = get_grading_cache().lookup(question, expected_answer, student_answer)
+    except Exception as e:  # e.g. RetrievalBusyError while embedding the answer
+        print(f"⚠️ Grading cache unavailable: {e}")
+        return None, None
+    if cached is not None:
+        cached['hint'] = None if cached['is_correct'] else _answer_hint(question, expected_answer, zpd_score, llm, lazy_hints)
+        cached['cached'] = True
+    return cached, vector
+
+def _remember_analysis(question: str, student_answer: str, expected_answer: str, vector, analysis: Dict[str, Any]) -> None:
+    if vector is None or 'relevant' not in analysis:  # Error results carry no verdict worth keeping
+        return
+    try:
+        get_grading_cache().store(question, expected_answer, student_answer, vector, analysis)
+    except sqlite3.Error as e:
+        print(f"⚠️ Could not cache grading: {e}")
+
+def _evaluate_answer(question: str, student_answer: str, expected_answer: str, llm, zpd_score: float,
+                     structured: bool, lazy_hints: bool) -> Dict[str, Any]:
+    """Grades an answer with the LLM; see `analyze_student_answer`."""
     try:
+        grading = _grade_answer_structured(question, student_answer, expected_answer, llm, zpd_score) if structured else None
+        if grading is not None:
+            return _analysis_from_grading(grading, question, expected_answer, llm, zpd_score, lazy_hints)
+
         # First, check if the answer is relevant
         prompt = f"""Is this answer relevant to the question? Answer ONLY 'yes' or 'no'.
         
         Question: {question}
         Answer: {student_answer}"""
         
-        response = llm.invoke([
+        response = gated(llm).invoke([
             SystemMessage(content="You are a history professor evaluating answer relevance."),
             HumanMessage(content=prompt)
         ]).content.strip().lower()
         
-        if 'no' in response:
+        # Match "no" as a word: a substring test also fires on "not", "know", "none" and the like
+        if re.match(r"^\W*no\b", response):
             return {
                 'is_correct': False,
-                'feedback': "Your answer doesn't seem to address the question. Please focus on the specific topic being asked about.",
+                'partially_correct': False,
+                'relevant': False,
+                'feedback': NOT_RELEVANT_FEEDBACK,
                 'score': 0.0,
-                'hint': generate_hint(question, expected_answer, zpd_score, llm)
+                'hint': _answer_hint(question, expected_answer, zpd_score, llm, lazy_hints)
             }
         
         # If relevant, evaluate correctness
@@ -538,7 +2725,7 @@ def analyze_student_answer(question: str, student_answer: str, expected_answer:
         
         Respond with ONLY one of: correct, partially correct, incorrect"""
         
-        evaluation = llm.invoke([
+        evaluation = gated(llm).invoke([
             SystemMessage(content="You are a history professor evaluating answer correctness."),
             HumanMessage(content=prompt)
         ]).content.strip().lower()
@@ -549,24 +2736,28 @@ def analyze_student_answer(question: str, student_answer: str, expected_answer:
         
         # Generate appropriate feedback
         if is_correct:
-            feedback = "✅ Correct! Your answer demonstrates good understanding of the topic."
+            feedback = VERDICT_FEEDBACK["correct"]
         elif is_partial:
-            feedback = "⚠️ Partially correct. You're on the right track, but there's room for improvement."
+            feedback = VERDICT_FEEDBACK["partially correct"]
         else:
-            feedback = "❌ Incorrect. Let's review this concept together."
+            feedback = VERDICT_FEEDBACK["incorrect"]
         
         # Generate hint if answer isn't fully correct
         hint = None
         if not is_correct:
-            hint = generate_hint(question, expected_answer, zpd_score, llm)
+            hint = _answer_hint(question, expected_answer, zpd_score, llm, lazy_hints)
         
         return {
             'is_correct': is_correct,
+            'partially_correct': is_partial,
+            'relevant': True,
             'score': score,
             'feedback': feedback,
             'hint': hint
         }
             
+    except LLMBusyError:
+        raise  # Not the student's fault: the API answers 503 instead of grading the answer wrong
     except Exception as e:
         print(f"Error in analyze_student_answer: {e}")
         return {
@@ -576,7 +2767,37 @@ def analyze_student_answer(question: str, student_answer: str, expected_answer:
             'hint': "Consider rephrasing your answer or providing more details."
         }
 
-def get_feedback_on_answer(user_answer: str, expected_answer: str, question: str, llm, context: str = "", zpd_score: float = 2.5):   
+def _closing_note(is_correct: bool) -> str:
+    if is_correct:
+        return "\nGreat job! You've demonstrated good understanding of the topic."
+    return "\nTake a moment to review the material and try again. You can do it!"
+
+def _feedback_message(analysis: Dict[str, Any]) -> str:
+    """Feedback shown to the student: the grading feedback plus a closing note."""
+    # Hints are shown separately, on request
+    return "\n".join([analysis['feedback'], _closing_note(analysis['is_correct'])])
+
+def _precheck_answer(user_answer: str, expected_answer: str, question: str, llm, zpd_score: float,
+                     lazy_hints: bool) -> Optional[Tuple[str, bool, Dict[str, Any]]]:
+    """(feedback, is_correct, analysis) for answers that need no grading, otherwise None."""
+    # Check if expected answer is present
+    if not expected_answer:
+        return (
+            "I don't have an expected answer for this question. Please try again.",
+            False,
+            {'hint': "Consider asking a different question"}
+        )
+    # Check if answer is too short
+    if len(user_answer.split()) < 3:
+        return (
+            "Your answer seems quite brief. Could you elaborate more? Try to explain your thinking in more detail.",
+            False,
+            {'hint': _answer_hint(question, expected_answer, zpd_score, llm, lazy_hints)}
+        )
+    return None
+
+def get_feedback_on_answer(user_answer: str, expected_answer: str, question: str, llm, context: str = "", zpd_score: float = 2.5,
+                           lazy_hints: bool = LAZY_HINTS):   
     """
     Evaluates the user's answer and provides feedback with ZPD-based hints.
     
@@ -586,45 +2807,25 @@ def get_feedback_on_answer(user_answer: str, expected_answer: str, question: str
         question: The question that was asked
         llm: The language model to use
         zpd_score: The student's ZPD score (1.0-10.0)
+        lazy_hints: Leave 'hint' as None for `get_hint` to fill in on demand (see `analyze_student_answer`)
     """
     try:
-        # Check if expected answer is present
-        if not expected_answer:
-            return (
-                "I don't have an expected answer for this question. Please try again.",
-                False,
-                {'hint': "Consider asking a different question"}
-            )
-        # Check if answer is too short
-        if len(user_answer.split()) < 3:
-            return (
-                "Your answer seems quite brief. Could you elaborate more? Try to explain your thinking in more detail.",
-                False,
-                {'hint': generate_hint(question, expected_answer, zpd_score, llm)}
-            )
+        early = _precheck_answer(user_answer, expected_answer, question, llm, zpd_score, lazy_hints)
+        if early:
+            return early
         
         # Analyze the answer
-        analysis = analyze_student_answer(question, user_answer, expected_answer, llm, zpd_score)
-        
-        # Build feedback message
-        feedback_parts = [analysis['feedback']]
-        
-        # Add hint if available and answer isn't correct
-        # if analysis.get('hint') and not analysis['is_correct']:
-        #     feedback_parts.append(f"\nHint: {analysis['hint']}")
-        
-        # Add closing note
-        if analysis['is_correct']:
-            feedback_parts.append("\nGreat job! You've demonstrated good understanding of the topic.")
-        else:
-            feedback_parts.append("\nTake a moment to review the material and try again. You can do it!")
+        analysis = analyze_student_answer(question, user_answer, expected_answer, llm, zpd_score,
+                                          lazy_hints=lazy_hints)
         
         return (
-            "\n".join(feedback_parts),
+            _feedback_message(analysis),
             analysis['is_correct'],
             analysis
         )
             
+    except LLMBusyError:
+        raise  # Not the student's fault: the API answers 503 instead of grading the answer wrong
     except Exception as e:
         print(f"Error in get_feedback_on_answer: {e}")
         return (
@@ -634,6 +2835,345 @@ def get_feedback_on_answer(user_answer: str, expected_answer: str, question: str
         )
 
 
+# --- Streaming ---
+class StreamLatencyStats:
+    """Time to first visible text and to completion of streamed responses, per kind of response."""
+
+    def __init__(self, max_samples: int = 1000):
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self._samples: Dict[str, List[Tuple[float, float]]] = {}
+
+    def record(self, kind: str, first_visible_s: float, total_s: float) -> None:
+        with self._lock:
+            samples = self._samples.setdefault(kind, [])
+            samples.append((first_visible_s, total_s))
+            del samples[:-self.max_samples]  # Recent samples only
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            report = {}
+            for kind, samples in self._samples.items():
+                first = sorted(sample[0] for sample in samples)
+                total = sorted(sample[1] for sample in samples)
+                report[kind] = {
+                    "count": len(samples),
+                    "first_visible_p50_s": first[len(first) // 2],
+                    "first_visible_mean_s": sum(first) / len(first),
+                    "total_p50_s": total[len(total) // 2],
+                    "total_mean_s": sum(total) / len(total),
+                }
+            return report
+
+stream_latency_stats = StreamLatencyStats()
+
+class _StreamTimer:
+    """Measures one streamed response; `finish` records it in `stream_latency_stats`."""
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.started = time.perf_counter()
+        self.first_visible_s = None
+
+    def visible(self) -> None:
+        if self.first_visible_s is None:
+            self.first_visible_s = time.perf_counter() - self.started
+
+    def finish(self) -> Dict[str, float]:
+        total_s = time.perf_counter() - self.started
+        first_visible_s = total_s if self.first_visible_s is None else self.first_visible_s
+        stream_latency_stats.record(self.kind, first_visible_s, total_s)
+        return {"first_visible_s": first_visible_s, "total_s": total_s}
+
+class QuestionStreamParser:
+    """
+    Incremental parser for streamed "QUESTION: ... ANSWER: ..." replies.
+
+    `feed` returns the question text that became visible with each chunk. A tail that could be the
+    start of the "ANSWER:" marker is held back until the next chunk settles it. Once the marker
+    arrives, `question` holds the complete question and `answer` the answer streamed so far.
+    """
+    QUESTION_MARKER = "QUESTION:"
+    ANSWER_MARKER = "ANSWER:"
+
+    def __init__(self):
+        self.buffer = ""
+        self.question: Optional[str] = None
+        self._emitted = 0
+
+    def feed(self, text: str) -> str:
+        self.buffer += text
+        if self.question is not None:
+            return ""
+        start = self.buffer.find(self.QUESTION_MARKER)
+        if start == -1:
+            return ""
+        start += len(self.QUESTION_MARKER)
+        end = self.buffer.find(self.ANSWER_MARKER, start)
+        if end == -1:
+            visible = self.buffer[start:max(start, len(self.buffer) - len(self.ANSWER_MARKER) + 1)]
+        else:
+            visible = self.buffer[start:end].rstrip()
+            self.question = visible.strip()
+        visible = visible.lstrip()
+        delta = visible[self._emitted:]
+        self._emitted = max(self._emitted, len(visible))
+        return delta
+
+    @property
+    def answer(self) -> str:
+        if self.question is None:
+            return ""
+        return self.buffer.split(self.ANSWER_MARKER, 1)[1].strip()
+
+def stream_question_with_sources(retriever, llm, zpd_score: float, selected_chapter_title: str,
+                                 previous_questions: set = None, student_id: str = None, max_attempts: int = 5,
+                                 candidates: int = QUESTION_CANDIDATES):
+    """
+    Streaming form of `generate_question_with_sources`; yields events as the reply arrives:
+
+    - {"event": "question_delta", "text": ...}   more of the question
+    - {"event": "retry"}   the question streamed so far was unusable (e.g. a repeat); discard it
+    - {"event": "question", "question": ..., "difficulty": ...}   the complete question, sent while
+      the expected answer is still being generated
+    - {"event": "done", "question": ..., "answer": ..., "difficulty": ..., "source_docs": [...],
+      "timing": {"first_visible_s": ..., "total_s": ...}}
+
+    Generation follows `generate_question_with_sources`: a spare candidate for `student_id` is
+    served at once; otherwise, with `candidates` > 1, the JSON candidate call is streamed, showing
+    the first candidate's question as it arrives, and the unused candidates are kept as spares.
+    Only if that yields nothing usable does each fallback attempt stream one question, stopping
+    as soon as a completed question turns out to be a repeat.
+    """
+    if previous_questions is None:
+        previous_questions = set()
+    timer = _StreamTimer("question")
+    difficulty = difficulty_band(zpd_score)
+
+    from fuzzywuzzy import fuzz  # For string matching: https://github.com/seatgeek/fuzzywuzzy
+
+    def is_new(question: str) -> bool:
+        return _is_new_question(question, previous_questions, fuzz)
+
+    def done(question: str, answer: str, source_docs: list) -> Dict[str, Any]:
+        return {"event": "done", "question": question, "answer": answer, "difficulty": difficulty,
+                "source_docs": source_docs, "timing": timer.finish()}
+
+    spare = _take_spare_question(student_id, selected_chapter_title, difficulty, is_new, previous_questions)
+    if spare:
+        timer.visible()
+        yield {"event": "question", "question": spare[0], "difficulty": difficulty}
+        yield done(*spare)
+        return
+
+    if candidates > 1:
+        print(f"\nStreaming {candidates} {difficulty}-level candidate questions from {selected_chapter_title}...")
+        shown = False
+        try:
+            focus_aspect = random.choice(CONTENT_ASPECTS)
+            filtered_docs = _chapter_context_docs(retriever, selected_chapter_title, focus_aspect)
+            if filtered_docs:
+                context, filtered_docs = pack_context(filtered_docs, CONTEXT_TOKEN_BUDGET, CHAT_MODEL_NAME)
+                messages = _question_candidates_messages(context, selected_chapter_title, focus_aspect, difficulty,
+                                                         DIFFICULTY_INSTRUCTIONS[difficulty], QUESTION_TYPES,
+                                                         candidates)
+                response, visible, first = "", "", None
+                for chunk in gated(llm).stream(messages):
+                    response += chunk.content
+                    if first is not None:
+                        continue  # The rest of the array is the answer and the spares
+                    text, complete = _partial_json_string(response, "question")
+                    if text and len(text) > len(visible):
+                        timer.visible()
+                        shown = True
+                        yield {"event": "question_delta", "text": text[len(visible):]}
+                        visible = text
+                    if complete:
+                        first = _normalize_question(text)
+                        if text.strip() and is_new(first):
+                            yield {"event": "question", "question": first, "difficulty": difficulty}
+                accepted, spares = _select_candidate(_parse_question_candidates(response), is_new, fuzz,
+                                                     filtered_docs)
+                if accepted:
+                    if accepted[0] != first:  # The streamed candidate was a repeat; a later one is used
+                        if shown:
+                            yield {"event": "retry"}
+                        timer.visible()
+                        yield {"event": "question", "question": accepted[0], "difficulty": difficulty}
+                    previous_questions.add(accepted[0])
+                    if student_id is not None:
+                        spare_questions.put(student_id, selected_chapter_title, difficulty, spares)
+                    yield done(accepted[0], accepted[1], filtered_docs)
+                    return
+                print("No usable candidate in the batch, falling back to sequential attempts...")
+        except (RetrievalBusyError, LLMBusyError):
+            raise  # Saturated retrieval pool or LLM queue: let the API answer 503 instead of retrying
+        except Exception as e:
+            print(f"❌ Error streaming candidate questions: {e}")
+        if shown:
+            yield {"event": "retry"}
+
+    for attempt in range(1, max_attempts + 1):
+        print(f"\nStreaming a {difficulty}-level question from {selected_chapter_title} (Attempt {attempt}/{max_attempts})...")
+        shown = False
+        try:
+            focus_aspect = random.choice(CONTENT_ASPECTS)
+            filtered_docs = _chapter_context_docs(retriever, selected_chapter_title, focus_aspect)
+            if not filtered_docs:
+                continue
+            context, filtered_docs = pack_context(filtered_docs, CONTEXT_TOKEN_BUDGET, CHAT_MODEL_NAME)
+            messages = _single_question_messages(context, selected_chapter_title, focus_aspect, difficulty,
+                                                 DIFFICULTY_INSTRUCTIONS[difficulty], random.choice(QUESTION_TYPES))
+            parser = QuestionStreamParser()
+            question = None
+            for chunk in gated(llm).stream(messages):
+                delta = parser.feed(chunk.content)
+                if delta:
+                    timer.visible()
+                    shown = True
+                    yield {"event": "question_delta", "text": delta}
+                if question is None and parser.question is not None:
+                    question = _normalize_question(parser.question)
+                    if not is_new(question):
+                        break  # No need to pay for the rest of the reply
+                    yield {"event": "question", "question": question, "difficulty": difficulty}
+            if question is not None and is_new(question) and parser.answer:
+                previous_questions.add(question)
+                yield done(question, parser.answer, filtered_docs)
+                return
+            print("Generated a similar or malformed question, trying again...")
+        except (RetrievalBusyError, LLMBusyError):
+            raise  # Saturated retrieval pool or LLM queue: let the API answer 503 instead of retrying
+        except Exception as e:
+            print(f"❌ Error streaming question: {e}")
+        if shown:
+            yield {"event": "retry"}
+
+    question, answer, _ = _default_question(selected_chapter_title, difficulty)
+    timer.visible()
+    yield {"event": "question", "question": question, "difficulty": difficulty}
+    yield done(question, answer, [])
+
+_JSON_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+def _partial_json_string(text: str, key: str) -> Tuple[Optional[str], bool]:
+    """Decoded value of a string field in a JSON object that is still streaming, and whether it is complete."""
+    match = re.search(r'"%s"\s*:\s*"' % re.escape(key), text)
+    if not match:
+        return None, False
+    chars = []
+    i = match.end()
+    while i < len(text):
+        char = text[i]
+        if char == '"':
+            return "".join(chars), True
+        if char == '\\':
+            if i + 1 >= len(text):
+                break  # Escape split across chunks
+            escape = text[i + 1]
+            if escape == 'u':
+                if i + 6 > len(text):
+                    break
+                try:
+                    chars.append(chr(int(text[i + 2:i + 6], 16)))
+                except ValueError:
+                    pass
+                i += 6
+                continue
+            chars.append(_JSON_ESCAPES.get(escape, escape))
+            i += 2
+            continue
+        chars.append(char)
+        i += 1
+    return "".join(chars), False
+
+def _partial_grading(text: str) -> Optional[Dict[str, Any]]:
+    """Relevance and verdict from a streaming structured grading reply, once both have arrived."""
+    relevant = re.search(r'"relevant"\s*:\s*(true|false)', text)
+    verdict = re.search(r'"verdict"\s*:\s*"([^"]*)"', text)
+    if not relevant or not verdict:
+        return None
+    verdict = verdict.group(1).strip().lower().replace("_", " ")
+    if verdict not in GRADING_VERDICTS:
+        return None
+    if relevant.group(1) == "false":
+        return {"relevant": False, "verdict": "incorrect"}
+    return {"relevant": True, "verdict": verdict}
+
+def _stream_structured_analysis(question: str, student_answer: str, expected_answer: str, llm, zpd_score: float,
+                                lazy_hints: bool, timer: _StreamTimer):
+    """Yields feedback deltas of a streamed structured grading; returns the analysis."""
+    response = ""
+    headline = None
+    emitted = 0
+    for chunk in gated(llm).stream(_structured_grading_messages(question, student_answer, expected_answer, zpd_score)):
+        response += chunk.content
+        if headline is None:
+            partial = _partial_grading(response)
+            if partial is None:
+                continue
+            headline = _grading_headline(partial)
+            timer.visible()
+            yield {"event": "feedback_delta", "text": headline}
+            if not partial["relevant"]:
+                emitted = None  # The model's feedback is not shown for irrelevant answers
+        if emitted is not None:
+            feedback, _ = _partial_json_string(response, "feedback")
+            feedback = (feedback or "").lstrip()
+            if len(feedback) > emitted:
+                yield {"event": "feedback_delta", "text": ("" if emitted else " ") + feedback[emitted:]}
+                emitted = len(feedback)
+    grading = _parse_grading(response)
+    if grading is None:
+        print("⚠️ Could not parse streamed grading; falling back to sequential grading.")
+        return _evaluate_answer(question, student_answer, expected_answer, llm, zpd_score, False, lazy_hints)
+    return _analysis_from_grading(grading, question, expected_answer, llm, zpd_score, lazy_hints)
+
+def stream_feedback_on_answer(user_answer: str, expected_answer: str, question: str, llm, zpd_score: float = 2.5,
+                              lazy_hints: bool = LAZY_HINTS, structured: bool = STRUCTURED_GRADING,
+                              use_cache: bool = GRADING_CACHE, local: bool = LOCAL_GRADING):
+    """
+    Streaming form of `get_feedback_on_answer`; yields events as the grading reply arrives:
+
+    - {"event": "feedback_delta", "text": ...}   more feedback, starting with the verdict line
+    - {"event": "result", "feedback": ..., "correct": ..., "analysis": {...}, "timing": {...}}
+
+    The result carries the complete feedback message, so clients replace the streamed preview
+    with it. Answers that need no grading, grading-cache hits, locally graded answers and
+    sequential (non-structured) grading produce only the result.
+    """
+    timer = _StreamTimer("feedback")
+
+    def result(feedback: str, correct: bool, analysis: Dict[str, Any]) -> Dict[str, Any]:
+        timer.visible()
+        return {"event": "result", "feedback": feedback, "correct": correct, "analysis": analysis,
+                "timing": timer.finish()}
+
+    try:
+        early = _precheck_answer(user_answer, expected_answer, question, llm, zpd_score, lazy_hints)
+        if early:
+            yield result(*early)
+            return
+        analysis, vector = _cached_analysis(question, user_answer, expected_answer, llm, zpd_score, lazy_hints) \
+            if use_cache else (None, None)
+        if analysis is None:
+            analysis = _local_analysis(question, user_answer, expected_answer, llm, zpd_score, lazy_hints, vector) \
+                if local else None
+            if analysis is None and structured:
+                analysis = yield from _stream_structured_analysis(question, user_answer, expected_answer, llm,
+                                                                  zpd_score, lazy_hints, timer)
+            elif analysis is None:
+                analysis = _evaluate_answer(question, user_answer, expected_answer, llm, zpd_score, False, lazy_hints)
+            _remember_analysis(question, user_answer, expected_answer, vector, analysis)
+        yield result(_feedback_message(analysis), analysis['is_correct'], analysis)
+    except LLMBusyError:
+        raise  # Not the student's fault: the API answers 503 instead of grading the answer wrong
+    except Exception as e:
+        print(f"Error in stream_feedback_on_answer: {e}")
+        yield result("I had trouble evaluating your response. Please try rephrasing your answer.", False,
+                     {'hint': "Consider providing more specific details in your answer."})
+
+
 # --- Main Application Logic ---
 def main():
     """Main function to run the RAG system."""
@@ -668,16 +3208,13 @@ def main():
         print("Vector store not found. Starting the data ingestion process...")
         documents = extract_text_with_metadata(PDF_PATH, chapter_map_data)
         chunks = split_documents(documents)
-        create_and_save_vectorstore(chunks)
+        create_and_save_vectorstore(chunks, pages=documents)
     else:
         print("Existing vector store found. Skipping ingestion.")
         
-    embeddings_model = HuggingFaceBgeEmbeddings(
-        model_name="BAAI/bge-base-en-v1.5", model_kwargs={'device': 'cpu'}, encode_kwargs={'normalize_embeddings': True},
-        query_instruction="Represent this sentence for searching relevant passages:"
-    )
+    embeddings_model = model_registry.get_embeddings()
     
-    llm = ChatOpenAI(model_name="gpt-4.1-nano", temperature=0.7, max_tokens=1500)
+    llm = model_registry.get_chat_model()
 
     print("\nAvailable Chapters:")
     print("0. All Chapters (Quiz Mode - questions from entire document)")
@@ -793,7 +3330,8 @@ def main():
                     
                     if not is_correct: # For both partially_correct and wrong answers
                         if input("\nWould you like a hint? (yes/no): ").lower().strip() == 'yes':
-                            print(f"\n💡 Hint: {analysis['hint']}")
+                            hint = analysis.get('hint') or get_hint(generated_question, expected_answer, current_zpd, llm)
+                            print(f"\n💡 Hint: {hint}")
                         
                         if input("\nWould you like to see the full answer? (yes/no): ").lower().strip() == 'yes':
                             print(f"\nThe full correct answer is: {expected_answer}")
@@ -815,7 +3353,7 @@ def main():
                     Answer: [your answer here]"""
                     
                     # Get the response
-                    response = llm.invoke([
+                    response = gated(llm).invoke([
                         SystemMessage(content="You are a helpful history tutor."),
                         HumanMessage(content=simple_prompt)
                     ]).content
@@ -875,7 +3413,8 @@ def main():
                         
                         if not is_correct: # For both partially_correct and wrong answers
                             if input("\nWould you like a hint? (yes/no): ").lower().strip() == 'yes':
-                                print(f"\nHint: {analysis['hint']}")
+                                hint = analysis.get('hint') or get_hint(generated_question, expected_answer, 2.5, llm)
+                                print(f"\nHint: {hint}")
                             
                             if input("\nWould you like to see the full answer? (yes/no): ").lower().strip() == 'yes':
                                 print(f"\nThe full correct answer is: {expected_answer}")
@@ -890,5 +3429,9 @@ def main():
             break
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--reindex":
+        # Incremental rebuild: only new or changed chunks are re-embedded
+        update_vectorstore(PDF_PATH, load_chapter_map(CHAPTER_MAP_PATH))
+        sys.exit(0)
     main()
     # Initialize the student manager
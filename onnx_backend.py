@@ -0,0 +1,260 @@
+"""
+ONNX Backend - int8 ONNX Runtime inference for the BGE embedder and BGE reranker
+
+Exports `BAAI/bge-base-en-v1.5` and `BAAI/bge-reranker-base` to ONNX once, applies dynamic
+int8 weight quantization and serves them through ONNX Runtime on CPU. The wrappers implement
+the same LangChain interfaces as the PyTorch models (`Embeddings` and `BaseCrossEncoder`), so
+`main.model_registry` can swap them in when INFERENCE_BACKEND=onnx.
+
+Quantized embeddings are close to, but not bit-identical with, the float32 vectors already in
+the FAISS index. Run this module directly to check parity and speed before switching:
+
+Usage:
+    python onnx_backend.py [--samples 64] [--output parity.json]
+
+Requires the optional `onnx` and `onnxruntime` packages.
+"""
+import argparse
+import inspect
+import json
+import os
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_community.cross_encoders import BaseCrossEncoder
+
+ONNX_DIR = Path(__file__).resolve().parent / "data" / "onnx"  # Exported and quantized models
+MAX_LENGTH = 512
+EXPORT_VERSION = 2  # Bumped when exports change; v1 bound BERT's token_type_ids and attention_mask crosswise
+
+
+def _require_onnxruntime():
+    try:
+        import onnxruntime
+    except ImportError as e:
+        raise ImportError(
+            "The ONNX backend needs onnxruntime: pip install onnx onnxruntime"
+        ) from e
+    return onnxruntime
+
+
+def _model_dir(model_name: str) -> Path:
+    return ONNX_DIR / model_name.replace("/", "__")
+
+
+def export_quantized_model(model_name: str, task: str) -> Path:
+    """
+    Exports a HuggingFace model to ONNX and writes a dynamically int8-quantized copy.
+
+    `task` is "embedding" (encoder, last_hidden_state) or "rerank" (sequence classification
+    logits). Returns the path of the quantized model; existing exports are reused.
+    """
+    model_dir = _model_dir(model_name)
+    quantized_path = model_dir / f"model.v{EXPORT_VERSION}.int8.onnx"
+    if quantized_path.exists():
+        return quantized_path
+
+    _require_onnxruntime()
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from transformers import AutoModel, AutoModelForSequenceClassification, AutoTokenizer
+
+    print(f"Exporting {model_name} to ONNX...")
+    model_dir.mkdir(parents=True, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    if task == "embedding":
+        model = AutoModel.from_pretrained(model_name)
+        sample = tokenizer(["sample text"], return_tensors="pt")
+        output_name = "last_hidden_state"
+    elif task == "rerank":
+        model = AutoModelForSequenceClassification.from_pretrained(model_name)
+        sample = tokenizer(["sample query"], ["sample passage"], return_tensors="pt")
+        output_name = "logits"
+    else:
+        raise ValueError(f"Unknown task '{task}'")
+    model.eval()
+
+    # Graph inputs follow forward()'s parameter order, not the tokenizer's key order (for BERT
+    # the tokenizer emits token_type_ids before attention_mask), so name them in that order and
+    # pass the tensors by keyword
+    parameters = list(inspect.signature(model.forward).parameters)
+    input_names = sorted(sample.keys(), key=parameters.index)
+    fp32_path = model_dir / f"model.v{EXPORT_VERSION}.onnx"
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            ({name: sample[name] for name in input_names},),
+            str(fp32_path),
+            input_names=input_names,
+            output_names=[output_name],
+            dynamic_axes={**{name: {0: "batch", 1: "sequence"} for name in input_names},
+                          output_name: {0: "batch"}},
+            opset_version=14,
+        )
+    tokenizer.save_pretrained(str(model_dir))
+
+    print(f"Quantizing {model_name} to int8...")
+    quantize_dynamic(str(fp32_path), str(quantized_path), weight_type=QuantType.QInt8)
+    return quantized_path
+
+
+class _OnnxModel:
+    """Tokenizer plus an ONNX Runtime CPU session for one exported model."""
+
+    def __init__(self, model_name: str, task: str, batch_size: int = 32, threads: int = None):
+        ort = _require_onnxruntime()
+        from transformers import AutoTokenizer
+
+        path = export_quantized_model(model_name, task)
+        options = ort.SessionOptions()
+        if threads is None:  # Read per session, not at import, so callers can set it late
+            threads = int(os.getenv("ONNX_THREADS", "0"))  # Intra-op threads; 0 lets ONNX Runtime decide
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(str(path), options, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.tokenizer = AutoTokenizer.from_pretrained(str(path.parent))
+        self.batch_size = batch_size
+
+    def run(self, *texts) -> np.ndarray:
+        encoded = self.tokenizer(*texts, padding=True, truncation=True, max_length=MAX_LENGTH, return_tensors="np")
+        feed = {name: value.astype(np.int64) for name, value in encoded.items() if name in self.input_names}
+        return self.session.run(None, feed)[0]
+
+
+class OnnxBgeEmbeddings(Embeddings):
+    """BGE embeddings served by an int8 ONNX Runtime session (CLS pooling, L2-normalized)."""
+
+    def __init__(self, model_name: str, query_instruction: str = "", normalize_embeddings: bool = True,
+                 batch_size: int = 32, threads: int = None):
+        self.model_name = model_name
+        self.query_instruction = query_instruction
+        self.encode_kwargs = {"normalize_embeddings": normalize_embeddings}
+        self._model = _OnnxModel(model_name, "embedding", batch_size, threads)
+
+    def _encode(self, texts: List[str]) -> List[List[float]]:
+        vectors = []
+        for start in range(0, len(texts), self._model.batch_size):
+            hidden = self._model.run(texts[start:start + self._model.batch_size])
+            vectors.append(hidden[:, 0])  # BGE uses the [CLS] token as the sentence embedding
+        vectors = np.vstack(vectors) if vectors else np.zeros((0, 0), dtype=np.float32)
+        if self.encode_kwargs["normalize_embeddings"] and len(vectors):
+            vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors.tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._encode([t.replace("\n", " ") for t in texts])
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._encode([self.query_instruction + text.replace("\n", " ")])[0]
+
+
+class OnnxCrossEncoder(BaseCrossEncoder):
+    """BGE reranker served by an int8 ONNX Runtime session; scores match CrossEncoder.predict (sigmoid)."""
+
+    def __init__(self, model_name: str, batch_size: int = 32, threads: int = None):
+        self.model_name = model_name
+        self._model = _OnnxModel(model_name, "rerank", batch_size, threads)
+
+    def score(self, text_pairs: List[Tuple[str, str]]) -> List[float]:
+        scores = []
+        for start in range(0, len(text_pairs), self._model.batch_size):
+            batch = text_pairs[start:start + self._model.batch_size]
+            logits = self._model.run([q for q, _ in batch], [d for _, d in batch])
+            scores.extend((1 / (1 + np.exp(-logits[:, 0]))).tolist())
+        return scores
+
+
+# --- Parity and speed check ---
+def _pairwise_rank_agreement(a: List[float], b: List[float]) -> float:
+    """Fraction of candidate pairs that both scorers order the same way (Kendall-style)."""
+    agree = total = 0
+    for i in range(len(a)):
+        for j in range(i + 1, len(a)):
+            total += 1
+            agree += (a[i] - a[j]) * (b[i] - b[j]) > 0
+    return agree / total if total else 1.0
+
+
+def _timed(fn, *args) -> Tuple[object, float]:
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def parity_report(texts: List[str], queries: List[str], candidates_per_query: int = 10, top_n: int = 4) -> Dict:
+    """Compares the ONNX int8 models with the PyTorch ones on the same inputs."""
+    from langchain_community.cross_encoders import HuggingFaceCrossEncoder
+    from langchain_community.embeddings import HuggingFaceBgeEmbeddings
+    from main import BGE_QUERY_INSTRUCTION, EMBEDDING_MODEL_NAME, RERANKER_MODEL_NAME
+
+    torch_embedder = HuggingFaceBgeEmbeddings(
+        model_name=EMBEDDING_MODEL_NAME, model_kwargs={'device': 'cpu'},
+        encode_kwargs={'normalize_embeddings': True}, query_instruction=BGE_QUERY_INSTRUCTION
+    )
+    onnx_embedder = OnnxBgeEmbeddings(EMBEDDING_MODEL_NAME, query_instruction=BGE_QUERY_INSTRUCTION)
+    torch_vectors, torch_embed_s = _timed(torch_embedder.embed_documents, texts)
+    onnx_vectors, onnx_embed_s = _timed(onnx_embedder.embed_documents, texts)
+    cosines = np.sum(np.array(torch_vectors) * np.array(onnx_vectors), axis=1)
+
+    torch_reranker = HuggingFaceCrossEncoder(model_name=RERANKER_MODEL_NAME, model_kwargs={"max_length": MAX_LENGTH})
+    onnx_reranker = OnnxCrossEncoder(RERANKER_MODEL_NAME)
+    agreements, top_overlaps = [], []
+    torch_rerank_s = onnx_rerank_s = 0.0
+    for i, query in enumerate(queries):
+        start = (i * candidates_per_query) % max(1, len(texts))
+        candidates = (texts[start:] + texts[:start])[:candidates_per_query]
+        pairs = [(query, text) for text in candidates]
+        torch_scores, seconds = _timed(torch_reranker.score, pairs)
+        torch_rerank_s += seconds
+        onnx_scores, seconds = _timed(onnx_reranker.score, pairs)
+        onnx_rerank_s += seconds
+        torch_scores = list(map(float, torch_scores))
+        agreements.append(_pairwise_rank_agreement(torch_scores, onnx_scores))
+        torch_top = set(np.argsort(torch_scores)[::-1][:top_n].tolist())
+        onnx_top = set(np.argsort(onnx_scores)[::-1][:top_n].tolist())
+        top_overlaps.append(len(torch_top & onnx_top) / max(1, len(torch_top)))
+
+    return {
+        "embedding": {
+            "texts": len(texts),
+            "mean_cosine": float(np.mean(cosines)),
+            "min_cosine": float(np.min(cosines)),
+            "torch_s": torch_embed_s,
+            "onnx_s": onnx_embed_s,
+            "speedup": torch_embed_s / max(onnx_embed_s, 1e-9),
+        },
+        "rerank": {
+            "queries": len(queries),
+            "pairwise_rank_agreement": float(np.mean(agreements)),
+            f"top{top_n}_overlap": float(np.mean(top_overlaps)),
+            "torch_s": torch_rerank_s,
+            "onnx_s": onnx_rerank_s,
+            "speedup": torch_rerank_s / max(onnx_rerank_s, 1e-9),
+        },
+    }
+
+
+if __name__ == "__main__":
+    from main import CHAPTER_MAP_PATH, VECTORSTORE_PATH, load_chapter_map
+    from vector_storage import load_vectorstore
+
+    parser = argparse.ArgumentParser(description="Parity and speed check for the ONNX int8 backend.")
+    parser.add_argument("--samples", type=int, default=64, help="Chunks used for the embedding comparison")
+    parser.add_argument("--output", help="Optional path to write the report as JSON")
+    args = parser.parse_args()
+
+    store = load_vectorstore(VECTORSTORE_PATH, None)
+    doc_ids = [store.index_to_docstore_id[i] for i in sorted(store.index_to_docstore_id)][:args.samples]
+    sample_texts = [store.docstore.search(doc_id).page_content for doc_id in doc_ids]
+    sample_queries = [f"{chapter['title']} key events" for chapter in load_chapter_map(CHAPTER_MAP_PATH)]
+
+    report = parity_report(sample_texts, sample_queries)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
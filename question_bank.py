@@ -0,0 +1,241 @@
+"""
+Question Bank - Pre-generated questions served from SQLite
+
+Generating a question inline costs a retrieval plus one or more LLM calls. The bank keeps pools
+of ready questions per (chapter_id, difficulty band) so the API can hand out one a student has
+not seen yet with a single indexed query. A background worker tops a pool up whenever a
+student's unseen stock in it drops below the low watermark.
+
+Tables:
+- questions    question, answer and source chunk ids, indexed by (chapter_id, difficulty)
+- served       which question went to which student, so nobody sees a question twice
+"""
+import json
+import os
+import queue
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+QUESTION_BANK_PATH = Path(__file__).resolve().parent / "data" / "question_bank.db"
+QUESTION_BANK_LOW_WATERMARK = int(os.getenv("QUESTION_BANK_LOW_WATERMARK", "3"))  # Unseen questions that trigger a top-up
+QUESTION_BANK_HIGH_WATERMARK = int(os.getenv("QUESTION_BANK_HIGH_WATERMARK", "10"))  # Unseen questions a top-up aims for
+QUESTION_BANK_PREFILL = os.getenv("QUESTION_BANK_PREFILL", "1") == "1"  # Fill every pool when the API starts
+QUESTION_BANK_MAX_MISSES = int(os.getenv("QUESTION_BANK_MAX_MISSES", "3"))  # Consecutive duplicates/failures that end a top-up
+DIFFICULTY_BANDS = ("beginner", "intermediate", "advanced")
+
+
+class QuestionBank:
+    """SQLite store of pre-generated questions and the questions served to each student."""
+
+    def __init__(self, db_path: Path = QUESTION_BANK_PATH):
+        self.db_path = Path(db_path)
+        self._create_tables()
+
+    def _get_connection(self):
+        return sqlite3.connect(str(self.db_path))
+
+    def _create_tables(self):
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._get_connection() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS questions (
+                    question_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chapter_id TEXT NOT NULL,
+                    difficulty TEXT NOT NULL,
+                    question TEXT NOT NULL,
+                    answer TEXT NOT NULL,
+                    source_chunk_ids TEXT DEFAULT '[]',  -- JSON array of docstore IDs
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    UNIQUE (chapter_id, difficulty, question)
+                )
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS served (
+                    student_id TEXT NOT NULL,
+                    question_id INTEGER NOT NULL,
+                    served_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (student_id, question_id)
+                )
+            ''')
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_questions_pool ON questions (chapter_id, difficulty)")
+            conn.commit()
+
+    def add_question(self, chapter_id: str, difficulty: str, question: str, answer: str,
+                     source_chunk_ids: List[str] = None) -> Optional[int]:
+        """Stores a question; returns its ID, or None if the pool already holds the same question."""
+        with self._get_connection() as conn:
+            cursor = conn.execute('''
+                INSERT OR IGNORE INTO questions (chapter_id, difficulty, question, answer, source_chunk_ids)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (chapter_id, difficulty, question, answer, json.dumps(source_chunk_ids or [])))
+            conn.commit()
+            return cursor.lastrowid if cursor.rowcount else None
+
+    def find_question(self, chapter_id: str, difficulty: str, question: str) -> Optional[int]:
+        """ID of the question in the pool with exactly this text, or None."""
+        with self._get_connection() as conn:
+            row = conn.execute(
+                "SELECT question_id FROM questions WHERE chapter_id = ? AND difficulty = ? AND question = ?",
+                (chapter_id, difficulty, question)
+            ).fetchone()
+        return row[0] if row else None
+
+    def mark_served(self, student_id: str, question_id: int) -> None:
+        with self._get_connection() as conn:
+            conn.execute("INSERT OR IGNORE INTO served (student_id, question_id) VALUES (?, ?)",
+                         (student_id, question_id))
+            conn.commit()
+
+    def take(self, student_id: str, chapter_id: str, difficulty: str) -> Tuple[Optional[Dict], int]:
+        """
+        Serves the oldest question in the pool the student has not seen, and marks it served.
+
+        Returns (question or None, unseen questions left in the pool for this student).
+        """
+        with self._get_connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")  # Two requests from one student must not get the same row
+            unseen = '''
+                FROM questions q
+                WHERE chapter_id = ? AND difficulty = ?
+                  AND NOT EXISTS (SELECT 1 FROM served s WHERE s.student_id = ? AND s.question_id = q.question_id)
+            '''
+            row = conn.execute(
+                "SELECT question_id, question, answer, source_chunk_ids" + unseen + "ORDER BY question_id LIMIT 1",
+                (chapter_id, difficulty, student_id)
+            ).fetchone()
+            if not row:
+                conn.commit()
+                return None, 0
+            question_id, question, answer, chunk_ids = row
+            conn.execute("INSERT OR IGNORE INTO served (student_id, question_id) VALUES (?, ?)",
+                         (student_id, question_id))
+            left = conn.execute("SELECT COUNT(*)" + unseen, (chapter_id, difficulty, student_id)).fetchone()[0]
+            conn.commit()
+        return {
+            "question_id": question_id,
+            "question": question,
+            "expected_answer": answer,
+            "source_chunk_ids": json.loads(chunk_ids),
+        }, left
+
+    def questions(self, chapter_id: str, difficulty: str) -> List[str]:
+        with self._get_connection() as conn:
+            rows = conn.execute("SELECT question FROM questions WHERE chapter_id = ? AND difficulty = ?",
+                                (chapter_id, difficulty)).fetchall()
+        return [row[0] for row in rows]
+
+    def pool_sizes(self) -> Dict[str, int]:
+        """Question count per "chapter_id|difficulty" pool."""
+        with self._get_connection() as conn:
+            rows = conn.execute("SELECT chapter_id, difficulty, COUNT(*) FROM questions GROUP BY chapter_id, difficulty")
+            return {f"{chapter_id}|{difficulty}": count for chapter_id, difficulty, count in rows}
+
+
+class QuestionBankWorker:
+    """
+    Background thread that fills question pools.
+
+    `generate(chapter_id, chapter_title, difficulty, previous_questions)` must return
+    (question, answer, source_chunk_ids), or None when no usable question came out. Requests for
+    the same pool are merged, so a burst of students only queues one top-up. A top-up gives up
+    after `max_misses` generations in a row that failed or only repeated a banked question,
+    since the pool is then likely exhausted for now; the next low-watermark request retries it.
+    """
+
+    def __init__(self, bank: QuestionBank, generate: Callable,
+                 high_watermark: int = QUESTION_BANK_HIGH_WATERMARK, max_misses: int = QUESTION_BANK_MAX_MISSES):
+        self.bank = bank
+        self.generate = generate
+        self.high_watermark = high_watermark
+        self.max_misses = max(1, max_misses)
+        self._queue: "queue.Queue[Tuple[str, str]]" = queue.Queue()
+        self._pending: Dict[Tuple[str, str], Tuple[str, int]] = {}  # pool -> (chapter title, questions wanted)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.generated = 0
+        self.duplicates = 0
+        self.failed = 0
+        self.abandoned = 0
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="question-bank", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._queue.put(None)
+
+    def request(self, chapter_id: str, chapter_title: str, difficulty: str, count: int) -> None:
+        """Asks for `count` more questions in a pool; merged with any top-up already queued."""
+        if count <= 0:
+            return
+        key = (chapter_id, difficulty)
+        with self._lock:
+            if key in self._pending:
+                title, wanted = self._pending[key]
+                self._pending[key] = (title, max(wanted, count))
+                return
+            self._pending[key] = (chapter_title, count)
+        self._queue.put(key)
+
+    def replenish(self, chapter_id: str, chapter_title: str, difficulty: str, unseen: int,
+                  low_watermark: int = QUESTION_BANK_LOW_WATERMARK) -> None:
+        """Tops the pool up to the high watermark if a student's unseen stock fell below the low one."""
+        if unseen < low_watermark:
+            self.request(chapter_id, chapter_title, difficulty, self.high_watermark - unseen)
+
+    def prefill(self, chapters: List[Dict]) -> None:
+        """Queues every (chapter, band) pool holding fewer than `high_watermark` questions."""
+        sizes = self.bank.pool_sizes()
+        for chapter in chapters:
+            for difficulty in DIFFICULTY_BANDS:
+                have = sizes.get(f"{chapter['id']}|{difficulty}", 0)
+                self.request(chapter["id"], chapter["title"], difficulty, self.high_watermark - have)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            pending = {f"{chapter_id}|{difficulty}": wanted
+                       for (chapter_id, difficulty), (_, wanted) in self._pending.items()}
+        return {"generated": self.generated, "duplicates": self.duplicates, "failed": self.failed,
+                "abandoned": self.abandoned, "pending": pending, "pools": self.bank.pool_sizes()}
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            key = self._queue.get()
+            if key is None:
+                break
+            with self._lock:
+                # Popped before generating, so requests arriving meanwhile queue a fresh top-up
+                chapter_title, wanted = self._pending.pop(key)
+            chapter_id, difficulty = key
+            print(f"Question bank: generating {wanted} {difficulty} questions for {chapter_id}...")
+            previous = set(self.bank.questions(chapter_id, difficulty))
+            misses = 0
+            for _ in range(wanted):
+                if self._stop.is_set():
+                    break
+                if misses >= self.max_misses:
+                    print(f"⚠️ Question bank: {misses} misses in a row for {chapter_id}/{difficulty}; "
+                          f"stopping this top-up.")
+                    self.abandoned += 1
+                    break
+                try:
+                    result = self.generate(chapter_id, chapter_title, difficulty, previous)
+                except (Exception, SystemExit) as e:  # main's loaders exit on fatal errors
+                    print(f"❌ Question bank generation failed for {chapter_id}/{difficulty}: {e}")
+                    result = None
+                if not result:
+                    self.failed += 1
+                    misses += 1
+                elif self.bank.add_question(chapter_id, difficulty, *result) is None:
+                    previous.add(result[0])
+                    self.duplicates += 1  # Already banked: not an error, but no new stock either
+                    misses += 1
+                else:
+                    previous.add(result[0])
+                    self.generated += 1
+                    misses = 0
@@ -1,38 +1,57 @@
 """FastAPI backend for the ZPD-based adaptive history quiz system. Handles user sessions, question generation, and answer evaluation with adaptive difficulty."""
 
-from typing import Optional, Dict
+import itertools
+import json
+import os
+from typing import Optional
 
 from fastapi import FastAPI, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 
 from student_manager import StudentManager, SessionExpiredError
+from question_bank import QuestionBank, QuestionBankWorker, QUESTION_BANK_PREFILL
+from llm_gateway import LLMBusyError, llm_gateway
+from context_packer import context_packing_stats
 from main import (
     load_chapter_map,
     extract_text_with_metadata,
     split_documents,
     create_and_save_vectorstore,
     load_retriever_and_reranker,
-    generate_question_from_chapter_content,
+    generate_question_with_sources,
+    stream_question_with_sources,
     get_feedback_on_answer,
+    stream_feedback_on_answer,
+    stream_latency_stats,
+    get_hint,
+    get_grading_cache,
+    get_local_grader,
+    hint_cache,
+    difficulty_band,
+    source_chunk_ids,
+    DIFFICULTY_BAND_ZPD,
+    model_registry,
+    arun_retrieval_work,
+    RetrievalBusyError,
     VECTORSTORE_PATH,
     PDF_PATH,
     CHAPTER_MAP_PATH,
 )
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_openai import ChatOpenAI
 
 app = FastAPI(title="Quiz API")
 
-student_mgr = StudentManager()
+STUDENT_DB_PATH = os.getenv("STUDENT_DB_PATH", "student.db")  # load_test.py --serve points this at a throwaway file
+student_mgr = StudentManager(STUDENT_DB_PATH)
 
-# Global resources
-embeddings = HuggingFaceEmbeddings(
-    model_name="BAAI/bge-base-en-v1.5",
-    model_kwargs={"device": "cpu"},
-    encode_kwargs={"normalize_embeddings": True}
-)
-llm = ChatOpenAI(model_name="gpt-4.1-nano", temperature=0.7, max_tokens=1500)
-retrievers: Dict[str, any] = {}
+
+# Global resources (embedder, reranker, retrievers and the chat model) live in main.model_registry
+# and are built on first use, so importing this module does no model work.
+# Endpoints that are `async def` run on the event loop: session lookups, chapter-map reads and
+# SQLite writes in them go through run_in_threadpool like the model work does.
+def get_llm():
+    return model_registry.get_chat_model("gpt-4.1-nano", temperature=0.7, max_tokens=1500)
 
 
 class LoginRequest(BaseModel):
@@ -52,23 +71,60 @@ class AnswerRequest(BaseModel):
     user_answer: str
 
 
+class HintRequest(BaseModel):
+    student_id: str
+    question: str
+    expected_answer: str
+    zpd: Optional[float] = None  # ZPD the answer was graded at (old_zpd from /submit-answer); defaults to the current one
+
+
 def ensure_vectorstore():
     if not VECTORSTORE_PATH.exists():
         chapters = load_chapter_map(CHAPTER_MAP_PATH)
         docs = extract_text_with_metadata(PDF_PATH, chapters)
         chunks = split_documents(docs)
-        create_and_save_vectorstore(chunks)
+        create_and_save_vectorstore(chunks, pages=docs)
 
 
 def get_retriever(chapter_id: str):
-    if chapter_id not in retrievers:
-        ensure_vectorstore()
-        retrievers[chapter_id] = load_retriever_and_reranker(
-            embeddings,
-            embeddings.query_instruction,
-            chapter_id,
-        )
-    return retrievers[chapter_id]
+    ensure_vectorstore()
+    embeddings = model_registry.get_embeddings()
+    return load_retriever_and_reranker(
+        embeddings,
+        embeddings.query_instruction,
+        chapter_id,
+    )
+
+
+def generate_bank_question(chapter_id: str, chapter_title: str, difficulty: str, previous_questions: set):
+    """Question-bank worker callback; returns None for the generic fallback question."""
+    question, answer, _, sources = generate_question_with_sources(
+        retriever=get_retriever(chapter_id),
+        llm=get_llm(),
+        zpd_score=DIFFICULTY_BAND_ZPD[difficulty],
+        selected_chapter_title=chapter_title,
+        previous_questions=previous_questions,
+        student_id=f"question-bank:{chapter_id}",  # Spare candidates feed the next top-up call
+    )
+    if not sources:
+        return None
+    return question, answer, source_chunk_ids(sources)
+
+
+question_bank = QuestionBank()
+bank_worker = QuestionBankWorker(question_bank, generate_bank_question)
+
+
+@app.on_event("startup")
+def start_question_bank():
+    bank_worker.start()
+    if QUESTION_BANK_PREFILL:
+        bank_worker.prefill(load_chapter_map(CHAPTER_MAP_PATH))
+
+
+@app.on_event("shutdown")
+def stop_question_bank():
+    bank_worker.stop()
 
 
 @app.post("/login")
@@ -92,48 +148,186 @@ def login(req: LoginRequest):
     return {"student_name": session.student_name, "zpd": session.current_zpd}
 
 
+@app.get("/memory")
+def memory():
+    return model_registry.memory_usage()
+
+
+@app.get("/question-bank")
+def question_bank_stats():
+    return bank_worker.stats()
+
+
+@app.get("/hint-cache")
+def hint_cache_stats():
+    return hint_cache.stats()
+
+
+@app.get("/grading-cache")
+def grading_cache_stats():
+    return get_grading_cache().stats()
+
+
+@app.get("/local-grader")
+def local_grader_stats():
+    return get_local_grader().stats()
+
+
 @app.get("/chapters")
 def chapters():
     return load_chapter_map(CHAPTER_MAP_PATH)
 
 
+@app.get("/stream-latency")
+def stream_latency():
+    return stream_latency_stats.as_dict()
+
+
+@app.get("/llm-gateway")
+def llm_gateway_stats():
+    return llm_gateway.stats()
+
+
+@app.get("/context-packing")
+def context_packing():
+    return context_packing_stats.as_dict()
+
+
+def chapter_id_for(chapter_title: str) -> str:
+    for c in load_chapter_map(CHAPTER_MAP_PATH):
+        if c["title"] == chapter_title:
+            return c["id"]
+    return "all"
+
+
+def bank_generated_question(student_id: str, chapter_id: str, difficulty: str, question: str, answer: str, sources):
+    """Banks an inline-generated question for other students and marks it served to this one."""
+    if sources:
+        question_id = question_bank.add_question(chapter_id, difficulty, question, answer, source_chunk_ids(sources))
+        if question_id is None:  # Already banked, e.g. by the worker: the bank must still not serve it again
+            question_id = question_bank.find_question(chapter_id, difficulty, question)
+        if question_id is not None:
+            question_bank.mark_served(student_id, question_id)
+
+
+def sse(event: dict) -> str:
+    """Formats one Server-Sent Events message, using the event's name as the SSE event type."""
+    return f"event: {event['event']}\ndata: {json.dumps(event)}\n\n"
+
+
 @app.post("/generate-question")
-def generate_question(req: QuestionRequest):
-    session = student_mgr.get_session(req.student_id)
+async def generate_question(req: QuestionRequest):
+    session = await run_in_threadpool(student_mgr.get_session, req.student_id)
+    if not session:
+        raise HTTPException(401, "Invalid or expired session")
+    chapter_id = await run_in_threadpool(chapter_id_for, req.chapter_title)
+
+    # Serve a pre-generated question the student has not seen; top the pool up in the background
+    difficulty = difficulty_band(session.current_zpd)
+    item, unseen = await run_in_threadpool(question_bank.take, req.student_id, chapter_id, difficulty)
+    bank_worker.replenish(chapter_id, req.chapter_title, difficulty, unseen)
+    if item:
+        return {"question": item["question"], "expected_answer": item["expected_answer"]}
+
+    # Pool exhausted for this student: generate inline and bank the result for other students
+    try:
+        # Model loading and retrieval are CPU-bound and run on main's bounded retrieval executor;
+        # the LLM calls around them only wait on I/O, so they use the regular threadpool.
+        retriever = await arun_retrieval_work(get_retriever, chapter_id)
+        question, answer, _, sources = await run_in_threadpool(
+            generate_question_with_sources,
+            retriever=retriever,
+            llm=get_llm(),
+            selected_chapter_title=req.chapter_title,
+            previous_questions=set(),
+            zpd_score=session.current_zpd,
+            student_id=req.student_id,
+        )
+    except (RetrievalBusyError, LLMBusyError):
+        raise HTTPException(503, "Server busy. Please retry shortly.")
+    await run_in_threadpool(bank_generated_question, req.student_id, chapter_id, difficulty, question, answer,
+                            sources)
+    return {"question": question, "expected_answer": answer}
+
+
+@app.post("/generate-question/stream")
+async def generate_question_stream(req: QuestionRequest):
+    """
+    /generate-question as Server-Sent Events: "question_delta" events carry the question as it is
+    written, "question" the complete question while the answer is still generated, "retry" tells
+    the client to discard the text shown so far, and "done" carries question and expected answer.
+    "error" ends the stream if the retrieval pool or LLM queue fills up after the first event was sent.
+    """
+    session = await run_in_threadpool(student_mgr.get_session, req.student_id)
     if not session:
         raise HTTPException(401, "Invalid or expired session")
-    chapter_map = load_chapter_map(CHAPTER_MAP_PATH)
-    chapter_id = "all"
-    for c in chapter_map:
-        if c["title"] == req.chapter_title:
-            chapter_id = c["id"]
-            break
-    retriever = get_retriever(chapter_id)
-    question, answer, _ = generate_question_from_chapter_content(
+    chapter_id = await run_in_threadpool(chapter_id_for, req.chapter_title)
+
+    difficulty = difficulty_band(session.current_zpd)
+    item, unseen = await run_in_threadpool(question_bank.take, req.student_id, chapter_id, difficulty)
+    bank_worker.replenish(chapter_id, req.chapter_title, difficulty, unseen)
+    if item:
+        events = [
+            {"event": "question", "question": item["question"], "difficulty": difficulty},
+            {"event": "done", "question": item["question"], "expected_answer": item["expected_answer"],
+             "difficulty": difficulty},
+        ]
+        return StreamingResponse((sse(event) for event in events), media_type="text/event-stream")
+
+    try:
+        retriever = await arun_retrieval_work(get_retriever, chapter_id)
+    except (RetrievalBusyError, LLMBusyError):
+        raise HTTPException(503, "Server busy. Please retry shortly.")
+    generated = stream_question_with_sources(
         retriever=retriever,
-        llm=llm,
+        llm=get_llm(),
+        zpd_score=session.current_zpd,
         selected_chapter_title=req.chapter_title,
         previous_questions=set(),
-        zpd_score=session.current_zpd,
+        student_id=req.student_id,
     )
-    return {"question": question, "expected_answer": answer}
+    try:
+        # The first event waits for the first retrieval and LLM admission, so a saturated pool still gets its 503
+        first = await run_in_threadpool(next, generated)
+    except (RetrievalBusyError, LLMBusyError):
+        raise HTTPException(503, "Server busy. Please retry shortly.")
+
+    def events():
+        # A sync generator: Starlette advances it in the threadpool, so LLM waits never block the loop
+        try:
+            for event in itertools.chain([first], generated):
+                if event["event"] == "done":
+                    bank_generated_question(req.student_id, chapter_id, difficulty, event["question"],
+                                            event["answer"], event["source_docs"])
+                    event = {"event": "done", "question": event["question"], "expected_answer": event["answer"],
+                             "difficulty": event["difficulty"], "timing": event["timing"]}
+                yield sse(event)
+        except (RetrievalBusyError, LLMBusyError):  # A later attempt; the response has already started
+            yield sse({"event": "error", "detail": "Server busy. Please retry shortly."})
+
+    return StreamingResponse(events(), media_type="text/event-stream")
 
 
 @app.post("/submit-answer")
-def submit_answer(req: AnswerRequest):
-    session = student_mgr.get_session(req.student_id)
+async def submit_answer(req: AnswerRequest):
+    session = await run_in_threadpool(student_mgr.get_session, req.student_id)
     if not session:
         raise HTTPException(401, "Invalid or expired session")
-    feedback, correct, analysis = get_feedback_on_answer(
-        user_answer=req.user_answer,
-        expected_answer=req.expected_answer,
-        question=req.question,
-        llm=llm,
-        context="",
-        zpd_score=session.current_zpd,
-    )
     try:
-        old, new = student_mgr.update_student_zpd(
+        feedback, correct, analysis = await run_in_threadpool(
+            get_feedback_on_answer,
+            user_answer=req.user_answer,
+            expected_answer=req.expected_answer,
+            question=req.question,
+            llm=get_llm(),
+            context="",
+            zpd_score=session.current_zpd,
+        )
+    except LLMBusyError:
+        raise HTTPException(503, "Server busy. Please retry shortly.")
+    try:
+        old, new = await run_in_threadpool(
+            student_mgr.update_student_zpd,
             student_session=session,
             is_correct=correct,
             is_partial=analysis.get("partially_correct", False),
@@ -143,12 +337,75 @@ def submit_answer(req: AnswerRequest):
     return {
         "feedback": feedback,
         "correct": correct,
-        "hint": analysis.get("hint"),
+        "hint": analysis.get("hint"),  # None with lazy hints; fetch it from /hint when the student asks
         "old_zpd": old,
         "new_zpd": new,
     }
 
 
+@app.post("/submit-answer/stream")
+async def submit_answer_stream(req: AnswerRequest):
+    """
+    /submit-answer as Server-Sent Events: "feedback_delta" events carry the feedback as it is
+    written, and "result" the complete feedback, verdict, hint and ZPD update. "error" ends the
+    stream if the LLM queue fills up after the first event was sent.
+    """
+    session = await run_in_threadpool(student_mgr.get_session, req.student_id)
+    if not session:
+        raise HTTPException(401, "Invalid or expired session")
+    graded = stream_feedback_on_answer(
+        user_answer=req.user_answer,
+        expected_answer=req.expected_answer,
+        question=req.question,
+        llm=get_llm(),
+        zpd_score=session.current_zpd,
+    )
+    try:
+        # The first event waits for LLM admission, so a full gateway queue still gets its 503
+        first = await run_in_threadpool(next, graded)
+    except LLMBusyError:
+        raise HTTPException(503, "Server busy. Please retry shortly.")
+
+    def events():
+        try:
+            for event in itertools.chain([first], graded):
+                if event["event"] == "result":
+                    analysis = event["analysis"]
+                    try:
+                        old, new = student_mgr.update_student_zpd(
+                            student_session=session,
+                            is_correct=event["correct"],
+                            is_partial=analysis.get("partially_correct", False),
+                        )
+                    except SessionExpiredError:
+                        yield sse({"event": "error", "detail": "Session expired. Please log in again."})
+                        return
+                    event = {
+                        "event": "result",
+                        "feedback": event["feedback"],
+                        "correct": event["correct"],
+                        "hint": analysis.get("hint"),
+                        "old_zpd": old,
+                        "new_zpd": new,
+                        "timing": event["timing"],
+                    }
+                yield sse(event)
+        except LLMBusyError:  # A fallback grading call; the response has already started
+            yield sse({"event": "error", "detail": "Server busy. Please retry shortly."})
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.post("/hint")
+async def hint(req: HintRequest):
+    session = await run_in_threadpool(student_mgr.get_session, req.student_id)
+    if not session:
+        raise HTTPException(401, "Invalid or expired session")
+    zpd = req.zpd if req.zpd is not None else session.current_zpd
+    text = await run_in_threadpool(get_hint, req.question, req.expected_answer, zpd, get_llm())
+    return {"hint": text}
+
+
 if __name__ == "__main__":
     import uvicorn
 
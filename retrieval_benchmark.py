@@ -0,0 +1,316 @@
+"""
+Retrieval Benchmark - Latency and quality of the retrieval pipeline, runnable offline
+
+Runs, for every chapter in the chapter map, the question-generation aspect queries plus any
+held-out labelled questions through `load_retriever_and_reranker`, and reports:
+- model and index load time
+- query-embed, FAISS-search (and BM25, in hybrid mode) and rerank latency, as p50/p95/p99
+- recall@k of the retrieved chunks against labelled chunk ids
+- peak RSS of the process
+
+Stages are timed by thin wrappers around the shared embedder, reranker and FAISS indexes, so
+the retriever under test is exactly the one the app builds. The query-embedding cache is
+cleared before every query (pass --warm to keep it) and the reranker runs without its score
+cache, so consecutive runs measure the same work.
+
+Nothing touches the network: HuggingFace models are loaded from the local cache only, and
+--stub swaps in a deterministic hashing embedder and token-overlap reranker. Stub runs measure
+pipeline overhead; their recall numbers say nothing about model quality.
+
+Held-out questions are read from a JSON list (default data/benchmark_questions.json):
+    [{"chapter_id": "1", "question": "...", "relevant_chunk_ids": ["<docstore id>", ...]}, ...]
+
+Usage:
+    python retrieval_benchmark.py [--stub] [--mode default|adaptive|hybrid] [--k 4]
+                                  [--output results.json] [--baseline previous.json]
+"""
+import argparse
+import hashlib
+import json
+import os
+import resource
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+# Must be set before transformers / huggingface_hub are imported by main
+os.environ.setdefault("HF_HUB_OFFLINE", "1")
+os.environ.setdefault("TRANSFORMERS_OFFLINE", "1")
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_community.cross_encoders import BaseCrossEncoder
+
+from lexical_index import tokenize
+from main import (
+    BASE_DIR,
+    CHAPTER_MAP_PATH,
+    CONTENT_ASPECTS,  # The focus aspects question generation draws from
+    VECTORSTORE_PATH,
+    build_cross_encoder,
+    load_chapter_map,
+    load_retriever_and_reranker,
+    model_registry,
+)
+
+LABELS_PATH = BASE_DIR / "data" / "benchmark_questions.json"
+
+
+# --- Deterministic stub models ---
+class HashingEmbeddings(Embeddings):
+    """Signed feature hashing of tokens into `dim` buckets, L2-normalized; no model needed."""
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.model_name = f"stub-hashing-{dim}"
+        self.query_instruction = ""
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for token in tokenize(text):
+            digest = int(hashlib.md5(token.encode('utf-8')).hexdigest(), 16)
+            vector[digest % self.dim] += 1.0 if (digest >> 64) & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(text)
+
+
+class TokenOverlapCrossEncoder(BaseCrossEncoder):
+    """Scores a pair by the fraction of query tokens found in the passage; no model needed."""
+
+    model_name = "stub-token-overlap"
+
+    def score(self, text_pairs: List[Tuple[str, str]]) -> List[float]:
+        scores = []
+        for query, passage in text_pairs:
+            query_tokens = set(tokenize(query))
+            scores.append(len(query_tokens & set(tokenize(passage))) / max(1, len(query_tokens)))
+        return scores
+
+
+# --- Stage timing ---
+class StageTimer:
+    """Collects wall-clock samples (milliseconds) per pipeline stage."""
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+
+    def record(self, stage: str, seconds: float) -> None:
+        self.samples.setdefault(stage, []).append(seconds * 1000)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        return {
+            stage: {
+                "n": len(values),
+                "p50_ms": float(np.percentile(values, 50)),
+                "p95_ms": float(np.percentile(values, 95)),
+                "p99_ms": float(np.percentile(values, 99)),
+                "mean_ms": float(np.mean(values)),
+            }
+            for stage, values in self.samples.items() if values
+        }
+
+
+class _TimedProxy:
+    """Delegates everything to `inner`, timing calls to one method under a stage name."""
+
+    def __init__(self, inner, method: str, stage: str, timer: StageTimer):
+        self.inner = inner
+        self._method = method
+        self._stage = stage
+        self._timer = timer
+
+    def __getattr__(self, name):
+        attr = getattr(self.inner, name)
+        if name != self._method:
+            return attr
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                self._timer.record(self._stage, time.perf_counter() - start)
+        return timed
+
+
+class TimedCrossEncoder(BaseCrossEncoder):
+    """Cross-encoder wrapper recording `score` latency; a real subclass because rerankers validate the type."""
+
+    def __init__(self, cross_encoder, timer: StageTimer):
+        self.inner = cross_encoder
+        self.model_name = getattr(cross_encoder, "model_name", type(cross_encoder).__name__)
+        self._timer = timer
+
+    def __getattr__(self, name):
+        if name == "inner":
+            raise AttributeError(name)
+        return getattr(self.inner, name)
+
+    def score(self, text_pairs: List[Tuple[str, str]]) -> List[float]:
+        start = time.perf_counter()
+        try:
+            return self.inner.score(text_pairs)
+        finally:
+            self._timer.record("rerank", time.perf_counter() - start)
+
+
+def _time_index(vectorstore, timer: StageTimer) -> None:
+    if not isinstance(vectorstore.index, _TimedProxy):
+        vectorstore.index = _TimedProxy(vectorstore.index, "search", "search", timer)
+
+
+def _index_dim() -> int:
+    import faiss
+    index = faiss.read_index(str(VECTORSTORE_PATH / "index.faiss"), faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    return index.d
+
+
+def load_models(stub: bool, timer: StageTimer) -> Dict[str, float]:
+    """Installs timed (optionally stubbed) models in the shared registry and loads the index."""
+    start = time.perf_counter()
+    if stub:
+        model_registry.set_embeddings(HashingEmbeddings(_index_dim()))
+        model_registry.set_reranker(TimedCrossEncoder(TokenOverlapCrossEncoder(), timer))
+    else:
+        model_registry.set_reranker(TimedCrossEncoder(build_cross_encoder(), timer))
+    embeddings = model_registry.get_embeddings()
+    embeddings.inner = _TimedProxy(embeddings.inner, "embed_query", "embed", timer)
+    models_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    model_registry.get_vectorstore()
+    index_s = time.perf_counter() - start
+    return {"models_s": models_s, "index_s": index_s}
+
+
+def load_labels(path: Path) -> List[dict]:
+    if not path.exists():
+        print(f"⚠️ No labelled questions at {path}; recall will not be reported.")
+        return []
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def build_retriever(chapter_id: str, mode: str, timer: StageTimer):
+    retriever = load_retriever_and_reranker(
+        model_registry.get_embeddings(),
+        selected_chapter_id=chapter_id,
+        adaptive_rerank=(mode == "adaptive"),
+        hybrid=(mode == "hybrid"),
+    )
+    _time_index(model_registry.get_chapter_vectorstore(chapter_id), timer)
+    if mode == "hybrid":
+        if not isinstance(retriever.lexical_index, _TimedProxy):
+            retriever.lexical_index = _TimedProxy(retriever.lexical_index, "search", "lexical", timer)
+    return retriever
+
+
+def run_query(retriever, query: str, timer: StageTimer, warm: bool):
+    if not warm:
+        model_registry.get_embeddings().clear()
+    start = time.perf_counter()
+    docs = retriever.get_relevant_documents(query)
+    timer.record("total", time.perf_counter() - start)
+    return docs
+
+
+def run_benchmark(stub: bool = False, mode: str = "default", k: int = 4, labels_path: Path = LABELS_PATH,
+                  warm: bool = False) -> dict:
+    timer = StageTimer()
+    load = load_models(stub, timer)
+    print(f"Models loaded in {load['models_s']:.2f}s, index in {load['index_s']:.2f}s")
+
+    chapters = load_chapter_map(CHAPTER_MAP_PATH)
+    labels = load_labels(labels_path)
+    docstore = model_registry.get_vectorstore().docstore
+
+    recalls: Dict[str, List[float]] = {}
+    n_queries = 0
+    for chapter in chapters:
+        chapter_id = str(chapter["id"])
+        retriever = build_retriever(chapter_id, mode, timer)
+        for aspect in CONTENT_ASPECTS:
+            run_query(retriever, f"{chapter['title']} {aspect}", timer, warm)
+            n_queries += 1
+        for item in (item for item in labels if str(item["chapter_id"]) == chapter_id):
+            docs = run_query(retriever, item["question"], timer, warm)[:k]
+            n_queries += 1
+            retrieved = {doc.page_content for doc in docs}
+            expected = [docstore.search(doc_id) for doc_id in item["relevant_chunk_ids"]]
+            expected = [doc.page_content for doc in expected if not isinstance(doc, str)]
+            if expected:
+                recalls.setdefault(chapter_id, []).append(
+                    sum(text in retrieved for text in expected) / len(expected)
+                )
+        print(f"Chapter {chapter_id}: done")
+
+    all_recalls = [r for values in recalls.values() for r in values]
+    return {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "config": {"stub": stub, "mode": mode, "k": k, "warm_query_cache": warm,
+                   "embedder": model_registry.get_embeddings().model_name,
+                   "reranker": model_registry.get_reranker().model_name},
+        "load": load,
+        "queries": n_queries,
+        "latency": timer.summary(),
+        "quality": {
+            f"recall@{k}": float(np.mean(all_recalls)) if all_recalls else None,
+            "labelled_queries": len(all_recalls),
+            "per_chapter": {chapter_id: float(np.mean(values)) for chapter_id, values in recalls.items()},
+        },
+        # ru_maxrss is in kilobytes on Linux and bytes on macOS
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 ** 2 if sys.platform == "darwin" else 1024),
+    }
+
+
+def print_report(report: dict, baseline: dict = None) -> None:
+    def delta(section: str, stage: str, key: str) -> str:
+        try:
+            return f" ({report[section][stage][key] - baseline[section][stage][key]:+.2f})"
+        except (KeyError, TypeError):
+            return ""
+
+    print(f"\n{'stage':<9} {'n':>5} {'p50 ms':>18} {'p95 ms':>18} {'p99 ms':>18}")
+    for stage, stats in report["latency"].items():
+        cells = [f"{stats[key]:.2f}{delta('latency', stage, key)}" for key in ("p50_ms", "p95_ms", "p99_ms")]
+        print(f"{stage:<9} {stats['n']:>5} {cells[0]:>18} {cells[1]:>18} {cells[2]:>18}")
+    k = report["config"]["k"]
+    recall = report["quality"][f"recall@{k}"]
+    recall_text = f"{recall:.3f}" if recall is not None else "n/a"
+    if recall is not None and baseline and baseline.get("quality", {}).get(f"recall@{k}") is not None:
+        recall_text += f" ({recall - baseline['quality'][f'recall@{k}']:+.3f})"
+    print(f"\nrecall@{k}: {recall_text} over {report['quality']['labelled_queries']} labelled queries")
+    print(f"Load: models {report['load']['models_s']:.2f}s, index {report['load']['index_s']:.2f}s; "
+          f"peak RSS {report['peak_rss_mb']:.0f} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline latency and recall benchmark for the retrieval pipeline.")
+    parser.add_argument("--stub", action="store_true", help="Use the deterministic stub embedder and reranker")
+    parser.add_argument("--mode", choices=("default", "adaptive", "hybrid"), default="default",
+                        help="Retriever variant passed to load_retriever_and_reranker")
+    parser.add_argument("--k", type=int, default=4, help="Retrieved chunks scored for recall (default: 4)")
+    parser.add_argument("--labels", default=str(LABELS_PATH), help="Held-out labelled questions (JSON)")
+    parser.add_argument("--warm", action="store_true", help="Keep the query-embedding cache between queries")
+    parser.add_argument("--output", help="Optional path to write the results as JSON")
+    parser.add_argument("--baseline", help="Earlier results JSON to print deltas against")
+    args = parser.parse_args()
+
+    report = run_benchmark(stub=args.stub, mode=args.mode, k=args.k, labels_path=Path(args.labels), warm=args.warm)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
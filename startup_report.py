@@ -0,0 +1,120 @@
+"""
+Startup Report - Import time of each entry point
+
+Worker restarts and Streamlit reloads pay the import cost of `main` before serving anything, so
+this report tracks it. Each entry point is imported in a fresh interpreter with
+`python -X importtime`, and the report gives:
+- wall-clock time of the import (interpreter startup subtracted)
+- the slowest top-level imports by cumulative time
+
+Results can be written as JSON and compared with an earlier run; --budget makes the script exit
+non-zero when an entry point is slower than the given number of seconds, e.g. in CI.
+
+Usage:
+    python startup_report.py [--runs 3] [--top 10] [--output startup.json] [--baseline previous.json]
+                             [--budget 1.5]
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List
+
+BASE_DIR = Path(__file__).resolve().parent
+ENTRY_POINTS = ("main", "quiz_api", "streamlit_frontend")
+
+
+def _run(code: str, importtime: bool = False) -> subprocess.CompletedProcess:
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + ["-c", code]
+    return subprocess.run(command, cwd=BASE_DIR, capture_output=True, text=True)
+
+
+def _wall_time(code: str, runs: int) -> float:
+    """Best-of-N wall-clock seconds for running `code` in a fresh interpreter."""
+    best = float("inf")
+    for _ in range(runs):
+        start = time.perf_counter()
+        _run(code)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _top_imports(stderr: str, top: int) -> List[Dict]:
+    """Parses `-X importtime` output into the slowest top-level imports (cumulative time)."""
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative_us, name = line[len("import time:"):].split("|")
+        if name[1:].startswith("  "):
+            continue  # Nested import, already counted in its parent's cumulative time
+        imports.append({"module": name.strip(), "cumulative_ms": int(cumulative_us) / 1000})
+    return sorted(imports, key=lambda item: item["cumulative_ms"], reverse=True)[:top]
+
+
+def measure_entry_point(module: str, runs: int = 3, top: int = 10, interpreter_s: float = 0.0) -> Dict:
+    result = _run(f"import {module}", importtime=True)
+    if result.returncode != 0:
+        error = result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "unknown error"
+        return {"ok": False, "error": error}
+    return {
+        "ok": True,
+        "import_s": max(0.0, _wall_time(f"import {module}", runs) - interpreter_s),
+        "top_imports": _top_imports(result.stderr, top),
+    }
+
+
+def run_report(runs: int = 3, top: int = 10) -> Dict:
+    interpreter_s = _wall_time("pass", runs)
+    return {
+        "python": sys.version.split()[0],
+        "interpreter_s": interpreter_s,
+        "entry_points": {
+            module: measure_entry_point(module, runs, top, interpreter_s) for module in ENTRY_POINTS
+        },
+    }
+
+
+def print_report(report: Dict, baseline: Dict = None) -> None:
+    print(f"Interpreter startup: {report['interpreter_s'] * 1000:.0f} ms (subtracted below)")
+    for module, stats in report["entry_points"].items():
+        if not stats["ok"]:
+            print(f"\n❌ {module}: import failed ({stats['error']})")
+            continue
+        line = f"\n{module}: {stats['import_s'] * 1000:.0f} ms"
+        previous = (baseline or {}).get("entry_points", {}).get(module, {})
+        if previous.get("ok"):
+            line += f" ({(stats['import_s'] - previous['import_s']) * 1000:+.0f} ms vs baseline)"
+        print(line)
+        for item in stats["top_imports"]:
+            print(f"    {item['cumulative_ms']:>8.1f} ms  {item['module']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import time of each entry point.")
+    parser.add_argument("--runs", type=int, default=3, help="Imports per entry point; the fastest is kept")
+    parser.add_argument("--top", type=int, default=10, help="Slowest top-level imports to list")
+    parser.add_argument("--output", help="Optional path to write the report as JSON")
+    parser.add_argument("--baseline", help="Earlier report JSON to print deltas against")
+    parser.add_argument("--budget", type=float, help="Fail if any entry point imports slower than this (seconds)")
+    args = parser.parse_args()
+
+    report = run_report(runs=args.runs, top=args.top)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
+    if args.budget is not None:
+        over = [module for module, stats in report["entry_points"].items()
+                if stats["ok"] and stats["import_s"] > args.budget]
+        if over:
+            print(f"❌ Over the {args.budget}s import budget: {', '.join(over)}")
+            sys.exit(1)
+        print(f"✅ All entry points import within {args.budget}s.")
@@ -8,14 +8,14 @@ from main import (
     create_and_save_vectorstore,
     load_retriever_and_reranker,
     setup_qa_chain,
-    generate_question_from_chapter_content,
-    get_feedback_on_answer,
+    stream_question_with_sources,
+    stream_feedback_on_answer,
+    get_hint,
+    model_registry,
     VECTORSTORE_PATH,
     PDF_PATH,
     CHAPTER_MAP_PATH,
 )
-from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_openai import ChatOpenAI
 import os
 from dotenv import load_dotenv
 
@@ -98,15 +98,11 @@ def initialize_qa(choice, chapters):
             print("Vector store not found. Creating a new one...")
             docs = extract_text_with_metadata(PDF_PATH, chapters)
             chunks = split_documents(docs)
-            create_and_save_vectorstore(chunks)
+            create_and_save_vectorstore(chunks, pages=docs)
 
-        # Initialize embeddings with explicit device specification
+        # Shared embeddings are loaded once per process, not once per user session
         print("Initializing embeddings...")
-        embeddings = HuggingFaceEmbeddings(
-            model_name="BAAI/bge-base-en-v1.5",
-            model_kwargs={"device": "cpu"},
-            encode_kwargs={"normalize_embeddings": True}
-        )
+        embeddings = model_registry.get_embeddings()
         
         # Initialize retriever with error handling
         print("Initializing retriever...")
@@ -121,11 +117,10 @@ def initialize_qa(choice, chapters):
         if not os.getenv("OPENAI_API_KEY"):
             raise ValueError("OPENAI_API_KEY not found in environment variables")
             
-        llm = ChatOpenAI(
-            model_name="gpt-3.5-turbo",
+        llm = model_registry.get_chat_model(
+            "gpt-3.5-turbo",
             temperature=0.7,
             max_tokens=1500,
-            api_key=os.getenv("OPENAI_API_KEY"),
             request_timeout=30  # Add timeout to prevent hanging
         )
         
@@ -173,19 +168,15 @@ def quiz():
             if "expected_answer" not in st.session_state:
                 st.session_state.expected_answer = ""
             if "llm" not in st.session_state:
-                st.session_state["llm"] = ChatOpenAI(
-                    model_name="gpt-3.5-turbo",
+                st.session_state["llm"] = model_registry.get_chat_model(
+                    "gpt-3.5-turbo",
                     temperature=0.7,
                     max_tokens=1500,
-                    api_key=os.getenv("OPENAI_API_KEY")
+                    request_timeout=30
                 )
             if "retriever" not in st.session_state:
                 # Initialize retriever if not already done
-                embeddings = HuggingFaceEmbeddings(
-                    model_name="sentence-transformers/all-MiniLM-L6-v2",
-                    model_kwargs={"device": "cpu"},
-                    encode_kwargs={"normalize_embeddings": True}
-                )
+                embeddings = model_registry.get_embeddings()
                 chapter_map = load_chapter_map(CHAPTER_MAP_PATH)
                 selected_chapter = st.session_state.get("selected_chapter", "All Chapters")
                 selected_id = "all"
@@ -203,62 +194,78 @@ def quiz():
 
         # Generate a new question if needed
         if not st.session_state.get("current_question"):
-            with st.spinner("Generating a new question..."):
-                try:
-                    # Clear any previous error messages and feedback
+            # The question is shown while it streams in; the expected answer keeps generating behind it
+            placeholder = st.empty()
+            placeholder.info("Generating a new question...")
+            try:
+                # Clear any previous error messages and feedback
+                if "error_message" in st.session_state:
+                    del st.session_state["error_message"]
+                if "feedback" in st.session_state:
+                    del st.session_state["feedback"]
+                if "show_feedback" in st.session_state:
+                    del st.session_state["show_feedback"]
+                # Ensure we have a valid retriever and LLM
+                if "retriever" not in st.session_state or "llm" not in st.session_state:
+                    raise ValueError("Question generation components not properly initialized")
+                # Get the selected chapter or use "All Chapters" as default
+                selected_chapter = st.session_state.get("selected_chapter", "All Chapters")
+                # Stream the question, rendering it as it is written
+                q = a = difficulty = None
+                shown = ""
+                question_box = "<div style='background:#f8fafc; border-radius:8px; padding:1.2rem; margin-bottom:1rem; border:1.5px solid #e3e6f0; font-size:1.08rem;'>{}</div>"
+                for event in stream_question_with_sources(
+                    retriever=st.session_state["retriever"],
+                    llm=st.session_state["llm"],
+                    selected_chapter_title=selected_chapter,
+                    previous_questions=st.session_state.get("asked", set()),
+                    zpd_score=session.current_zpd,
+                    student_id=session.student_id,
+                ):
+                    if event["event"] == "question_delta":
+                        shown += event["text"]
+                        placeholder.markdown(question_box.format(shown + "▌"), unsafe_allow_html=True)
+                    elif event["event"] == "question":
+                        placeholder.markdown(question_box.format(event["question"]), unsafe_allow_html=True)
+                    elif event["event"] == "retry":
+                        shown = ""
+                        placeholder.info("Generating a new question...")
+                    elif event["event"] == "done":
+                        q, a, difficulty = event["question"], event["answer"], event["difficulty"]
+                if not q or not a:
+                    raise ValueError("Failed to generate a valid question or answer")
+                # Store question and expected answer in session state
+                st.session_state["current_question"] = q
+                st.session_state["expected_answer"] = a
+                st.session_state["question_difficulty"] = difficulty
+                # Initialize asked questions set if it doesn't exist
+                if "asked" not in st.session_state:
+                    st.session_state["asked"] = set()
+                st.session_state["asked"].add(q.lower())
+                # Reset feedback state
+                st.session_state["show_feedback"] = False
+                if "feedback" in st.session_state:
+                    del st.session_state["feedback"]
+                if "is_correct" in st.session_state:
+                    del st.session_state["is_correct"]
+                if "analysis" in st.session_state:
+                    del st.session_state["analysis"]
+                # Force a rerun to update the UI
+                st.rerun()
+            except Exception as e:
+                error_msg = f" Error generating question: {str(e)}"
+                if "retriever" not in st.session_state:
+                    error_msg += "\n\nRetriever not initialized. Please try selecting a chapter again."
+                st.error(error_msg)
+                st.session_state["error_message"] = error_msg
+                # Add a button to retry question generation
+                if st.button("Retry Generating Question", use_container_width=True):
+                    if "current_question" in st.session_state:
+                        del st.session_state["current_question"]
                     if "error_message" in st.session_state:
                         del st.session_state["error_message"]
-                    if "feedback" in st.session_state:
-                        del st.session_state["feedback"]
-                    if "show_feedback" in st.session_state:
-                        del st.session_state["show_feedback"]
-                    # Ensure we have a valid retriever and LLM
-                    if "retriever" not in st.session_state or "llm" not in st.session_state:
-                        raise ValueError("Question generation components not properly initialized")
-                    # Get the selected chapter or use "All Chapters" as default
-                    selected_chapter = st.session_state.get("selected_chapter", "All Chapters")
-                    # Generate question using the predefined function
-                    q, a, difficulty = generate_question_from_chapter_content(
-                        retriever=st.session_state["retriever"],
-                        llm=st.session_state["llm"],
-                        selected_chapter_title=selected_chapter,
-                        previous_questions=st.session_state.get("asked", set()),
-                        zpd_score=session.current_zpd,
-                    )
-                    if not q or not a:
-                        raise ValueError("Failed to generate a valid question or answer")
-                    # Store question and expected answer in session state
-                    st.session_state["current_question"] = q
-                    st.session_state["expected_answer"] = a
-                    st.session_state["question_difficulty"] = difficulty
-                    # Initialize asked questions set if it doesn't exist
-                    if "asked" not in st.session_state:
-                        st.session_state["asked"] = set()
-                    st.session_state["asked"].add(q.lower())
-                    # Reset feedback state
-                    st.session_state["show_feedback"] = False
-                    if "feedback" in st.session_state:
-                        del st.session_state["feedback"]
-                    if "is_correct" in st.session_state:
-                        del st.session_state["is_correct"]
-                    if "analysis" in st.session_state:
-                        del st.session_state["analysis"]
-                    # Force a rerun to update the UI
                     st.rerun()
-                except Exception as e:
-                    error_msg = f" Error generating question: {str(e)}"
-                    if "retriever" not in st.session_state:
-                        error_msg += "\n\nRetriever not initialized. Please try selecting a chapter again."
-                    st.error(error_msg)
-                    st.session_state["error_message"] = error_msg
-                    # Add a button to retry question generation
-                    if st.button("Retry Generating Question", use_container_width=True):
-                        if "current_question" in st.session_state:
-                            del st.session_state["current_question"]
-                        if "error_message" in st.session_state:
-                            del st.session_state["error_message"]
-                        st.rerun()
-                    return
+                return
 
         # Display the current question with difficulty level
         difficulty = st.session_state.get("question_difficulty", "unknown")
@@ -280,30 +287,37 @@ def quiz():
         with col1:
             if st.button("Submit Answer", use_container_width=True) and user_answer:
                 try:
-                    with st.spinner("Evaluating your answer..."):
-                        # Get feedback on the answer
-                        feedback, correct, analysis = get_feedback_on_answer(
-                            user_answer=user_answer,
-                            expected_answer=st.session_state["expected_answer"],
-                            question=st.session_state["current_question"],
-                            llm=st.session_state["llm"],
-                            zpd_score=session.current_zpd
-                        )
-                        # Update student's ZPD score
-                        old, new = student_mgr.update_student_zpd(
-                            student_session=session,
-                            is_correct=correct,
-                            is_partial=analysis.get("partially_correct", False),
-                        )
-                        # Store feedback in session state
-                        st.session_state.update({
-                            "feedback": feedback,
-                            "show_feedback": True,
-                            "is_correct": correct,
-                            "analysis": analysis,
-                            "zpd_update": (old, new),
-                            "show_hint": False  # Reset hint state for new feedback
-                        })
+                    # Get feedback on the answer, rendering it as it streams in
+                    placeholder = st.empty()
+                    placeholder.info("Evaluating your answer...")
+                    shown = ""
+                    for event in stream_feedback_on_answer(
+                        user_answer=user_answer,
+                        expected_answer=st.session_state["expected_answer"],
+                        question=st.session_state["current_question"],
+                        llm=st.session_state["llm"],
+                        zpd_score=session.current_zpd
+                    ):
+                        if event["event"] == "feedback_delta":
+                            shown += event["text"]
+                            placeholder.markdown(shown + "▌")
+                        elif event["event"] == "result":
+                            feedback, correct, analysis = event["feedback"], event["correct"], event["analysis"]
+                    # Update student's ZPD score
+                    old, new = student_mgr.update_student_zpd(
+                        student_session=session,
+                        is_correct=correct,
+                        is_partial=analysis.get("partially_correct", False),
+                    )
+                    # Store feedback in session state
+                    st.session_state.update({
+                        "feedback": feedback,
+                        "show_feedback": True,
+                        "is_correct": correct,
+                        "analysis": analysis,
+                        "zpd_update": (old, new),
+                        "show_hint": False  # Reset hint state for new feedback
+                    })
                 except Exception as e:
                     st.error(f"Error evaluating answer: {str(e)}")
                 # Force a rerun to update the UI
@@ -327,9 +341,19 @@ def quiz():
             if "show_hint" not in st.session_state:
                 st.session_state["show_hint"] = False
 
-            # Show hint button if answer is incorrect and hint is available
-            if not st.session_state.get("is_correct", False) and st.session_state.get("analysis", {}).get("hint"):
+            # Show hint button if answer is incorrect; the hint is generated (or read from the cache) on click
+            if not st.session_state.get("is_correct", False) and "analysis" in st.session_state:
                 if st.button("Show Hint", use_container_width=True):
+                    analysis = st.session_state["analysis"]
+                    if not analysis.get("hint"):
+                        old_zpd, _ = st.session_state.get("zpd_update", (session.current_zpd, None))
+                        with st.spinner("Thinking of a hint..."):
+                            analysis["hint"] = get_hint(
+                                st.session_state["current_question"],
+                                st.session_state["expected_answer"],
+                                old_zpd,  # The ZPD the answer was graded at
+                                st.session_state["llm"],
+                            )
                     st.session_state["show_hint"] = True
                     st.rerun()
                 # Display the hint if show_hint is True
@@ -0,0 +1,70 @@
+"""Deleting chunks from IVF stores must keep FAISS positions and docstore IDs aligned."""
+import pytest
+
+np = pytest.importorskip("numpy")
+faiss = pytest.importorskip("faiss")
+pytest.importorskip("dotenv")
+pytest.importorskip("langchain_community")
+
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from main import build_faiss_index, delete_chunks
+
+
+class _UnusedEmbeddings(Embeddings):
+    def embed_documents(self, texts):
+        raise AssertionError("the test searches by vector")
+
+    def embed_query(self, text):
+        raise AssertionError("the test searches by vector")
+
+
+def _store(index_type: str, n: int = 800, dim: int = 16):
+    vectors = np.random.default_rng(0).standard_normal((n, dim)).astype("float32")
+    doc_ids = [f"chunk-{i}" for i in range(n)]
+    index = build_faiss_index(vectors, index_type)
+    faiss.extract_index_ivf(index).nprobe = faiss.extract_index_ivf(index).nlist  # Exhaustive, so results are exact
+    store = FAISS(
+        embedding_function=_UnusedEmbeddings(),
+        index=index,
+        docstore=InMemoryDocstore({doc_id: Document(page_content=doc_id) for doc_id in doc_ids}),
+        index_to_docstore_id=dict(enumerate(doc_ids)),
+    )
+    return store, vectors, doc_ids
+
+
+def _nearest(store, vector) -> str:
+    doc, _ = store.similarity_search_with_score_by_vector(vector.tolist(), k=1)[0]
+    return doc.page_content
+
+
+@pytest.mark.parametrize("index_type", ["ivf_flat", "ivf_pq"])
+def test_delete_from_ivf_keeps_ids_aligned(index_type):
+    store, vectors, doc_ids = _store(index_type)
+    deleted = set(doc_ids[::7])
+    delete_chunks(store, sorted(deleted))
+
+    assert store.index.ntotal == len(doc_ids) - len(deleted)
+    assert sorted(store.index_to_docstore_id) == list(range(store.index.ntotal))
+    assert set(store.index_to_docstore_id.values()) == set(doc_ids) - deleted
+    survivors = [i for i, doc_id in enumerate(doc_ids) if doc_id not in deleted]
+    hits = sum(_nearest(store, vectors[i]) == doc_ids[i] for i in survivors[:100])
+    assert hits >= (100 if index_type == "ivf_flat" else 90)  # PQ is approximate
+    assert all(_nearest(store, vectors[i]) not in deleted for i in range(0, len(doc_ids), 7))
+
+
+def test_add_after_ivf_delete_does_not_reuse_ids():
+    store, vectors, doc_ids = _store("ivf_flat")
+    delete_chunks(store, doc_ids[:50])
+    new_vectors = np.random.default_rng(1).standard_normal((20, vectors.shape[1])).astype("float32")
+    new_ids = [f"new-{i}" for i in range(20)]
+    store.add_embeddings([(doc_id, vector.tolist()) for doc_id, vector in zip(new_ids, new_vectors)], ids=new_ids)
+
+    assert len(set(store.index_to_docstore_id.values())) == store.index.ntotal
+    for i in (0, 100, 500, 799):
+        assert _nearest(store, vectors[i]) == doc_ids[i]
+    for doc_id, vector in zip(new_ids, new_vectors):
+        assert _nearest(store, vector) == doc_id
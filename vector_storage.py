@@ -0,0 +1,219 @@
+"""
+Vector Storage - Memory-mapped FAISS index and columnar chunk store
+
+Replaces LangChain's pickled docstore (index.pkl) with a layout that can be memory-mapped:
+- chunks.bin           every chunk's text, UTF-8, back to back
+- chunk_offsets.npy    int64 byte offsets into chunks.bin (one more entry than there are chunks)
+- chunk_pages.npy      int32 page number per chunk
+- chunk_chapters.npy   int16 code per chunk into the chapter tables in columns.json
+- chunk_sources.npy    int16 code per chunk into the source table in columns.json
+- columns.json         docstore IDs plus the small lookup tables
+
+Row i of every column belongs to FAISS vector position i. Worker processes that open the same
+files share their pages through the OS cache, and nothing is unpickled at load time. Indexes
+saved in the old layout (index.pkl) still load; run this module directly to convert one.
+
+Usage:
+    python vector_storage.py    # Convert data/faiss_index_optimized to the columnar layout
+"""
+import json
+import mmap
+import os
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+from langchain.docstore.document import Document
+from langchain_community.docstore.base import Docstore
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+
+INDEX_FILE = "index.faiss"
+LEGACY_DOCSTORE_FILE = "index.pkl"
+TEXT_FILE = "chunks.bin"
+OFFSETS_FILE = "chunk_offsets.npy"
+PAGES_FILE = "chunk_pages.npy"
+CHAPTERS_FILE = "chunk_chapters.npy"
+SOURCES_FILE = "chunk_sources.npy"
+COLUMNS_FILE = "columns.json"  # Written last, so its presence marks a complete columnar store
+
+
+class ColumnarDocstore(Docstore):
+    """
+    Read-only LangChain docstore backed by memory-mapped columns.
+
+    Documents are materialized on lookup from the text blob and typed metadata arrays, so the
+    resident cost of the store is the pages the OS actually touched. Metadata is limited to the
+    fields written by `extract_text_with_metadata`: source, page, chapter_id and chapter_title.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        with open(self.directory / COLUMNS_FILE, 'r', encoding='utf-8') as f:
+            columns = json.load(f)
+        self.doc_ids: List[str] = columns["doc_ids"]
+        self.chapter_ids: List[str] = columns["chapter_ids"]
+        self.chapter_titles: List[str] = columns["chapter_titles"]
+        self.sources: List[str] = columns["sources"]
+        self.offsets = np.load(self.directory / OFFSETS_FILE, mmap_mode="r")
+        self.pages = np.load(self.directory / PAGES_FILE, mmap_mode="r")
+        self.chapters = np.load(self.directory / CHAPTERS_FILE, mmap_mode="r")
+        self.source_codes = np.load(self.directory / SOURCES_FILE, mmap_mode="r")
+        self._rows = {doc_id: row for row, doc_id in enumerate(self.doc_ids)}
+        with open(self.directory / TEXT_FILE, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            # The mapping stays valid after the file is closed; an empty file cannot be mapped
+            self._blob = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    @property
+    def nbytes(self) -> int:
+        """Size of the mapped columns; shared between processes through the page cache."""
+        return len(self._blob) + sum(a.nbytes for a in (self.offsets, self.pages, self.chapters, self.source_codes))
+
+    def text(self, row: int) -> str:
+        return self._blob[int(self.offsets[row]):int(self.offsets[row + 1])].decode('utf-8')
+
+    def document(self, row: int) -> Document:
+        chapter = int(self.chapters[row])
+        return Document(
+            page_content=self.text(row),
+            metadata={
+                "source": self.sources[int(self.source_codes[row])],
+                "page": int(self.pages[row]),
+                "chapter_id": self.chapter_ids[chapter],
+                "chapter_title": self.chapter_titles[chapter],
+            }
+        )
+
+    def search(self, search: str):
+        row = self._rows.get(search)
+        if row is None:
+            return f"ID {search} not found."
+        return self.document(row)
+
+    def chapter_rows(self) -> Dict[str, List[int]]:
+        """Row (= FAISS position) lists per chapter_id, read straight from the chapter column."""
+        rows: Dict[str, List[int]] = {}
+        for code, chapter_id in enumerate(self.chapter_ids):
+            rows.setdefault(chapter_id, []).extend(np.flatnonzero(self.chapters == code).tolist())
+        return {chapter_id: sorted(r) for chapter_id, r in rows.items()}
+
+    def to_dict(self) -> Dict[str, Document]:
+        """Materializes every document, e.g. to get a writable InMemoryDocstore."""
+        return {doc_id: self.document(row) for row, doc_id in enumerate(self.doc_ids)}
+
+
+def _replace(tmp_path: Path, path: Path) -> None:
+    # Readers that mapped the old file keep its inode, so replacing is safe while serving
+    os.replace(tmp_path, path)
+
+
+def write_columnar_docstore(directory: Path, documents: List[Tuple[str, Document]]) -> None:
+    """Writes (doc_id, Document) pairs, in FAISS position order, as columnar files."""
+    directory = Path(directory)
+    chapter_codes: Dict[Tuple[str, str], int] = {}
+    source_codes: Dict[str, int] = {}
+    offsets = np.zeros(len(documents) + 1, dtype=np.int64)
+    pages = np.zeros(len(documents), dtype=np.int32)
+    chapters = np.zeros(len(documents), dtype=np.int16)
+    sources = np.zeros(len(documents), dtype=np.int16)
+
+    tmp_text = directory / (TEXT_FILE + ".tmp")
+    with open(tmp_text, 'wb') as f:
+        for row, (_, doc) in enumerate(documents):
+            data = doc.page_content.encode('utf-8')
+            f.write(data)
+            offsets[row + 1] = offsets[row] + len(data)
+            pages[row] = int(doc.metadata.get("page", 0))
+            chapter = (doc.metadata.get("chapter_id", "unknown"), doc.metadata.get("chapter_title", "Unknown Chapter"))
+            chapters[row] = chapter_codes.setdefault(chapter, len(chapter_codes))
+            sources[row] = source_codes.setdefault(doc.metadata.get("source", ""), len(source_codes))
+    _replace(tmp_text, directory / TEXT_FILE)
+
+    for filename, array in ((OFFSETS_FILE, offsets), (PAGES_FILE, pages),
+                            (CHAPTERS_FILE, chapters), (SOURCES_FILE, sources)):
+        tmp_path = directory / (filename + ".tmp")
+        with open(tmp_path, 'wb') as f:
+            np.save(f, array)
+        _replace(tmp_path, directory / filename)
+
+    tmp_columns = directory / (COLUMNS_FILE + ".tmp")
+    with open(tmp_columns, 'w', encoding='utf-8') as f:
+        json.dump({
+            "doc_ids": [doc_id for doc_id, _ in documents],
+            "chapter_ids": [chapter_id for chapter_id, _ in chapter_codes],
+            "chapter_titles": [title for _, title in chapter_codes],
+            "sources": list(source_codes),
+        }, f)
+    _replace(tmp_columns, directory / COLUMNS_FILE)
+
+
+def save_vectorstore(vectorstore, directory: Path) -> None:
+    """Saves a LangChain FAISS store as index.faiss plus the columnar docstore."""
+    import faiss
+
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    documents = [
+        (doc_id, vectorstore.docstore.search(doc_id))
+        for _, doc_id in sorted(vectorstore.index_to_docstore_id.items())
+    ]
+    tmp_index = directory / (INDEX_FILE + ".tmp")
+    faiss.write_index(vectorstore.index, str(tmp_index))
+    _replace(tmp_index, directory / INDEX_FILE)
+    write_columnar_docstore(directory, documents)
+    legacy = directory / LEGACY_DOCSTORE_FILE
+    if legacy.exists():
+        legacy.unlink()  # The pickle would describe a stale docstore from now on
+
+
+def _read_index(path: Path, use_mmap: bool):
+    import faiss
+
+    if use_mmap:
+        # IO_FLAG_MMAP_IFC maps flat codes in newer FAISS; older versions only map IVF lists
+        flags = faiss.IO_FLAG_READ_ONLY | getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+        try:
+            return faiss.read_index(str(path), flags)
+        except RuntimeError as e:
+            print(f"Memory-mapped index load failed ({e}); reading it into memory instead.")
+    return faiss.read_index(str(path))
+
+
+def load_vectorstore(directory: Path, embeddings, use_mmap: bool = True):
+    """
+    Opens a saved FAISS store.
+
+    Columnar stores are memory-mapped by default; pass `use_mmap=False` to get a writable store
+    (in-memory index and InMemoryDocstore) for incremental updates. Stores still in the legacy
+    pickle layout are loaded through `FAISS.load_local`.
+    """
+    directory = Path(directory)
+    if not (directory / COLUMNS_FILE).exists():
+        return FAISS.load_local(
+            str(directory),
+            embeddings,
+            allow_dangerous_deserialization=True  # Legacy layout only; the columnar store needs no pickle
+        )
+    index = _read_index(directory / INDEX_FILE, use_mmap)
+    docstore = ColumnarDocstore(directory)
+    doc_ids = docstore.doc_ids
+    if not use_mmap:
+        docstore = InMemoryDocstore(docstore.to_dict())
+    return FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=docstore,
+        index_to_docstore_id=dict(enumerate(doc_ids)),
+    )
+
+
+if __name__ == "__main__":
+    from main import VECTORSTORE_PATH, model_registry
+
+    store = load_vectorstore(VECTORSTORE_PATH, model_registry.get_embeddings(), use_mmap=False)
+    save_vectorstore(store, VECTORSTORE_PATH)
+    print(f"✅ Converted {len(store.index_to_docstore_id)} chunks at {VECTORSTORE_PATH} to the columnar layout.")